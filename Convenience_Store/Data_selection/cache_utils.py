@@ -0,0 +1,49 @@
+import hashlib
+import json
+import os
+
+DIGEST_MEMO_NAME = 'file_digests.json'
+
+
+def _read_json(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def file_digest(path, cache_dir):
+    """sha256 of a file's content.
+
+    Hashing a multi-GB PBF takes seconds, so the digest is remembered in
+    cache_dir and only recomputed when the file's size or mtime changes.
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    memo_path = os.path.join(cache_dir, DIGEST_MEMO_NAME)
+    memo = _read_json(memo_path)
+
+    entry = memo.get(path)
+    if entry and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+        return entry['sha256']
+
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    digest = sha.hexdigest()
+
+    memo[path] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': digest}
+    os.makedirs(cache_dir, exist_ok=True)
+    # per-process temp name, several state builds may hash files at once
+    tmp_path = f"{memo_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(memo, f, indent=2)
+    os.replace(tmp_path, memo_path)
+    return digest
+
+
+def cache_key(*parts):
+    """Short stable key built from digests and settings."""
+    return hashlib.sha256('|'.join(str(p) for p in parts).encode('utf-8')).hexdigest()[:16]
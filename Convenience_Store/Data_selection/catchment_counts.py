@@ -0,0 +1,165 @@
+import numpy as np
+import pandas as pd
+import os
+import sys
+import time
+from pyproj import Transformer
+from scipy.spatial import cKDTree
+
+import osmium_feature_counter as feature_scan
+import sa1_geometry_cache
+import state_shards
+import table_store
+
+# Catchment counts: how many features of each TARGET_FEATURES type lie within
+# CATCHMENT_RADII_M metres of a point, the centroid of every region of the
+# geography level or a candidate site. Unlike the counts of
+# osmium_feature_counter.py they do not stop at the region's boundary, so a
+# bus stop across the road counts, and a tiny SA1 does not get a noisy count.
+#
+# One KD-tree per feature type over the projected feature points
+# (osm_feature_points.csv of the state), queried in batches of centres. The
+# points are those of the state, so centres near a state border miss the
+# features across it.
+CATCHMENT_RADII_M = [200, 500, 1000]
+# equal-area metres for all of Australia, where distances stay within a few
+# parts per thousand
+PROJECTED_CRS = "EPSG:3577"
+INPUT_CRS = "EPSG:4326"
+# centres per KD-tree query
+QUERY_BATCH_SIZE = 100_000
+# threads of each query, -1 = every core
+QUERY_WORKERS = -1
+
+CATCHMENT_FILENAME = 'osm_catchment.csv'
+
+
+def catchment_column(feature_type, radius_m):
+    """'bus_stop_count' within 500 m -> 'bus_stop_count_500m'."""
+    return f"{feature_type}_{radius_m}m"
+
+
+def catchment_columns(radii=None):
+    return [catchment_column(feature_type, radius_m)
+            for feature_type in feature_scan.FEATURE_TYPES for radius_m in (radii or CATCHMENT_RADII_M)]
+
+
+def catchment_path(state=state_shards.DEFAULT_STATE):
+    return state_shards.shard_path(state, state_shards.level_filename(CATCHMENT_FILENAME))
+
+
+def project(lons, lats):
+    """(x, y) in PROJECTED_CRS metres of lon/lat points."""
+    transformer = Transformer.from_crs(INPUT_CRS, PROJECTED_CRS, always_xy=True)
+    return transformer.transform(np.asarray(lons, dtype=np.float64), np.asarray(lats, dtype=np.float64))
+
+
+class CatchmentCounter:
+    """KD-trees of the feature points, by feature type, for counting around any centres."""
+
+    def __init__(self, points_df, radii=None):
+        self.radii = list(radii or CATCHMENT_RADII_M)
+        xs, ys = project(points_df['longitude'].to_numpy(), points_df['latitude'].to_numpy())
+        feature_types = points_df['feature_type'].astype(str).to_numpy()
+        self.trees = {}
+        for feature_type in feature_scan.FEATURE_TYPES:
+            is_type = (feature_types == feature_type) & np.isfinite(xs) & np.isfinite(ys)
+            self.trees[feature_type] = cKDTree(np.column_stack([xs[is_type], ys[is_type]]))
+        self.columns = catchment_columns(self.radii)
+
+    def count(self, xs, ys, batch_size=None):
+        """(centres, feature types x radii) counts of the points within each radius of each centre.
+
+        Centres without valid coordinates count 0.
+        """
+        centres = np.column_stack([np.asarray(xs, dtype=np.float64), np.asarray(ys, dtype=np.float64)])
+        valid = np.flatnonzero(np.isfinite(centres).all(axis=1))
+        batch_size = batch_size or QUERY_BATCH_SIZE
+        counts = np.zeros((len(centres), len(self.columns)), dtype=np.int64)
+        for start in range(0, len(valid), batch_size):
+            rows = valid[start:start + batch_size]
+            batch = centres[rows]
+            column = 0
+            for feature_type in feature_scan.FEATURE_TYPES:
+                tree = self.trees[feature_type]
+                for radius_m in self.radii:
+                    if tree.n:
+                        counts[rows, column] = tree.query_ball_point(
+                            batch, radius_m, return_length=True, workers=QUERY_WORKERS)
+                    column += 1
+        return counts
+
+    def count_frame(self, lons, lats):
+        """DataFrame of catchment counts around lon/lat centres (EPSG:4326)."""
+        xs, ys = project(lons, lats)
+        return pd.DataFrame(self.count(xs, ys), columns=self.columns)
+
+
+def region_centroids(state=state_shards.DEFAULT_STATE):
+    """(codes, x, y) of the centroid of every region of the level, in PROJECTED_CRS.
+
+    Regions without geometry get NaN centres, which count 0.
+    """
+    gpkg_path, layer_name, code_column, where = state_shards.region_layer(state)
+    shapes = sa1_geometry_cache.load_sa1_shapes(gpkg_path, layer_name, crs=PROJECTED_CRS,
+                                                code_column=code_column, where=where)
+    centroids = shapes.geometry.centroid
+    return shapes[code_column].to_numpy(), centroids.x.to_numpy(), centroids.y.to_numpy()
+
+
+def load_counter(state=state_shards.DEFAULT_STATE, radii=None):
+    """CatchmentCounter over the feature points of one state's last OSM scan."""
+    _, _, _, points_csv_path = feature_scan.state_paths(state)
+    points_df = table_store.read_table(points_csv_path, columns=['feature_type', 'longitude', 'latitude'])
+    print(f"    ...{len(points_df)} feature points from {table_store.existing_table_path(points_csv_path)}")
+    return CatchmentCounter(points_df, radii)
+
+
+def write_state_catchment(state=state_shards.DEFAULT_STATE):
+    """Catchment counts around every region centroid of one state, saved to its shard."""
+    start_time = time.time()
+    code_column = state_shards.region_code_column()
+    print(f"Catchment counts of {state} ({state_shards.check_level()} centroids, "
+          f"radii {CATCHMENT_RADII_M} m)...")
+    try:
+        counter = load_counter(state)
+    except FileNotFoundError as e:
+        print(f"Error: {e}. Run the OSM feature scan first.")
+        sys.exit()
+
+    codes, xs, ys = region_centroids(state)
+    catchment_df = pd.DataFrame(counter.count(xs, ys), columns=counter.columns)
+    catchment_df.insert(0, code_column, codes)
+
+    output_path = table_store.write_table(catchment_df, catchment_path(state),
+                                          {col: table_store.COUNT_DTYPE for col in counter.columns})
+    print(f"    ...{len(catchment_df)} regions saved to {output_path} ({time.time() - start_time:.2f} seconds)")
+    return output_path
+
+
+def write_candidate_catchment(state, candidates_path, output_path):
+    """Catchment counts of candidate sites (longitude/latitude columns), next to their other columns."""
+    candidates_df = table_store.read_table(candidates_path)
+    counter = load_counter(state)
+    counts_df = counter.count_frame(candidates_df['longitude'].to_numpy(), candidates_df['latitude'].to_numpy())
+    output_df = pd.concat([candidates_df.reset_index(drop=True), counts_df], axis=1)
+    return table_store.write_table(output_df, output_path,
+                                   {col: table_store.COUNT_DTYPE for col in counter.columns})
+
+
+if __name__ == "__main__":
+    # python catchment_counts.py [STATE]
+    #   counts around the region centroids of the state
+    # python catchment_counts.py STATE CANDIDATES_TABLE OUTPUT_TABLE
+    #   counts around candidate sites (longitude/latitude columns), from the
+    #   feature points of the state
+    state = state_shards.check_state(sys.argv[1]) if len(sys.argv) > 1 else state_shards.DEFAULT_STATE
+    if len(sys.argv) > 3:
+        try:
+            output_path = write_candidate_catchment(state, sys.argv[2], sys.argv[3])
+        except FileNotFoundError as e:
+            print(f"Error: {e}")
+            sys.exit()
+        print(f"Candidate catchment counts saved to: {output_path}")
+    else:
+        write_state_catchment(state)
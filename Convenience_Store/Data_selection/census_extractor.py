@@ -0,0 +1,158 @@
+import pyogrio
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import gpkg_attributes
+import state_shards
+import table_store
+
+# pyogrio reads through Arrow when pyarrow is installed, much faster for wide tables
+try:
+    import pyarrow
+    USE_ARROW = True
+except ImportError:
+    USE_ARROW = False
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.json")
+# 'sqlite'  - read .gpkg attribute columns straight from the SQLite table
+# 'pyogrio' - read through GDAL (any vector format)
+ATTRIBUTE_READER = 'sqlite'
+# None = one worker per table
+EXTRACT_WORKERS = None
+
+
+def load_config(config_path):
+    try:
+        with open(config_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        print(f"Error: Config file not found at '{config_path}'")
+    except json.JSONDecodeError:
+        print(f"Error: Config file '{config_path}' is not formatted correctly.")
+    return None
+
+
+def census_tables(config):
+    """Every config entry that describes a table to extract, in config order."""
+    return [key for key, settings in config.items()
+            if isinstance(settings, dict) and 'columns_to_extract' in settings]
+
+
+def resolve_paths(config, config_dir):
+    """Input and output paths of every table, relative ones taken from the config's directory."""
+    for key in census_tables(config):
+        for path_key in ('input_path', 'output_path'):
+            config[key][path_key] = os.path.normpath(os.path.join(config_dir, config[key][path_key]))
+    return config
+
+
+def extract_table(file_key, settings):
+    """Write the configured columns of one census table to its csv.
+
+    Returns (file_key, seconds, rows written or None on failure). Output lines
+    are prefixed with the table, since several tables run at the same time.
+    """
+    start_time = time.time()
+
+    def log(message):
+        print(f"[{file_key}] {message}", flush=True)
+
+    input_file = settings['input_path']
+    output_file = settings['output_path']
+    columns = settings['columns_to_extract']
+    layer_name = settings.get('layer_name')
+
+    use_sqlite = ATTRIBUTE_READER == 'sqlite' and input_file.lower().endswith('.gpkg')
+
+    try:
+        # the layer schema alone, no rows or geometry are read here
+        log(f"Reading layer schema: {input_file} (Layer: {layer_name})")
+        if use_sqlite:
+            all_columns = list(gpkg_attributes.table_columns(input_file, layer_name))
+        else:
+            all_columns = list(pyogrio.read_info(input_file, layer=layer_name)['fields'])
+        log(f"Total columns found: {len(all_columns)}")
+
+        missing_cols = [col for col in columns if col not in all_columns]
+        if missing_cols:
+            log(f"Warning: The following columns were not found in {input_file}: {missing_cols}")
+            columns_to_keep = [col for col in columns if col in all_columns]
+        else:
+            columns_to_keep = columns
+
+        if not columns_to_keep:
+            log(f"Error: None of the requested columns were found in {input_file}. Skipping.")
+            return file_key, time.time() - start_time, None
+
+        if use_sqlite:
+            log(f"Extracting {len(columns_to_keep)} columns (SQLite)...")
+            df_selected = gpkg_attributes.read_attribute_frame(input_file, layer_name, columns_to_keep)
+        else:
+            log(f"Extracting {len(columns_to_keep)} columns (no geometry, Arrow: {USE_ARROW})...")
+            df = pyogrio.read_dataframe(
+                input_file,
+                layer=layer_name,
+                columns=columns_to_keep,
+                read_geometry=False,
+                use_arrow=USE_ARROW
+            )
+            # pyogrio returns the columns in file order
+            df_selected = df[columns_to_keep]
+
+        output_file = table_store.write_table(df_selected, output_file, table_store.census_schema(df_selected))
+        log(f"Success! Extracted data saved to: {output_file}")
+
+    except Exception as e:
+        log(f"An unexpected error occurred: {e}")
+        log(f"Error Type: {type(e)}")
+        return file_key, time.time() - start_time, None
+
+    return file_key, time.time() - start_time, len(df_selected)
+
+
+def extract_tables(config_path=CONFIG_PATH, table_keys=None, workers=EXTRACT_WORKERS,
+                   state=state_shards.DEFAULT_STATE):
+    """Extract the given tables (default: every table in the config) in a process pool.
+
+    {state} in the config paths and layer names is replaced with the state.
+    """
+    config = load_config(config_path)
+    if config is None:
+        return []
+    config = state_shards.fill_state(config, state_shards.check_state(state))
+    config = resolve_paths(config, os.path.dirname(os.path.abspath(config_path)))
+
+    table_keys = table_keys or census_tables(config)
+    missing = [key for key in table_keys if key not in config]
+    if missing:
+        print(f"Error: Could not find {missing} in your config.json file.")
+        table_keys = [key for key in table_keys if key in config]
+    if not table_keys:
+        return []
+
+    workers = workers or len(table_keys)
+    print(f"--- Extracting {table_keys} for {state} with {min(workers, len(table_keys))} workers ---")
+    start_time = time.time()
+
+    if workers == 1 or len(table_keys) == 1:
+        results = [extract_table(key, config[key]) for key in table_keys]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(extract_table, table_keys, [config[key] for key in table_keys]))
+
+    print("\n--- Census extraction summary ---")
+    for file_key, seconds, rows in results:
+        status = f"{rows} rows" if rows is not None else "FAILED"
+        print(f"{file_key}: {status}, {seconds:.2f} seconds")
+    print(f"Total wall time: {time.time() - start_time:.2f} seconds")
+    return results
+
+
+if __name__ == "__main__":
+    # python census_extractor.py [STATE] [TABLE ...]
+    args = sys.argv[1:]
+    state = args.pop(0) if args and args[0] in state_shards.STATES else state_shards.DEFAULT_STATE
+    extract_tables(CONFIG_PATH, args or None, state=state)
@@ -2,14 +2,23 @@ import osmium
 import csv
 import sys
 import os
+from array import array
 
-print("Starting store extraction process (V2)...")
+import osm_apply
+import osm_area_points
+import osm_region_extract
+import state_shards
+import table_store
 
-DATA_PATH = "/Users/Zhuanz/Documents/ACADEMIC/fifth-semaster/Introduction-to-AI/final_project/data"
-OUTPUT_DIR = "/Convenience_Store/Data_for_Conven"
+DATA_PATH = state_shards.BASE_DATA_PATH
 OSM_FILE_PATH = os.path.join(DATA_PATH, 'australia-251105.osm.pbf')
-OUTPUT_CSV_PATH = os.path.join(OUTPUT_DIR, 'convenience_stores_locations.csv')
-os.makedirs(OUTPUT_DIR, exist_ok=True)
+# default state's output; main(state) writes into that state's shard
+OUTPUT_CSV_PATH = state_shards.shard_path(state_shards.DEFAULT_STATE, 'convenience_stores_locations.csv')
+# osm_element_type is 'node', 'way' or 'relation'; ids are the original OSM ids
+STORE_COLUMNS = ['osm_element_id', 'longitude', 'latitude', 'osm_element_type']
+OSM_TYPES = ['node', 'way', 'relation']
+# rows kept in memory before one writerows call
+WRITE_BATCH_SIZE = 50000
 TARGET_SHOP_TAGS = {
     "convenience",
     "conveneince",
@@ -21,86 +30,166 @@ TARGET_SHOP_TAGS = {
     "kiosk"
 }
 
+
+def is_target_shop(tags):
+    #automation to compound tags
+    if 'shop' in tags:
+        shop_value = tags['shop']
+        tag_parts = shop_value.split(';')
+        for part in tag_parts:
+            if part in TARGET_SHOP_TAGS:
+                return True
+
+    return False
+
+
+class StoreRowBuffer:
+    """Typed columns of found stores, written to the csv a batch at a time."""
+    def __init__(self):
+        self.ids = array('q')
+        self.lons = array('d')
+        self.lats = array('d')
+        self.types = array('B')
+
+    def __len__(self):
+        return len(self.ids)
+
+    def append(self, element_id, lon, lat, type_code):
+        self.ids.append(element_id)
+        self.lons.append(lon)
+        self.lats.append(lat)
+        self.types.append(type_code)
+
+    def write_to(self, writer):
+        writer.writerows(zip(self.ids, self.lons, self.lats, (OSM_TYPES[t] for t in self.types)))
+        self.__init__()
+
+
 # osmium handler
 class StoreLocationHandler(osmium.SimpleHandler):
+    # only objects with a shop key reach Python; compound values such as
+    # "convenience;kiosk" are still split in check_tags
+    FILTER_KEYS = ('shop',)
+
     def __init__(self, writer):
         super(StoreLocationHandler, self).__init__()
         self.writer = writer
         self.stores_found = 0
-        self.processed_ids = set()
-
-    def check_tags(self, element_id, tags):
-        if element_id in self.processed_ids:
+        # node 5 and way 5 are different objects, so every type has its own
+        # id bitmap (osmium IdSet, a few bits per id instead of a Python int)
+        self.processed_ids = {osm_type: osmium.index.IdSet() for osm_type in OSM_TYPES}
+        self.rows = StoreRowBuffer()
+        self.area_points = osm_area_points.AreaPointBatcher(self.write_area_points)
+        # node ids of the store ways, for incremental updates
+        self.way_nodes = osm_area_points.WayNodeBuffer()
+
+    def check_tags(self, element_type, element_id, tags):
+        if element_id in self.processed_ids[element_type]:
             return None
 
-        #automation to compound tags
-        if 'shop' in tags:
-            shop_value = tags['shop']
-            tag_parts = shop_value.split(';')
-            for part in tag_parts:
-                if part in TARGET_SHOP_TAGS:
-                    return True
+        return is_target_shop(tags)
+
+    def add_row(self, element_type, element_id, lon, lat):
+        self.rows.append(element_id, lon, lat, OSM_TYPES.index(element_type))
+        self.stores_found += 1
+        if len(self.rows) >= WRITE_BATCH_SIZE:
+            self.flush_rows()
 
-        return False
+    def flush_rows(self):
+        if len(self.rows):
+            self.rows.write_to(self.writer)
+            print(f"Found {self.stores_found} stores so far...", end='\r')
 
-    def write_location(self, element_id, location):
+    def write_location(self, element_type, element_id, location):
         try:
             lon = location.lon
             lat = location.lat
 
-            self.writer.writerow([element_id, lon, lat])
-            self.stores_found += 1
-            self.processed_ids.add(element_id)
-
-            if self.stores_found % 100 == 0:
-                print(f"Found {self.stores_found} stores so far...", end='\r')
+            self.processed_ids[element_type].set(element_id)
+            self.add_row(element_type, element_id, lon, lat)
 
         except osmium.InvalidLocationError:
             pass
 
+    def write_area_points(self, payloads, lons, lats):
+        for (element_type, element_id), lon, lat in zip(payloads, lons.tolist(), lats.tolist()):
+            self.add_row(element_type, element_id, lon, lat)
+
     def node(self, n):
-        if self.check_tags(n.id, n.tags):
-            self.write_location(n.id, n.location)
+        if self.check_tags('node', n.id, n.tags):
+            self.write_location('node', n.id, n.location)
 
     def way(self, w):
         pass
 
-    def area(self, a, i):
-        i = 0
-        if self.check_tags(a.id, a.tags):
-            i = i + 1
-            try:
-                center_location = a.envelope.center
-                self.write_location(a.id, center_location)
-            except osmium.InvalidLocationError:
-                pass
-            except AttributeError:
-                print(f"Skipping area {a.id}, could not get center.")
-                print(f"i = {i}")
-                pass
-
-
-print(f"Scanning OSM file: {OSM_FILE_PATH}")
-print(f"Looking for {len(TARGET_SHOP_TAGS)} types of shop tags...")
-print("This may take several minutes...")
-
-if not os.path.exists(OSM_FILE_PATH):
-    print(f"Error: Input file not found at {OSM_FILE_PATH}")
-    print("Please check the file paths and names.")
-    sys.exit()
-
-try:
-    with open(OUTPUT_CSV_PATH, 'w', newline='', encoding='utf-8') as csvfile:
-        csv_writer = csv.writer(csvfile)
-        csv_writer.writerow(['osm_element_id', 'longitude', 'latitude'])
-
-        handler = StoreLocationHandler(csv_writer)
-        handler.apply_file(OSM_FILE_PATH)
-
-finally:
-    if 'handler' in locals() and handler.stores_found > 0:
+    def area(self, a):
+        element_type = 'way' if a.from_way() else 'relation'
+        if self.check_tags(element_type, a.orig_id(), a.tags):
+            # the point is computed later with the rest of the batch
+            self.processed_ids[element_type].set(a.orig_id())
+            self.area_points.add(a, (element_type, a.orig_id()))
+            if a.from_way():
+                self.way_nodes.add_area(a)
+
+    def finish(self):
+        self.area_points.flush()
+        self.flush_rows()
+        if self.area_points.invalid_areas:
+            print(f"\nSkipped {self.area_points.invalid_areas} areas without a valid geometry.")
+
+
+def open_store_writer(output_csv_path=OUTPUT_CSV_PATH):
+    os.makedirs(os.path.dirname(output_csv_path), exist_ok=True)
+    csvfile = open(output_csv_path, 'w', newline='', encoding='utf-8')
+    csv_writer = csv.writer(csvfile)
+    csv_writer.writerow(STORE_COLUMNS)
+    return csvfile, csv_writer
+
+
+def write_store_way_nodes(handler, output_csv_path=OUTPUT_CSV_PATH):
+    """Node ids of the store ways, next to the store file (see osm_incremental_update.py)."""
+    return table_store.write_table(handler.way_nodes.to_frame(), osm_area_points.way_nodes_path(output_csv_path))
+
+
+def report_store_results(handler, output_csv_path=OUTPUT_CSV_PATH):
+    if handler is not None and handler.stores_found > 0:
         print(f"\n\nScan complete!")
         print(f"Success! Total convenience stores found: {handler.stores_found}")
-        print(f"Locations saved to: {OUTPUT_CSV_PATH}")
+        print(f"Locations saved to: {output_csv_path}")
     else:
-        print("\n\nScan complete, but 0 stores were found or an error occurred.")
\ No newline at end of file
+        print("\n\nScan complete, but 0 stores were found or an error occurred.")
+
+
+def state_output_path(state=state_shards.DEFAULT_STATE):
+    return state_shards.shard_path(state, 'convenience_stores_locations.csv')
+
+
+def main(state=state_shards.DEFAULT_STATE):
+    output_csv_path = state_output_path(state)
+    print(f"Starting store extraction process (V2) for {state}...")
+    print(f"Scanning OSM file: {OSM_FILE_PATH}")
+    print(f"Looking for {len(TARGET_SHOP_TAGS)} types of shop tags...")
+    print("This may take several minutes...")
+
+    if not os.path.exists(OSM_FILE_PATH):
+        print(f"Error: Input file not found at {OSM_FILE_PATH}")
+        print("Please check the file paths and names.")
+        sys.exit()
+
+    osm_file_path = osm_region_extract.resolve_scan_input(
+        OSM_FILE_PATH, state_shards.census_gpkg_path('G01', state), state_shards.sa1_layer_name('G01', state))
+
+    handler = None
+    try:
+        csvfile, csv_writer = open_store_writer(output_csv_path)
+        with csvfile:
+            handler = StoreLocationHandler(csv_writer)
+            osm_apply.apply_handlers(osm_file_path, [handler])
+        write_store_way_nodes(handler, output_csv_path)
+
+    finally:
+        report_store_results(handler, output_csv_path)
+
+
+if __name__ == "__main__":
+    main(state_shards.check_state(sys.argv[1]) if len(sys.argv) > 1 else state_shards.DEFAULT_STATE)
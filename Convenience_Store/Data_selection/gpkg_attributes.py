@@ -0,0 +1,84 @@
+import contextlib
+import numpy as np
+import pandas as pd
+import sqlite3
+
+# A GeoPackage is a SQLite database and every layer is a plain table, so
+# attribute columns can be read with SQL, without GDAL and without touching
+# the geometry blobs.
+
+CHUNK_SIZE = 50000
+
+
+def _connect(gpkg_path):
+    # read-only, so a cached or shared file is never locked for writing;
+    # closing() because a sqlite3 connection's own "with" only ends a transaction
+    return contextlib.closing(sqlite3.connect(f"file:{gpkg_path}?mode=ro", uri=True))
+
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _numpy_dtype(declared_type):
+    declared_type = (declared_type or '').upper()
+    if 'INT' in declared_type or declared_type == 'BOOLEAN':
+        return np.int64
+    if any(t in declared_type for t in ('REAL', 'FLOA', 'DOUB', 'NUMERIC', 'DECIMAL')):
+        return np.float64
+    return object
+
+
+def feature_tables(gpkg_path):
+    with _connect(gpkg_path) as conn:
+        rows = conn.execute("SELECT table_name FROM gpkg_contents WHERE data_type = 'features'").fetchall()
+    return [row[0] for row in rows]
+
+
+def table_columns(gpkg_path, table_name):
+    """{column: declared SQLite type} of a layer, geometry column included."""
+    with _connect(gpkg_path) as conn:
+        rows = conn.execute(f"PRAGMA table_info({_quote(table_name)})").fetchall()
+    if not rows:
+        raise ValueError(f"Table '{table_name}' not found in {gpkg_path}")
+    return {row[1]: row[2] for row in rows}
+
+
+def read_attributes(gpkg_path, table_name, columns, chunk_size=CHUNK_SIZE, where=None):
+    """Read the given columns into {column: NumPy array}, CHUNK_SIZE rows at a time.
+
+    Arrays are typed from the declared column types: int64, float64, or
+    object for text. An integer column holding NULLs becomes float64 with NaN.
+    where is an SQL filter on the rows (as in state_shards.region_layer); the
+    rows it leaves out are never read.
+    """
+    declared = table_columns(gpkg_path, table_name)
+    missing = [col for col in columns if col not in declared]
+    if missing:
+        raise ValueError(f"Columns {missing} not found in table '{table_name}'")
+
+    select = ', '.join(_quote(col) for col in columns)
+    condition = f" WHERE {where}" if where else ""
+    with _connect(gpkg_path) as conn:
+        n_rows = conn.execute(f"SELECT COUNT(*) FROM {_quote(table_name)}{condition}").fetchone()[0]
+        arrays = {col: np.empty(n_rows, dtype=_numpy_dtype(declared[col])) for col in columns}
+
+        cursor = conn.execute(f"SELECT {select} FROM {_quote(table_name)}{condition} ORDER BY rowid")
+        start = 0
+        for chunk in iter(lambda: cursor.fetchmany(chunk_size), []):
+            end = start + len(chunk)
+            for col, values in zip(columns, zip(*chunk)):
+                target = arrays[col]
+                try:
+                    target[start:end] = values
+                except TypeError:
+                    # NULL in an integer column
+                    arrays[col] = target.astype(np.float64)
+                    arrays[col][start:end] = np.array(values, dtype=np.float64)
+            start = end
+
+    return arrays
+
+
+def read_attribute_frame(gpkg_path, table_name, columns, chunk_size=CHUNK_SIZE, where=None):
+    return pd.DataFrame(read_attributes(gpkg_path, table_name, columns, chunk_size, where), columns=columns)
@@ -0,0 +1,171 @@
+import osmium
+from osmium.io import Reader, ThreadPool
+from osmium.osm import osm_entity_bits
+from osmium.area import AreaManager
+from osmium.index import create_map
+import os
+import time
+
+import osm_scan_metrics
+import state_shards
+
+BASE_DATA_PATH = state_shards.BASE_DATA_PATH
+LOCATION_INDEX_DIR = os.path.join(BASE_DATA_PATH, 'osm_cache')
+
+# Node location index used to build area geometries:
+#   'flex_mem'    - osmium default, in memory, picks sparse or dense by itself
+#   'sparse_mem'  - sorted in-memory array, smallest for country extracts
+#   'dense_mmap'  - anonymous mmap indexed by node id (Linux only)
+#   'dense_file'  - dense array in a file under LOCATION_INDEX_DIR; the only
+#                   index osm_incremental_update.py can keep up to date
+#   'sparse_file' - sorted array in a file under LOCATION_INDEX_DIR
+NODE_LOCATION_INDEX = 'flex_mem'
+
+# 'all'    - osmium assembles an area for every tagged closed way / multipolygon
+# 'tagged' - only for ways and relations that carry one of the handlers' FILTER_KEYS
+AREA_MODE = 'all'
+
+LOCATION_INDEX_TYPES = {
+    'flex_mem': 'flex_mem',
+    'sparse_mem': 'sparse_mem_array',
+    'dense_mmap': 'dense_mmap_array',
+    'dense_file': 'dense_file_array',
+    'sparse_file': 'sparse_file_array',
+}
+
+
+def location_index_spec(index_type=None, index_dir=None, osm_file_path=None):
+    """Turn a NODE_LOCATION_INDEX name into the string osmium.index.create_map wants.
+
+    File-backed indexes are named after the scanned file, so per-state scans
+    running side by side each keep their own index.
+    """
+    index_type = index_type or NODE_LOCATION_INDEX
+    index_dir = index_dir or LOCATION_INDEX_DIR
+    if index_type not in LOCATION_INDEX_TYPES:
+        raise ValueError(f"Unknown node location index '{index_type}'. "
+                         f"Choose from {list(LOCATION_INDEX_TYPES.keys())}")
+
+    map_type = LOCATION_INDEX_TYPES[index_type]
+    if map_type not in osmium.index.map_types():
+        print(f"Warning: location index '{map_type}' is not available on this platform, using flex_mem.")
+        return 'flex_mem'
+
+    if map_type.endswith('_file_array'):
+        os.makedirs(index_dir, exist_ok=True)
+        prefix = 'node_locations'
+        if osm_file_path:
+            prefix += '_' + os.path.basename(osm_file_path).split('.')[0]
+        return f"{map_type},{os.path.join(index_dir, f'{prefix}.{index_type}')}"
+    return map_type
+
+
+class AreaCandidateCollector(osmium.SimpleHandler):
+    """Ids of the ways an area may be built from: tagged ways plus outer/inner
+    member ways of tagged multipolygon relations (members are usually untagged)."""
+    def __init__(self):
+        super(AreaCandidateCollector, self).__init__()
+        self.way_ids = set()
+
+    def way(self, w):
+        self.way_ids.add(w.id)
+
+    def relation(self, r):
+        if r.tags.get('type') in ('multipolygon', 'boundary'):
+            for m in r.members:
+                if m.type == 'w':
+                    self.way_ids.add(m.ref)
+
+
+def apply_handlers(osm_file_path, handlers, index_type=None, area_mode=None, scan_name=None):
+    """Decode the OSM file a single time and hand every object to all handlers.
+
+    This mirrors SimpleHandler.apply_file, but with a list of handlers chained
+    behind one reader, so every handler sees the same decoded buffers.
+
+    Handlers with a FILTER_KEYS attribute sit behind one native KeyFilter
+    (the union of their keys), after the handlers that need every object.
+    Handlers with a finish() method (batched area geometry, buffered rows)
+    get it called once the file is read, also when the scan stops early.
+
+    With osm_scan_metrics.SCAN_METRICS on, the handlers' callbacks are timed
+    and a JSON report is written when the scan ends; the ScanMetrics object
+    is returned.
+    """
+    index_type = index_type or NODE_LOCATION_INDEX
+    area_mode = area_mode or AREA_MODE
+    metrics = None
+    if osm_scan_metrics.SCAN_METRICS:
+        metrics = osm_scan_metrics.ScanMetrics(
+            scan_name or '+'.join(type(h).__name__ for h in handlers), osm_file_path)
+        metrics.settings = {'node_location_index': index_type, 'area_mode': area_mode}
+        for handler in handlers:
+            metrics.instrument(handler)
+        metrics.start()
+
+    try:
+        _apply_chain(osm_file_path, handlers, index_type, area_mode, metrics)
+    finally:
+        finish_start = time.perf_counter()
+        for handler in handlers:
+            if hasattr(handler, 'finish'):
+                handler.finish()
+        if metrics is not None:
+            metrics.add_phase('finish', time.perf_counter() - finish_start)
+            metrics.stop()
+            metrics.write_report()
+    return metrics
+
+
+def _timed_apply(metrics, phase, rd, *chain):
+    start = time.perf_counter()
+    osmium.apply(rd, *chain)
+    if metrics is not None:
+        metrics.add_phase(phase, time.perf_counter() - start)
+
+
+def _apply_chain(osm_file_path, handlers, index_type, area_mode, metrics):
+    thread_pool = ThreadPool()
+    entities = osm_entity_bits.NOTHING
+    for handler in handlers:
+        entities |= handler.enabled_for()
+
+    unfiltered = [h for h in handlers if getattr(h, 'FILTER_KEYS', None) is None]
+    filtered = [h for h in handlers if getattr(h, 'FILTER_KEYS', None) is not None]
+    filter_keys = sorted({key for h in filtered for key in h.FILTER_KEYS})
+    targets = list(unfiltered)
+    if filtered:
+        targets += [osmium.filter.KeyFilter(*filter_keys), *filtered]
+
+    if not entities & osm_entity_bits.AREA:
+        with Reader(osm_file_path, entities, thread_pool=thread_pool) as rd:
+            _timed_apply(metrics, 'scan', rd, *targets)
+        return
+
+    # areas need the relations first, then every object with node locations
+    area = AreaManager()
+    area_input_filters = []
+    if area_mode == 'tagged' and filtered and not unfiltered:
+        # first pass also reads ways, so the area builder can later be limited to
+        # the ways our handlers can actually use
+        candidates = AreaCandidateCollector()
+        with Reader(osm_file_path, osm_entity_bits.WAY | osm_entity_bits.RELATION,
+                    thread_pool=thread_pool) as rd:
+            _timed_apply(metrics, 'area_first_pass', rd,
+                         osmium.filter.KeyFilter(*filter_keys), candidates, area.first_pass_handler())
+        way_filter = osmium.filter.IdFilter(candidates.way_ids)
+        way_filter.enable_for(osm_entity_bits.WAY)
+        area_input_filters.append(way_filter)
+    else:
+        if area_mode == 'tagged':
+            print("Warning: AREA_MODE 'tagged' needs every handler to declare FILTER_KEYS, building all areas.")
+        with Reader(osm_file_path, osm_entity_bits.RELATION, thread_pool=thread_pool) as rd:
+            _timed_apply(metrics, 'area_first_pass', rd, area.first_pass_handler())
+
+    entities |= osm_entity_bits.OBJECT
+    lh = osmium.NodeLocationsForWays(create_map(location_index_spec(index_type, osm_file_path=osm_file_path)))
+    lh.ignore_errors()
+    chain = [lh, *area_input_filters, area.second_pass_handler(*targets), *targets]
+
+    with Reader(osm_file_path, entities, thread_pool=thread_pool) as rd:
+        _timed_apply(metrics, 'scan', rd, *chain)
@@ -0,0 +1,149 @@
+import numpy as np
+import pandas as pd
+import shapely
+import osmium
+import os
+from array import array
+
+# 'centroid'       - polygon centroid; when it falls outside the polygon (L-shaped
+#                    buildings, crescent campuses) the representative point is used
+# 'representative' - shapely point_on_surface, always inside the polygon
+AREA_POINT_METHOD = 'centroid'
+# areas collected before one vectorized shapely call
+AREA_BATCH_SIZE = 10000
+
+
+def area_points(geometries, method=None):
+    """One (lon, lat) per polygon, computed for the whole array in a few shapely calls."""
+    method = method or AREA_POINT_METHOD
+    if method not in ('centroid', 'representative'):
+        raise ValueError(f"Unknown area point method '{method}'. Choose 'centroid' or 'representative'")
+
+    if method == 'representative':
+        points = shapely.point_on_surface(geometries)
+    else:
+        points = shapely.centroid(geometries)
+        outside = ~shapely.contains_properly(geometries, points) & ~shapely.is_empty(geometries)
+        if outside.any():
+            points[outside] = shapely.point_on_surface(geometries[outside])
+
+    # areas that did not close give NaN
+    lons = np.full(len(points), np.nan)
+    lats = np.full(len(points), np.nan)
+    has_point = ~shapely.is_empty(points)
+    lons[has_point] = shapely.get_x(points[has_point])
+    lats[has_point] = shapely.get_y(points[has_point])
+    return lons, lats
+
+
+def polygons_from_rings(areas):
+    """Polygons from node coordinates, one entry per area.
+
+    Every area is a list of rings and every ring a list of (lon, lat) pairs,
+    e.g. the outer member ways of a multipolygon. Ways that are only pieces
+    of a ring are joined by build_area. Areas that do not close give an empty
+    geometry.
+    """
+    coords = []
+    ring_index = []
+    area_index = []
+    ring_count = 0
+    for i, rings in enumerate(areas):
+        for ring in rings:
+            if len(ring) < 2:
+                continue
+            coords.extend(ring)
+            ring_index.extend([ring_count] * len(ring))
+            area_index.append(i)
+            ring_count += 1
+
+    geometries = np.full(len(areas), shapely.from_wkt('POLYGON EMPTY'), dtype=object)
+    if not ring_count:
+        return geometries
+    lines = shapely.linestrings(np.asarray(coords, dtype=np.float64), indices=ring_index)
+    multi_lines = shapely.multilinestrings(lines, indices=area_index)
+    geometries[np.unique(area_index)] = shapely.build_area(multi_lines)
+    return geometries
+
+
+class AreaPointBatcher:
+    """Collects osmium areas as WKB and turns them into points a batch at a time.
+
+    area() callbacks only call add(); the geometry work happens in flush(),
+    which hands (payloads, lons, lats) to on_points. Call flush() once more
+    after the scan for the last partial batch.
+    """
+    def __init__(self, on_points, batch_size=None, method=None):
+        self.on_points = on_points
+        self.batch_size = batch_size or AREA_BATCH_SIZE
+        self.method = method
+        self.wkb_factory = osmium.geom.WKBFactory()
+        self.wkbs = []
+        self.payloads = []
+        self.invalid_areas = 0
+
+    def add(self, a, payload):
+        try:
+            self.wkbs.append(self.wkb_factory.create_multipolygon(a))
+        except RuntimeError:
+            # broken multipolygon the area builder could not close
+            self.invalid_areas += 1
+            return
+        self.payloads.append(payload)
+        if len(self.wkbs) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.wkbs:
+            return
+        geometries = shapely.from_wkb(self.wkbs)
+        lons, lats = area_points(geometries, self.method)
+        payloads = self.payloads
+        self.wkbs = []
+        self.payloads = []
+
+        valid = ~np.isnan(lons)
+        if not valid.all():
+            self.invalid_areas += int((~valid).sum())
+            payloads = [p for p, ok in zip(payloads, valid) if ok]
+            lons, lats = lons[valid], lats[valid]
+        self.on_points(payloads, lons, lats)
+
+
+class WayNodeBuffer:
+    """Node ids of the closed ways a scan placed, in ring order.
+
+    Saved next to the scan's output (way_nodes_path), so an incremental
+    update can place a way again when one of its nodes moves.
+    """
+    COLUMNS = ['osm_element_id', 'node_id']
+
+    def __init__(self):
+        self.way_ids = array('q')
+        self.node_ids = array('q')
+
+    def __len__(self):
+        return len(self.way_ids)
+
+    def add(self, way_id, refs):
+        self.way_ids.extend([way_id] * len(refs))
+        self.node_ids.extend(refs)
+
+    def add_area(self, a):
+        """The outer ring of an osmium area built from a way."""
+        for ring in a.outer_rings():
+            self.add(a.orig_id(), [n.ref for n in ring])
+
+    def extend(self, other):
+        self.way_ids.extend(other.way_ids)
+        self.node_ids.extend(other.node_ids)
+
+    def to_frame(self):
+        return pd.DataFrame({'osm_element_id': np.frombuffer(self.way_ids, dtype=np.int64),
+                             'node_id': np.frombuffer(self.node_ids, dtype=np.int64)})
+
+
+def way_nodes_path(output_path):
+    """Where the way nodes of a scan output are saved: name_way_nodes.ext."""
+    stem, ext = os.path.splitext(output_path)
+    return f"{stem}_way_nodes{ext}"
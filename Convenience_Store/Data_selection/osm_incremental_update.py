@@ -0,0 +1,424 @@
+import pandas as pd
+import osmium
+import shapely
+import json
+import os
+import sys
+import time
+
+import catchment_counts
+import geographic_store_data_extraction as store_scan
+import osm_apply
+import osm_area_points
+import osm_region_extract
+import osmium_feature_counter as feature_scan
+import pipeline_records
+import state_shards
+import table_store
+
+BASE_DATA_PATH = state_shards.BASE_DATA_PATH
+# daily .osc / .osc.gz diffs are dropped here and applied in file-name order
+CHANGE_DIR = os.path.join(BASE_DATA_PATH, 'osm_changes')
+APPLIED_LOG_PATH = os.path.join(CHANGE_DIR, 'applied_changes.json')
+
+# Ways are placed again when the way or one of its nodes is in the diff: full
+# scans save the node ids of every placed way (osm_area_points.way_nodes_path)
+# and the update keeps them current.
+#
+# Known limits of the incremental path:
+#  - way nodes that are not in the diff are looked up in the node location
+#    index of the state's last full scan, which every update writes the moved
+#    nodes back to. Only a dense file index can be updated in place, so
+#    NODE_LOCATION_INDEX in osm_apply must be 'dense_file' for ways to resolve
+#  - the diffs cover the whole country; new and changed stores are kept only
+#    inside the outline the state's region extract is cut with, as in a full
+#    scan, and features only inside the state's regions
+#  - multipolygon relations cannot be rebuilt from a diff: deletions and tag
+#    changes that stop a match are applied, geometry changes are not
+
+
+def _tags_dict(tags):
+    return {t.k: t.v for t in tags}
+
+
+class ChangeCollector(osmium.SimpleHandler):
+    """Last state of every object touched by the change files.
+
+    None means the object was deleted.
+    """
+    def __init__(self):
+        super(ChangeCollector, self).__init__()
+        self.nodes = {}
+        self.ways = {}
+        self.relations = {}
+
+    def node(self, n):
+        if n.deleted or not n.location.valid():
+            self.nodes[n.id] = None
+        else:
+            self.nodes[n.id] = (n.location.lon, n.location.lat, _tags_dict(n.tags))
+
+    def way(self, w):
+        if w.deleted:
+            self.ways[w.id] = None
+        else:
+            self.ways[w.id] = ([n.ref for n in w.nodes], _tags_dict(w.tags))
+
+    def relation(self, r):
+        self.relations[r.id] = None if r.deleted else _tags_dict(r.tags)
+
+
+def pending_change_files(change_dir=CHANGE_DIR, applied_log_path=APPLIED_LOG_PATH):
+    if not os.path.isdir(change_dir):
+        return []
+    applied = set()
+    if os.path.exists(applied_log_path):
+        with open(applied_log_path, 'r', encoding='utf-8') as f:
+            applied = set(json.load(f))
+    return [
+        os.path.join(change_dir, name)
+        for name in sorted(os.listdir(change_dir))
+        if name.endswith(('.osc', '.osc.gz', '.osc.bz2')) and name not in applied
+    ]
+
+
+def check_location_index(osm_file_path=None):
+    """Exit unless the last full scan of osm_file_path left a dense file index to update.
+
+    Without one no way can be placed again, and a sparse_file index is a
+    sorted array: set() would append unsorted entries that later lookups miss,
+    returning the location of an older run.
+    """
+    spec = osm_apply.location_index_spec(osm_file_path=osm_file_path)
+    if not spec.startswith('dense_file_array'):
+        print("Error: the incremental update needs a dense file node location index. "
+              "Set NODE_LOCATION_INDEX = 'dense_file' in osm_apply.py and run a full scan first.")
+        sys.exit()
+    index_path = spec.split(',', 1)[1]
+    if not os.path.exists(index_path):
+        print(f"Error: node location index {index_path} not found. "
+              "Run a full scan with NODE_LOCATION_INDEX = 'dense_file' first.")
+        sys.exit()
+
+
+def open_location_index(osm_file_path=None):
+    """Node locations of the last full scan of osm_file_path, updated in place with the diff."""
+    check_location_index(osm_file_path)
+    return osmium.index.create_map(osm_apply.location_index_spec(osm_file_path=osm_file_path))
+
+
+def update_location_index(location_index, changes):
+    for node_id, state in changes.nodes.items():
+        # an invalid location removes a deleted node
+        location = osmium.osm.Location() if state is None else osmium.osm.Location(state[0], state[1])
+        location_index.set(node_id, location)
+
+
+def way_coords(refs, changes, location_index):
+    """Node coordinates of a closed way, or None if it is not an area or a node is unknown."""
+    if len(refs) < 4 or refs[0] != refs[-1]:
+        return None
+    coords = []
+    for ref in refs:
+        state = changes.nodes.get(ref)
+        if state is not None:
+            coords.append((state[0], state[1]))
+        else:
+            try:
+                location = location_index.get(ref)
+            except KeyError:
+                return None
+            coords.append((location.lon, location.lat))
+    return coords
+
+
+def read_way_nodes(output_path):
+    """Node ids of the ways placed in a scan output, or an empty table for outputs older than them."""
+    try:
+        return table_store.read_table(osm_area_points.way_nodes_path(output_path))
+    except FileNotFoundError:
+        print(f"Warning: no way nodes saved with {output_path}, "
+              "ways whose nodes moved keep their points until a full scan.")
+        return pd.DataFrame({col: pd.Series(dtype='int64') for col in osm_area_points.WayNodeBuffer.COLUMNS})
+
+
+def moved_ways(way_nodes_df, changes, way_matches):
+    """{way id: (node ids, match)} of the placed ways that are not in the diff
+    but have a node that is. way_matches maps way ids to their stored match.
+    """
+    touched = way_nodes_df['node_id'].isin(list(changes.nodes)).to_numpy()
+    way_ids = set(way_nodes_df.loc[touched, 'osm_element_id'].tolist()) - set(changes.ways)
+    way_ids &= set(way_matches)
+    rows = way_nodes_df[way_nodes_df['osm_element_id'].isin(list(way_ids))]
+    return {way_id: (refs.tolist(), way_matches[way_id])
+            for way_id, refs in rows.groupby('osm_element_id', sort=False)['node_id']}
+
+
+def update_way_nodes(way_nodes_df, changes, way_refs, output_path):
+    """Save the node ids of the placed ways with the diff's ways replaced."""
+    way_nodes_df = way_nodes_df[~way_nodes_df['osm_element_id'].isin(list(changes.ways))]
+    new_rows = pd.DataFrame(
+        [(way_id, ref) for way_id, refs in way_refs.items() for ref in refs],
+        columns=osm_area_points.WayNodeBuffer.COLUMNS, dtype='int64'
+    )
+    way_nodes_df = pd.concat([way_nodes_df, new_rows], ignore_index=True)
+    table_store.write_table(way_nodes_df, osm_area_points.way_nodes_path(output_path))
+
+
+def plan_element_updates(changes, match_tags, location_index, moved=None):
+    """Which (type, id) keys to drop from the state and which rows to add back.
+
+    match_tags(tags) returns the value to store for a matching object
+    (True or a feature name) and something falsy otherwise. moved maps ways
+    that are not in the diff but have a node in it to (node ids, stored
+    match); they are placed again. A matching way with a node that cannot be
+    resolved keeps its stored point, whether it is in the diff or moved.
+
+    Also returns the node ids of the diff's matching closed ways.
+    """
+    removed = set()
+    added = []
+    unresolved = 0
+    way_refs = {}
+
+    for node_id, state in changes.nodes.items():
+        removed.add(('node', node_id))
+        if state is not None:
+            match = match_tags(state[2])
+            if match:
+                added.append(('node', node_id, match, state[0], state[1]))
+
+    # way points are computed together, the same way a full scan places them
+    way_matches = []
+    way_rings = []
+    for way_id, state in changes.ways.items():
+        match = match_tags(state[1]) if state is not None else None
+        if not match:
+            removed.add(('way', way_id))
+            continue
+        if len(state[0]) >= 4 and state[0][0] == state[0][-1]:
+            way_refs[way_id] = state[0]
+        coords = way_coords(state[0], changes, location_index)
+        if coords is None:
+            # the stored row, if any, stays until the way can be placed
+            unresolved += 1
+        else:
+            removed.add(('way', way_id))
+            way_matches.append((way_id, match))
+            way_rings.append([coords])
+    for way_id, (refs, match) in (moved or {}).items():
+        coords = way_coords(refs, changes, location_index)
+        if coords is None:
+            unresolved += 1
+        else:
+            removed.add(('way', way_id))
+            way_matches.append((way_id, match))
+            way_rings.append([coords])
+
+    if way_rings:
+        lons, lats = osm_area_points.area_points(osm_area_points.polygons_from_rings(way_rings))
+        for (way_id, match), lon, lat in zip(way_matches, lons.tolist(), lats.tolist()):
+            if not pd.isna(lon):
+                added.append(('way', way_id, match, lon, lat))
+            else:
+                unresolved += 1
+
+    # a relation that still matches keeps its old point (see the notes above)
+    for relation_id, tags in changes.relations.items():
+        if tags is None or not match_tags(tags):
+            removed.add(('relation', relation_id))
+
+    return removed, added, unresolved, way_refs
+
+
+def _element_keys(df):
+    return pd.MultiIndex.from_arrays([df['osm_element_type'].astype(str), df['osm_element_id'].astype('int64')])
+
+
+def state_outline(gpkg_path=None, layer_name=None):
+    """Outline of a state, the polygon its region extract is cut with (prepared for point tests)."""
+    outline = osm_region_extract.region_polygon_from_gpkg(gpkg_path or feature_scan.GPKG_PATH,
+                                                          layer_name or feature_scan.GPKG_LAYER_NAME)
+    shapely.prepare(outline)
+    return outline
+
+
+def update_store_locations(changes, location_index, stores_csv_path=store_scan.OUTPUT_CSV_PATH, outline=None):
+    """Apply the diff to a store file; with an outline, only stores inside it are written."""
+    stores_df = pd.read_csv(stores_csv_path)
+    if 'osm_element_type' not in stores_df.columns:
+        # files from before element types were recorded only held nodes
+        stores_df['osm_element_type'] = 'node'
+
+    way_nodes_df = read_way_nodes(stores_csv_path)
+    store_ways = stores_df.loc[stores_df['osm_element_type'] == 'way', 'osm_element_id'].astype('int64')
+    moved = moved_ways(way_nodes_df, changes, dict.fromkeys(store_ways.tolist(), True))
+    removed, added, unresolved, way_refs = plan_element_updates(
+        changes, store_scan.is_target_shop, location_index, moved)
+    outside = 0
+    if outline is not None and added:
+        inside = shapely.contains_xy(outline, [row[3] for row in added], [row[4] for row in added])
+        outside = int((~inside).sum())
+        added = [row for row, ok in zip(added, inside) if ok]
+
+    keep = ~_element_keys(stores_df).isin(list(removed))
+    new_rows = pd.DataFrame(
+        [(osm_id, lon, lat, osm_type) for osm_type, osm_id, _, lon, lat in added],
+        columns=store_scan.STORE_COLUMNS
+    )
+    updated_df = pd.concat([stores_df.loc[keep, store_scan.STORE_COLUMNS], new_rows], ignore_index=True)
+    updated_df.to_csv(stores_csv_path, index=False)
+    update_way_nodes(way_nodes_df, changes, way_refs, stores_csv_path)
+
+    print(f"    ...stores: {int((~keep).sum())} removed/replaced, {len(new_rows)} written, "
+          f"{outside} outside the state, {len(moved)} ways with moved nodes, "
+          f"{unresolved} ways without node locations")
+    return updated_df
+
+
+def update_feature_counts(changes, location_index,
+                          points_csv_path=feature_scan.FEATURE_POINTS_CSV_PATH,
+                          counts_csv_path=feature_scan.OUTPUT_CSV_PATH,
+                          gpkg_path=None, layer_name=None, state=None):
+    handler = feature_scan.FeatureLocationHandler()
+    # SA1_CODE_2021, or MB_CODE_2021 at Mesh Block level
+    code_column = state_shards.region_code_column()
+
+    points_df = table_store.read_table(points_csv_path)
+    points_df[code_column] = points_df[code_column].astype(str)
+    way_nodes_df = read_way_nodes(points_csv_path)
+    feature_ways = points_df[points_df['osm_element_type'].astype(str) == 'way']
+    moved = moved_ways(way_nodes_df, changes, dict(zip(feature_ways['osm_element_id'].astype('int64').tolist(),
+                                                       feature_ways['feature_type'].astype(str).tolist())))
+    removed, added, unresolved, way_refs = plan_element_updates(
+        changes, lambda tags: handler.check_element_tags(tags.items()), location_index, moved
+    )
+    keep = ~_element_keys(points_df).isin(list(removed))
+    touched_regions = set(points_df.loc[~keep, code_column])
+    points_df = points_df[keep]
+
+    if added:
+        new_df = pd.DataFrame(
+            added, columns=['osm_element_type', 'osm_element_id', 'feature_type', 'longitude', 'latitude']
+        )
+        lookup = feature_scan.load_region_lookup(state, gpkg_path, layer_name)
+        joined_df = feature_scan.locate_points_in_sa1(new_df, lookup)
+        touched_regions |= set(joined_df[code_column])
+        # concat turns the categorical columns of the full scan into strings
+        points_df = pd.concat([points_df, joined_df[feature_scan.point_columns(code_column)]],
+                              ignore_index=True).astype(points_df.dtypes.to_dict())
+
+    table_store.write_table(points_df, points_csv_path)
+    update_way_nodes(way_nodes_df, changes, way_refs, points_csv_path)
+
+    # recount only the regions that lost or gained a point
+    counts_df = table_store.read_table(counts_csv_path)
+    counts_df[code_column] = counts_df[code_column].astype(str)
+    touched_codes = sorted(touched_regions)
+    if touched_codes:
+        recount_df = feature_scan.count_features_by_sa1(
+            points_df[points_df[code_column].isin(touched_regions)], touched_codes, code_column
+        ).set_index(code_column)
+
+        counts_df = counts_df.set_index(code_column)
+        for col in recount_df.columns:
+            if col not in counts_df.columns:
+                counts_df[col] = 0
+        recount_df = recount_df.reindex(columns=counts_df.columns, fill_value=0)
+        known = recount_df.index.intersection(counts_df.index)
+        counts_df.loc[known, :] = recount_df.loc[known, :].values
+        counts_df = counts_df.reset_index()
+        table_store.write_table(counts_df, counts_csv_path, feature_scan.count_schema(counts_df))
+
+    print(f"    ...features: {int((~keep).sum())} removed/replaced, {len(added)} written, "
+          f"{len(moved)} ways with moved nodes, {unresolved} ways without node locations, {len(touched_codes)} {state_shards.check_level()} regions recounted")
+    return counts_df
+
+
+def state_output_paths(state):
+    """(stores csv, feature points csv, feature counts csv) of one state."""
+    _, _, counts_csv_path, points_csv_path = feature_scan.state_paths(state)
+    return store_scan.state_output_path(state), points_csv_path, counts_csv_path
+
+
+def rewritten_paths(state):
+    """The files an update rewrites in place, as run_pipeline names the scan outputs."""
+    stores_csv_path, points_csv_path, counts_csv_path = state_output_paths(state)
+    return [stores_csv_path, osm_area_points.way_nodes_path(table_store.table_path(stores_csv_path)),
+            table_store.table_path(points_csv_path), table_store.table_path(counts_csv_path),
+            osm_area_points.way_nodes_path(table_store.table_path(points_csv_path))]
+
+
+def scanned_states():
+    """States with the outputs of a full scan to update."""
+    return [state for state in state_shards.STATES
+            if all(os.path.exists(table_store.existing_table_path(path)) for path in state_output_paths(state))]
+
+
+def apply_change_files(change_files, states=None):
+    states = states or [state_shards.DEFAULT_STATE]
+    # every state is checked before any file is touched
+    for state in states:
+        gpkg_path, layer_name, _, _ = feature_scan.state_paths(state)
+        check_location_index(osm_region_extract.resolve_scan_input(feature_scan.OSM_FILE_PATH, gpkg_path, layer_name))
+
+    changes = ChangeCollector()
+    for path in change_files:
+        print(f"Reading change file: {path}")
+        changes.apply_file(path)
+    print(f"    ...{len(changes.nodes)} nodes, {len(changes.ways)} ways, "
+          f"{len(changes.relations)} relations changed")
+
+    for state in states:
+        print(f"\n--- {state} ---")
+        gpkg_path, layer_name, _, _ = feature_scan.state_paths(state)
+        stores_csv_path, points_csv_path, counts_csv_path = state_output_paths(state)
+        # the stores:<state> and osm_features:<state> runs these files came from
+        scan_stages = pipeline_records.stages_with_outputs(rewritten_paths(state))
+        # the index written by this state's last scan, which read its region extract
+        scan_input = osm_region_extract.resolve_scan_input(feature_scan.OSM_FILE_PATH, gpkg_path, layer_name)
+        location_index = open_location_index(scan_input)
+        update_location_index(location_index, changes)
+
+        update_store_locations(changes, location_index, stores_csv_path, state_outline(gpkg_path, layer_name))
+        update_feature_counts(changes, location_index, points_csv_path, counts_csv_path, gpkg_path, layer_name, state)
+        # otherwise the next run_pipeline would see changed outputs, scan the
+        # old PBF again and drop the applied diffs
+        pipeline_records.record_rewritten_outputs(scan_stages)
+        # a moved point changes the catchment of every centroid near it; the
+        # KD-tree recount of the whole state takes seconds
+        if os.path.exists(table_store.existing_table_path(catchment_counts.catchment_path(state))):
+            catchment_counts.write_state_catchment(state)
+
+
+def main(change_files=None):
+    print("--- Starting incremental OSM update ---")
+    start_time = time.time()
+
+    from_change_dir = not change_files
+    change_files = change_files or pending_change_files()
+    if not change_files:
+        print(f"Nothing to do: no new change files in {CHANGE_DIR}")
+        return
+
+    states = scanned_states()
+    if not states:
+        print(f"Error: no state has a full scan in {state_shards.SHARDS_DIR}. Run a full scan first.")
+        sys.exit()
+    print(f"Updating states: {states}")
+
+    apply_change_files(change_files, states)
+
+    if from_change_dir:
+        applied = []
+        if os.path.exists(APPLIED_LOG_PATH):
+            with open(APPLIED_LOG_PATH, 'r', encoding='utf-8') as f:
+                applied = json.load(f)
+        applied += [os.path.basename(path) for path in change_files]
+        with open(APPLIED_LOG_PATH, 'w', encoding='utf-8') as f:
+            json.dump(applied, f, indent=2)
+
+    print(f"\nIncremental update finished in {time.time() - start_time:.2f} seconds")
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
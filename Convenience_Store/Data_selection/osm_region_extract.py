@@ -0,0 +1,147 @@
+import numpy as np
+import shapely
+import osmium
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+import cache_utils
+import sa1_geometry_cache
+import state_shards
+
+BASE_DATA_PATH = state_shards.BASE_DATA_PATH
+SOURCE_OSM_PATH = os.path.join(BASE_DATA_PATH, 'australia-251105.osm.pbf')
+REGION_GPKG_PATH = os.path.join(BASE_DATA_PATH, "Geopackage_2021_G01_NSW_GDA2020/G01_NSW_GDA2020.gpkg")
+REGION_LAYER_NAME = "G01_SA1_2021_NSW"
+CACHE_DIR = os.path.join(BASE_DATA_PATH, 'osm_cache')
+
+# scanners read the clipped extract instead of the whole country when True
+USE_REGION_EXTRACT = True
+
+# degrees; keeps the clip polygon small and catches points right on the coast
+REGION_SIMPLIFY = 0.005
+REGION_BUFFER = 0.02
+NODE_BATCH_SIZE = 1_000_000
+
+
+def region_polygon_from_gpkg(gpkg_path, layer_name):
+    """Outline of every polygon in the layer, in EPSG:4326, slightly buffered."""
+    shapes = sa1_geometry_cache.load_sa1_shapes(gpkg_path, layer_name, crs="EPSG:4326")
+    outline = shapely.union_all(shapes.geometry.values)
+    return outline.simplify(REGION_SIMPLIFY).buffer(REGION_BUFFER)
+
+
+def _extract_with_osmium_tool(source_path, polygon, output_path):
+    polygon_path = output_path + '.geojson'
+    with open(polygon_path, 'w', encoding='utf-8') as f:
+        json.dump({'type': 'Feature', 'properties': {},
+                   'geometry': shapely.geometry.mapping(polygon)}, f)
+    try:
+        subprocess.run(
+            ['osmium', 'extract', '--polygon', polygon_path, '--strategy', 'complete_ways',
+             '--overwrite', '--output', output_path, source_path],
+            check=True
+        )
+    finally:
+        os.remove(polygon_path)
+
+
+def _extract_with_pyosmium(source_path, polygon, output_path):
+    # pass 1: ids of the nodes inside the polygon, tested a batch at a time
+    shapely.prepare(polygon)
+    inside_nodes = osmium.index.IdSet()
+    ids = np.empty(NODE_BATCH_SIZE, dtype=np.int64)
+    lons = np.empty(NODE_BATCH_SIZE, dtype=np.float64)
+    lats = np.empty(NODE_BATCH_SIZE, dtype=np.float64)
+    filled = 0
+
+    def flush(n):
+        for node_id in ids[:n][shapely.contains_xy(polygon, lons[:n], lats[:n])]:
+            inside_nodes.set(int(node_id))
+
+    for n in osmium.FileProcessor(source_path, osmium.osm.NODE):
+        if not n.location.valid():
+            continue
+        ids[filled] = n.id
+        lons[filled] = n.location.lon
+        lats[filled] = n.location.lat
+        filled += 1
+        if filled == NODE_BATCH_SIZE:
+            flush(filled)
+            filled = 0
+    flush(filled)
+
+    # pass 2: keep those nodes plus any way/relation touching them; the writer
+    # adds the missing way nodes (untagged), like osmium's complete_ways
+    kept_ways = osmium.index.IdSet()
+    with osmium.BackReferenceWriter(output_path, ref_src=source_path, overwrite=True) as writer:
+        for obj in osmium.FileProcessor(source_path):
+            if obj.is_node():
+                if obj.id in inside_nodes:
+                    writer.add_node(obj)
+            elif obj.is_way():
+                if any(n.ref in inside_nodes for n in obj.nodes):
+                    kept_ways.set(obj.id)
+                    writer.add_way(obj)
+            elif obj.is_relation():
+                for m in obj.members:
+                    if (m.type == 'n' and m.ref in inside_nodes) or (m.type == 'w' and m.ref in kept_ways):
+                        writer.add_relation(obj)
+                        break
+
+
+def build_region_extract(source_path=SOURCE_OSM_PATH, gpkg_path=REGION_GPKG_PATH,
+                         layer_name=REGION_LAYER_NAME, cache_dir=CACHE_DIR):
+    """Return the path of the clipped PBF, cutting it only if it is not cached yet."""
+    source_digest = cache_utils.file_digest(source_path, cache_dir)
+    region_digest = cache_utils.file_digest(gpkg_path, cache_dir)
+    key = cache_utils.cache_key(source_digest, region_digest, layer_name, REGION_SIMPLIFY, REGION_BUFFER)
+    output_path = os.path.join(cache_dir, f"{layer_name}_{key}.osm.pbf")
+
+    if os.path.exists(output_path):
+        print(f"    ...reusing cached region extract: {output_path}")
+        return output_path
+
+    print(f"Cutting {source_path} to the outline of {layer_name}...")
+    start_time = time.time()
+    polygon = region_polygon_from_gpkg(gpkg_path, layer_name)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = output_path + '.tmp.osm.pbf'
+    if shutil.which('osmium'):
+        _extract_with_osmium_tool(source_path, polygon, tmp_path)
+    else:
+        print("    ...osmium-tool not found, using the (slower) pyosmium clipper")
+        _extract_with_pyosmium(source_path, polygon, tmp_path)
+    os.replace(tmp_path, output_path)
+
+    source_mb = os.path.getsize(source_path) / 1e6
+    extract_mb = os.path.getsize(output_path) / 1e6
+    print(f"    ...extract saved to {output_path} ({extract_mb:.1f} MB of {source_mb:.1f} MB, "
+          f"{time.time() - start_time:.1f} seconds)")
+    return output_path
+
+
+def resolve_scan_input(osm_file_path, gpkg_path=None, layer_name=None):
+    """The file an OSM scanner should read: the cached region extract when enabled.
+
+    gpkg_path/layer_name pick the region (default REGION_GPKG_PATH, i.e. NSW),
+    so each state is scanned from its own extract.
+    """
+    gpkg_path = gpkg_path or REGION_GPKG_PATH
+    layer_name = layer_name or REGION_LAYER_NAME
+    if not USE_REGION_EXTRACT:
+        return osm_file_path
+    if not os.path.exists(gpkg_path):
+        print(f"Warning: region GeoPackage not found at {gpkg_path}, scanning the full file.")
+        return osm_file_path
+    return build_region_extract(osm_file_path, gpkg_path, layer_name, CACHE_DIR)
+
+if __name__ == "__main__":
+    if not os.path.exists(SOURCE_OSM_PATH):
+        print(f"Error: Input file not found at {SOURCE_OSM_PATH}")
+        sys.exit()
+    build_region_extract()
@@ -0,0 +1,168 @@
+import json
+import os
+import sys
+import time
+
+import state_shards
+
+BASE_DATA_PATH = state_shards.BASE_DATA_PATH
+METRICS_DIR = os.path.join(BASE_DATA_PATH, 'osm_scan_metrics')
+
+# time every handler callback and write a JSON report after each scan. Off by
+# default: the timing wraps every callback in an extra Python call. Turn it on
+# with OSM_SCAN_METRICS=1 in the environment, which the scan worker processes
+# inherit, or by setting SCAN_METRICS here.
+SCAN_METRICS = os.environ.get('OSM_SCAN_METRICS', '0') not in ('', '0')
+
+CALLBACK_TYPES = ('node', 'way', 'relation', 'area')
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process (children not included), None where unknown (Windows)."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    if sys.platform == 'darwin':
+        return peak / 1e6
+    return peak * 1024 / 1e6
+
+
+def _handler_name(handler):
+    return type(handler).__name__
+
+
+class ScanMetrics:
+    """Counts and callback time for every handler of one scan.
+
+    instrument() wraps a handler's node/way/relation/area methods on the
+    instance (enabled_for still sees the same callbacks), so handlers need no
+    changes. Whatever is not callback time is spent in osmium itself:
+    decoding, node location lookups and area assembly.
+    """
+    def __init__(self, scan_name, osm_file_path=None):
+        self.scan_name = scan_name
+        self.osm_file_path = osm_file_path
+        self.counts = {}
+        self.callback_seconds = {}
+        self.phase_seconds = {}
+        self.settings = {}
+        self.worker_peak_rss_mb = 0.0
+        self.instrumented = []
+        self.start_time = None
+        self.wall_seconds = 0.0
+
+    def instrument(self, handler):
+        name = _handler_name(handler)
+        counts = self.counts.setdefault(name, {})
+        seconds = self.callback_seconds.setdefault(name, {})
+        for osm_type in CALLBACK_TYPES + ('finish',):
+            callback = getattr(handler, osm_type, None)
+            if callback is None:
+                continue
+            counts.setdefault(osm_type, 0)
+            seconds.setdefault(osm_type, 0.0)
+            setattr(handler, osm_type, self._timed(callback, counts, seconds, osm_type))
+            self.instrumented.append((handler, osm_type))
+        return handler
+
+    @staticmethod
+    def _timed(callback, counts, seconds, osm_type):
+        perf_counter = time.perf_counter
+
+        def timed_callback(*args):
+            start = perf_counter()
+            try:
+                return callback(*args)
+            finally:
+                seconds[osm_type] += perf_counter() - start
+                counts[osm_type] += 1
+        return timed_callback
+
+    def uninstrument(self):
+        for handler, osm_type in self.instrumented:
+            handler.__dict__.pop(osm_type, None)
+        self.instrumented = []
+
+    def start(self):
+        self.start_time = time.perf_counter()
+
+    def stop(self):
+        if self.start_time is not None:
+            self.wall_seconds += time.perf_counter() - self.start_time
+            self.start_time = None
+        self.uninstrument()
+
+    def add_phase(self, name, seconds):
+        self.phase_seconds[name] = self.phase_seconds.get(name, 0.0) + seconds
+
+    def merge(self, other):
+        """Add the counts of a worker's metrics (parallel scans)."""
+        for name, counts in other.counts.items():
+            mine = self.counts.setdefault(name, {})
+            for osm_type, count in counts.items():
+                mine[osm_type] = mine.get(osm_type, 0) + count
+        for name, seconds in other.callback_seconds.items():
+            mine = self.callback_seconds.setdefault(name, {})
+            for osm_type, value in seconds.items():
+                mine[osm_type] = mine.get(osm_type, 0.0) + value
+        for phase, value in other.phase_seconds.items():
+            self.add_phase(phase, value)
+        self.worker_peak_rss_mb = max(self.worker_peak_rss_mb, other.worker_peak_rss_mb)
+
+    def report(self):
+        wall = self.wall_seconds or 1e-9
+        handlers = {}
+        callback_total = 0.0
+        for name, counts in self.counts.items():
+            seconds = self.callback_seconds[name]
+            objects = sum(count for osm_type, count in counts.items() if osm_type in CALLBACK_TYPES)
+            callback_seconds = sum(seconds.values())
+            callback_total += callback_seconds
+            handlers[name] = {
+                'objects': {k: v for k, v in counts.items() if k in CALLBACK_TYPES},
+                'objects_per_second': round(objects / wall, 1),
+                'callback_seconds': {k: round(v, 3) for k, v in seconds.items()},
+                'callback_seconds_total': round(callback_seconds, 3),
+            }
+
+        report = {
+            'scan': self.scan_name,
+            'finished_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'osm_file': self.osm_file_path,
+            'wall_seconds': round(self.wall_seconds, 3),
+            'phase_seconds': {k: round(v, 3) for k, v in self.phase_seconds.items()},
+            'callback_seconds_total': round(callback_total, 3),
+            'osmium_seconds': round(max(self.wall_seconds - callback_total, 0.0), 3),
+            'peak_rss_mb': peak_rss_mb(),
+            'settings': self.settings,
+            'handlers': handlers,
+        }
+        if report['peak_rss_mb'] is not None:
+            report['peak_rss_mb'] = round(report['peak_rss_mb'], 1)
+        if self.osm_file_path and os.path.exists(self.osm_file_path):
+            size_mb = os.path.getsize(self.osm_file_path) / 1e6
+            report['osm_file_mb'] = round(size_mb, 1)
+            report['mb_per_second'] = round(size_mb / wall, 2)
+        if self.worker_peak_rss_mb:
+            report['worker_peak_rss_mb'] = round(self.worker_peak_rss_mb, 1)
+        return report
+
+    def write_report(self, path=None):
+        if path is None:
+            os.makedirs(METRICS_DIR, exist_ok=True)
+            # per-state scans run in parallel: the input file, the process and
+            # the microseconds keep their report names apart
+            now = time.time()
+            parts = [time.strftime('%Y%m%d_%H%M%S', time.localtime(now)) + f"_{int(now % 1 * 1e6):06d}",
+                     self.scan_name]
+            if self.osm_file_path:
+                parts.append(os.path.basename(self.osm_file_path).split('.')[0])
+            parts.append(f"pid{os.getpid()}")
+            path = os.path.join(METRICS_DIR, '_'.join(parts) + '.json')
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.report(), f, indent=2)
+        print(f"    ...scan metrics saved to: {path}")
+        return path
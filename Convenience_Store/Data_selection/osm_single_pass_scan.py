@@ -0,0 +1,86 @@
+import os
+import sys
+import time
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(CURRENT_DIR, '..', '..', 'script_to_clean_data', 'get_name'))
+
+import geographic_store_data_extraction as store_scan
+import osm_apply
+import osm_region_extract
+import osmium_feature_counter as feature_scan
+import scan_tags_from_osm_file as tag_scan
+import state_shards
+
+OSM_FILE_PATH = feature_scan.OSM_FILE_PATH
+
+
+# name -> (build handler, write its usual output) for one state
+def _store_task(state):
+    output_csv_path = store_scan.state_output_path(state)
+    csvfile, csv_writer = store_scan.open_store_writer(output_csv_path)
+    handler = store_scan.StoreLocationHandler(csv_writer)
+
+    def finish():
+        csvfile.close()
+        store_scan.write_store_way_nodes(handler, output_csv_path)
+        store_scan.report_store_results(handler, output_csv_path)
+
+    return handler, finish
+
+
+def _feature_task(state):
+    handler = feature_scan.FeatureLocationHandler()
+    gpkg_path, layer_name, output_csv_path, points_csv_path = feature_scan.state_paths(state)
+    return handler, lambda: feature_scan.write_feature_counts(
+        handler, output_csv_path, points_csv_path, gpkg_path, layer_name, state)
+
+
+def _tag_task(state):
+    handler = tag_scan.TagScannerHandler()
+    return handler, lambda: tag_scan.write_tag_scan_results(handler, tag_scan.OUTPUT_TXT_PATH)
+
+
+SCAN_TASKS = {
+    'stores': _store_task,
+    'features': _feature_task,
+    'tags': _tag_task,
+}
+
+
+def main(task_names=None, state=state_shards.DEFAULT_STATE):
+    task_names = task_names or list(SCAN_TASKS.keys())
+    unknown = [name for name in task_names if name not in SCAN_TASKS]
+    if unknown:
+        print(f"Error: unknown scan task(s) {unknown}. Choose from {list(SCAN_TASKS.keys())}")
+        sys.exit()
+
+    print(f"--- Starting single-pass OSM scan ({state}) ---")
+    print(f"Scanning OSM file: {OSM_FILE_PATH}")
+    print(f"Handlers in this pass: {task_names}")
+    start_time = time.time()
+
+    if not os.path.exists(OSM_FILE_PATH):
+        print(f"Error: Input file not found at {OSM_FILE_PATH}")
+        sys.exit()
+
+    gpkg_path, layer_name, _, _ = feature_scan.state_paths(state)
+    osm_file_path = osm_region_extract.resolve_scan_input(OSM_FILE_PATH, gpkg_path, layer_name)
+
+    tasks = [SCAN_TASKS[name](state) for name in task_names]
+    try:
+        osm_apply.apply_handlers(osm_file_path, [handler for handler, _ in tasks])
+    finally:
+        print(f"\nDecode finished in {time.time() - start_time:.2f} seconds. Writing outputs...")
+        for name, (_, finish) in zip(task_names, tasks):
+            print(f"\n--- Output: {name} ---")
+            finish()
+
+    print(f"\nTotal cost: {time.time() - start_time:.2f} second")
+
+
+if __name__ == "__main__":
+    # python osm_single_pass_scan.py [STATE] [TASK ...]
+    args = sys.argv[1:]
+    state = args.pop(0) if args and args[0] in state_shards.STATES else state_shards.DEFAULT_STATE
+    main(args, state)
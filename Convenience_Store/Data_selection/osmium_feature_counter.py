@@ -1,21 +1,38 @@
-import geopandas as gpd
 import pandas as pd
+import numpy as np
 import osmium
 import os
 import sys
 import time
-
-print("--- Starting OSM Feature Counter Script ---")
-start_time = time.time()
-
-BASE_DATA_PATH = "/Users/Zhuanz/Documents/ACADEMIC/fifth-semaster/Introduction-to-AI/final_project/data/"
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+import osm_apply
+import osm_area_points
+import osm_region_extract
+import osm_scan_metrics
+import pbf_blocks
+import sa1_lookup
+import state_shards
+import table_store
+
+BASE_DATA_PATH = state_shards.BASE_DATA_PATH
 OSM_FILE_PATH = os.path.join(BASE_DATA_PATH, 'australia-251105.osm.pbf')
-GPKG_PATH = os.path.join(BASE_DATA_PATH, "Geopackage_2021_G01_NSW_GDA2020/G01_NSW_GDA2020.gpkg")
-GPKG_LAYER_NAME = "G01_SA1_2021_NSW"
+# defaults for the default state; main(state) uses the paths of the given state
+GPKG_PATH = state_shards.census_gpkg_path('G01')
+GPKG_LAYER_NAME = state_shards.sa1_layer_name('G01')
 
-OUTPUT_DIR = "/Users/Zhuanz/Documents/ACADEMIC/fifth-semaster/Introduction-to-AI/final_project/Convenience_Store/Data_for_Conven"
+OUTPUT_DIR = state_shards.shard_dir()
 OUTPUT_CSV_PATH = os.path.join(OUTPUT_DIR, 'osm_features.csv')
-os.makedirs(OUTPUT_DIR, exist_ok=True)
+# every matched feature with its SA1, the state incremental updates start from
+FEATURE_POINTS_CSV_PATH = os.path.join(OUTPUT_DIR, 'osm_feature_points.csv')
+FEATURE_POINT_COLUMNS = ['osm_element_type', 'osm_element_id', 'feature_type',
+                         'longitude', 'latitude', 'SA1_CODE_2021']
+# at Mesh Block level (state_shards.GEOGRAPHY_LEVEL) counts and points are
+# keyed by MB_CODE_2021 instead, in files with an _MB suffix
+
+# 1 = single-threaded osm_apply scan, >1 = parallel block-range scan
+SCAN_WORKERS = 1
 
 
 TARGET_FEATURES = {
@@ -45,13 +62,70 @@ for col_name, (key, value) in TARGET_FEATURES.items():
         TAG_FILTER[key] = set()
     TAG_FILTER[key].add(value)
 
+# feature_type is stored as a small code into this list
+FEATURE_TYPES = list(TARGET_FEATURES.keys())
+FEATURE_CODES = {name: code for code, name in enumerate(FEATURE_TYPES)}
+OSM_TYPES = ['node', 'way', 'relation']
+OSM_TYPE_CODES = {name: code for code, name in enumerate(OSM_TYPES)}
+
+
+class FeatureBuffer:
+    """Growable typed columns for matched features: type code, lon, lat,
+    plus the OSM object type code and id the feature came from.
+
+    A few bytes per feature instead of one dict, and the columns can be viewed
+    as NumPy arrays without copying.
+    """
+    def __init__(self):
+        self.codes = array('B')
+        self.lons = array('d')
+        self.lats = array('d')
+        self.osm_types = array('B')
+        self.osm_ids = array('q')
+
+    def __len__(self):
+        return len(self.codes)
+
+    def append(self, code, lon, lat, osm_type, osm_id):
+        self.codes.append(code)
+        self.lons.append(lon)
+        self.lats.append(lat)
+        self.osm_types.append(osm_type)
+        self.osm_ids.append(osm_id)
+
+    def extend(self, other):
+        self.codes.extend(other.codes)
+        self.lons.extend(other.lons)
+        self.lats.extend(other.lats)
+        self.osm_types.extend(other.osm_types)
+        self.osm_ids.extend(other.osm_ids)
+
+    def to_numpy(self):
+        return (
+            np.frombuffer(self.codes, dtype=np.uint8),
+            np.frombuffer(self.lons, dtype=np.float64),
+            np.frombuffer(self.lats, dtype=np.float64),
+        )
+
+    def ids_to_numpy(self):
+        return (
+            np.frombuffer(self.osm_types, dtype=np.uint8),
+            np.frombuffer(self.osm_ids, dtype=np.int64),
+        )
+
 
 # Osmium processing unit
 class FeatureLocationHandler(osmium.SimpleHandler):
+    # osmium drops objects without any of these keys before the Python callbacks
+    FILTER_KEYS = tuple(TAG_FILTER.keys())
+
     def __init__(self):
         super(FeatureLocationHandler, self).__init__()
-        self.features_list = []
+        self.features = FeatureBuffer()
         self.reverse_lookup = {v: k for k, v in TARGET_FEATURES.items()}
+        self.area_points = osm_area_points.AreaPointBatcher(self.add_area_points)
+        # node ids of the matched closed ways, for incremental updates
+        self.way_nodes = osm_area_points.WayNodeBuffer()
 
     def check_element_tags(self, tags):
         for tag_key, tag_value in tags:
@@ -65,106 +139,325 @@ class FeatureLocationHandler(osmium.SimpleHandler):
                         return col_name
         return None
 
-    def add_feature(self, col_name, location):
+    def add_feature(self, col_name, location, osm_type, osm_id):
         try:
-            self.features_list.append({
-                'feature_type': col_name,
-                'lon': location.lon,
-                'lat': location.lat
-            })
+            self.features.append(FEATURE_CODES[col_name], location.lon, location.lat,
+                                 OSM_TYPE_CODES[osm_type], osm_id)
         except osmium.InvalidLocationError:
             pass
 
+    def add_area_points(self, payloads, lons, lats):
+        for (code, osm_type, osm_id), lon, lat in zip(payloads, lons.tolist(), lats.tolist()):
+            self.features.append(code, lon, lat, osm_type, osm_id)
+
     def node(self, n):
         col_name = self.check_element_tags(n.tags)
         if col_name:
-            self.add_feature(col_name, n.location)
+            self.add_feature(col_name, n.location, 'node', n.id)
 
     def area(self, a):
         col_name = self.check_element_tags(a.tags)
         if col_name:
-            try:
-                center_location = a.envelope.center
-                self.add_feature(col_name, center_location)
-            except Exception:
-                pass
+            osm_type = 'way' if a.from_way() else 'relation'
+            self.area_points.add(a, (FEATURE_CODES[col_name], OSM_TYPE_CODES[osm_type], a.orig_id()))
+            if a.from_way():
+                self.way_nodes.add_area(a)
+
+    def finish(self):
+        self.area_points.flush()
+
+
+# Parallel scan: every worker decodes its own range of PBF blocks.
+# Node features are finished inside the worker. Ways and multipolygon
+# relations only know their member ids there, so their node locations are
+# looked up in a second parallel pass over the blocks.
+class BlockRangeScanner(FeatureLocationHandler):
+    def __init__(self):
+        super(BlockRangeScanner, self).__init__()
+        self.way_areas = []
+        self.relation_areas = []
+
+    def enabled_for(self):
+        # areas are placed after the scan from the collected rings; without
+        # this, apply_buffer would also run osmium's area builder per worker
+        return super(BlockRangeScanner, self).enabled_for() & (
+            osmium.osm.NODE | osmium.osm.WAY | osmium.osm.RELATION)
+
+    def way(self, w):
+        if len(w.nodes) < 4 or w.nodes[0].ref != w.nodes[-1].ref:
+            return
+        col_name = self.check_element_tags(w.tags)
+        if col_name:
+            self.way_areas.append((col_name, 'way', w.id, [[n.ref for n in w.nodes]]))
 
+    def relation(self, r):
+        if r.tags.get('type') not in ('multipolygon', 'boundary'):
+            return
+        col_name = self.check_element_tags(r.tags)
+        if col_name:
+            outer_ways = [m.ref for m in r.members if m.type == 'w' and m.role != 'inner']
+            if outer_ways:
+                self.relation_areas.append((col_name, 'relation', r.id, outer_ways))
 
-print(f"Step 1/5: Start scanning OSM file: {OSM_FILE_PATH}")
-print(f"looking for {len(TARGET_FEATURES)} types of features...")
 
-handler = FeatureLocationHandler()
-handler.apply_file(OSM_FILE_PATH, locations=True)
+class WayRefCollector(osmium.SimpleHandler):
+    def __init__(self, way_ids):
+        super(WayRefCollector, self).__init__()
+        self.way_ids = way_ids
+        self.refs = {}
 
-print(f"\n    ...scan complete. extract from OSM {len(handler.features_list)} features")
+    def way(self, w):
+        if w.id in self.way_ids:
+            self.refs[w.id] = [n.ref for n in w.nodes]
 
-if not handler.features_list:
-    print("Error: Check TARGET_FEATURES list again.")
-    sys.exit()
 
-print(f"Step 2/5: loading SA1 area's shape: {GPKG_PATH}")
-try:
-    sa1_shapes_gdf = gpd.read_file(
-        GPKG_PATH,
-        layer=GPKG_LAYER_NAME,
-        usecols=['SA1_CODE_2021', 'geometry']
+class NodeLocationCollector(osmium.SimpleHandler):
+    def __init__(self, node_ids):
+        super(NodeLocationCollector, self).__init__()
+        self.node_ids = node_ids
+        self.locations = {}
+
+    def node(self, n):
+        if n.id in self.node_ids and n.location.valid():
+            self.locations[n.id] = (n.location.lon, n.location.lat)
+
+
+def _scan_block_range(pbf_path, blobs, data_blobs):
+    scanner = BlockRangeScanner()
+    metrics = None
+    if osm_scan_metrics.SCAN_METRICS:
+        metrics = osm_scan_metrics.ScanMetrics('block_range')
+        metrics.instrument(scanner)
+        metrics.start()
+    scanner.apply_buffer(pbf_blocks.read_block_buffer(pbf_path, blobs, data_blobs), 'pbf',
+                         filters=[osmium.filter.KeyFilter(*BlockRangeScanner.FILTER_KEYS)])
+    if metrics is not None:
+        metrics.stop()
+        metrics.worker_peak_rss_mb = osm_scan_metrics.peak_rss_mb() or 0.0
+    return scanner.features, scanner.way_areas, scanner.relation_areas, metrics
+
+
+def _collect_way_refs(pbf_path, blobs, data_blobs, way_ids):
+    collector = WayRefCollector(way_ids)
+    collector.apply_buffer(pbf_blocks.read_block_buffer(pbf_path, blobs, data_blobs), 'pbf')
+    return collector.refs
+
+
+def _collect_node_locations(pbf_path, blobs, data_blobs, node_ids):
+    collector = NodeLocationCollector(node_ids)
+    collector.apply_buffer(pbf_blocks.read_block_buffer(pbf_path, blobs, data_blobs), 'pbf')
+    return collector.locations
+
+
+def parallel_feature_scan(osm_file_path, workers):
+    blobs = pbf_blocks.read_blob_index(osm_file_path)
+    ranges = pbf_blocks.split_block_ranges(blobs, workers)
+    print(f"    ...split {len(blobs)} PBF blocks into {len(ranges)} ranges for {workers} workers")
+
+    handler = FeatureLocationHandler()
+    metrics = osm_scan_metrics.ScanMetrics('parallel_feature_scan', osm_file_path)
+    metrics.settings = {'workers': workers, 'block_ranges': len(ranges)}
+    metrics.start()
+    phase_start = time.perf_counter()
+    way_areas = []
+    relation_areas = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        jobs = [pool.submit(_scan_block_range, osm_file_path, blobs, r) for r in ranges]
+        for job in jobs:
+            features, ways, relations, worker_metrics = job.result()
+            handler.features.extend(features)
+            way_areas.extend(ways)
+            relation_areas.extend(relations)
+            if worker_metrics is not None:
+                metrics.merge(worker_metrics)
+        # callback time is summed over the workers, phases are wall time here
+        metrics.add_phase('block_scan', time.perf_counter() - phase_start)
+        phase_start = time.perf_counter()
+
+        # multipolygon outlines: fetch the node lists of their outer ways
+        member_refs = {}
+        member_way_ids = {way_id for _, _, _, way_ids in relation_areas for way_id in way_ids}
+        if member_way_ids:
+            jobs = [pool.submit(_collect_way_refs, osm_file_path, blobs, r, member_way_ids) for r in ranges]
+            for job in jobs:
+                member_refs.update(job.result())
+        metrics.add_phase('way_refs', time.perf_counter() - phase_start)
+        phase_start = time.perf_counter()
+
+        # every area becomes a list of rings (node id lists)
+        areas = list(way_areas)
+        for _, _, way_id, rings in way_areas:
+            handler.way_nodes.add(way_id, rings[0])
+        for col_name, osm_type, osm_id, way_ids in relation_areas:
+            rings = [member_refs[way_id] for way_id in way_ids if way_id in member_refs]
+            if rings:
+                areas.append((col_name, osm_type, osm_id, rings))
+
+        locations = {}
+        node_ids = {ref for _, _, _, rings in areas for refs in rings for ref in refs}
+        if node_ids:
+            jobs = [pool.submit(_collect_node_locations, osm_file_path, blobs, r, node_ids) for r in ranges]
+            for job in jobs:
+                locations.update(job.result())
+        metrics.add_phase('node_locations', time.perf_counter() - phase_start)
+        phase_start = time.perf_counter()
+
+    # same point the serial area() callback uses, for all areas at once
+    geometries = osm_area_points.polygons_from_rings(
+        [[[locations[ref] for ref in refs if ref in locations] for refs in rings] for _, _, _, rings in areas]
     )
-    sa1_shapes_gdf['SA1_CODE_2021'] = sa1_shapes_gdf['SA1_CODE_2021'].astype(str)
-except Exception as e:
-    print(f"Error: CANNOT LOAD GPKG file: {e}")
-    sys.exit()
-
-print("Step 3/5: converting OSM Features to GeoDataFrame...")
-features_df = pd.DataFrame(handler.features_list)
-features_gdf = gpd.GeoDataFrame(
-    features_df,
-    geometry=gpd.points_from_xy(features_df.lon, features_df.lat),
-    crs="EPSG:4326"
-)
-print(f"    ...Convert process have finished CRS = {features_gdf.crs}")
-
-# spatial connection
-print(f"Step 4/5: Synchronise the data point and start the Spetial conection process (sjoin)...")
-print(f"    ...project {len(features_gdf)} features to SA1's CRS ({sa1_shapes_gdf.crs})")
-
-features_gdf = features_gdf.to_crs(sa1_shapes_gdf.crs)
-
-# Apply the Spatial connection
-joined_gdf = gpd.sjoin(
-    features_gdf,
-    sa1_shapes_gdf,
-    how="inner",
-    predicate="within"
-)
-print(f"    ...Spatial connection has finished {len(joined_gdf)} Features are matching to SA1 AREA.")
-
-
-print("Step 5/5: Count based on SA1 area's Features counting...")
-
-if joined_gdf.empty:
-    print("Error: The result of spatial connection. your OSM points and GPKG areamay not overlayed")
-    sys.exit()
-
-counts = joined_gdf.groupby(['SA1_CODE_2021', 'feature_type']).size()
-
-features_count_df = counts.unstack(level='feature_type', fill_value=0)
-final_df = sa1_shapes_gdf[['SA1_CODE_2021']].merge(
-    features_count_df,
-    on='SA1_CODE_2021',
-    how='left'
-)
-
-final_df = final_df.fillna(0)
-
-count_columns = list(TARGET_FEATURES.keys())
-existing_count_columns = [col for col in count_columns if col in final_df.columns]
-final_df[existing_count_columns] = final_df[existing_count_columns].astype(int)
-
-final_df.to_csv(OUTPUT_CSV_PATH, index=False)
-
-end_time = time.time()
-print("\nSUCESSFUL !!!!!")
-print(f"New feature file has been save to: {OUTPUT_CSV_PATH}")
-print(f"Total  cost: {end_time - start_time:.2f} second")
-print("\nHead review")
-print(final_df.head())
\ No newline at end of file
+    lons, lats = osm_area_points.area_points(geometries)
+    handler.add_area_points(
+        [(FEATURE_CODES[col_name], OSM_TYPE_CODES[osm_type], osm_id)
+         for (col_name, osm_type, osm_id, _), ok in zip(areas, ~np.isnan(lons)) if ok],
+        lons[~np.isnan(lons)], lats[~np.isnan(lats)]
+    )
+    metrics.add_phase('area_points', time.perf_counter() - phase_start)
+    metrics.stop()
+    if osm_scan_metrics.SCAN_METRICS:
+        metrics.write_report()
+
+    return handler
+
+
+def state_paths(state=state_shards.DEFAULT_STATE):
+    """(SA1 GeoPackage, layer, counts csv, feature points csv) of one state.
+
+    The SA1 layer outlines the state for the scan; the counts and points are
+    those of the geography level.
+    """
+    return (state_shards.census_gpkg_path('G01', state),
+            state_shards.sa1_layer_name('G01', state),
+            state_shards.shard_path(state, state_shards.level_filename('osm_features.csv')),
+            state_shards.shard_path(state, state_shards.level_filename('osm_feature_points.csv')))
+
+
+def load_sa1_lookup(gpkg_path=None, layer_name=None):
+    """Point -> SA1 code lookup of the layer (strip index cached on disk, opened with mmap)."""
+    return sa1_lookup.SA1Lookup(gpkg_path or GPKG_PATH, layer_name or GPKG_LAYER_NAME)
+
+
+def load_region_lookup(state=None, gpkg_path=None, layer_name=None):
+    """Lookup of the geography level: the SA1s of the layer, or the state's Mesh Blocks."""
+    if state_shards.check_level() == 'SA1':
+        return load_sa1_lookup(gpkg_path, layer_name)
+    return sa1_lookup.region_lookup(state or state_shards.DEFAULT_STATE)
+
+
+def point_columns(code_column=state_shards.SA1_CODE_COLUMN):
+    return FEATURE_POINT_COLUMNS[:-1] + [code_column]
+
+
+def locate_points_in_sa1(points_df, lookup):
+    """Rows of points_df (lon/lat columns, EPSG:4326) lying in a region of the
+    lookup, with its code (SA1_CODE_2021, or the lookup's code column).
+
+    Same rows, in the same order, as gpd.sjoin(..., how="inner", predicate="within").
+    """
+    codes = lookup.lookup(points_df['longitude'].to_numpy(), points_df['latitude'].to_numpy())
+    hit = pd.notna(codes)
+    located_df = points_df[hit].copy()
+    located_df[lookup.code_column] = codes[hit]
+    return located_df
+
+
+def count_features_by_sa1(points_df, sa1_codes, code_column=state_shards.SA1_CODE_COLUMN):
+    """Wide table of feature counts for the given region codes (rows with no feature get 0)."""
+    counts = points_df.groupby([code_column, 'feature_type'], observed=True).size()
+
+    features_count_df = counts.unstack(level='feature_type', fill_value=0)
+    # plain, alphabetical column names as before the categorical feature_type
+    features_count_df.columns = features_count_df.columns.astype(str)
+    features_count_df = features_count_df.sort_index(axis=1)
+    final_df = pd.DataFrame({code_column: sa1_codes}).merge(
+        features_count_df,
+        on=code_column,
+        how='left'
+    )
+
+    final_df = final_df.fillna(0)
+
+    count_columns = list(TARGET_FEATURES.keys())
+    existing_count_columns = [col for col in count_columns if col in final_df.columns]
+    final_df[existing_count_columns] = final_df[existing_count_columns].astype(int)
+    return final_df
+
+
+def count_schema(counts_df):
+    return {col: table_store.COUNT_DTYPE for col in counts_df.columns if col not in table_store.CODE_COLUMNS}
+
+
+def write_feature_counts(handler, output_csv_path=OUTPUT_CSV_PATH, points_csv_path=FEATURE_POINTS_CSV_PATH,
+                         gpkg_path=None, layer_name=None, state=None):
+    print(f"\n    ...scan complete. extract from OSM {len(handler.features)} features")
+
+    if not len(handler.features):
+        print("Error: Check TARGET_FEATURES list again.")
+        sys.exit()
+
+    print(f"Step 2/5: loading {state_shards.check_level()} lookup index")
+    lookup = load_region_lookup(state, gpkg_path, layer_name)
+    print(f"    ...{lookup.gpkg_path} (Layer: {lookup.layer_name})")
+
+    print("Step 3/5: converting OSM Features to a table...")
+    codes, lons, lats = handler.features.to_numpy()
+    osm_types, osm_ids = handler.features.ids_to_numpy()
+    features_df = pd.DataFrame({
+        'osm_element_type': pd.Categorical.from_codes(osm_types, categories=OSM_TYPES),
+        'osm_element_id': osm_ids,
+        'feature_type': pd.Categorical.from_codes(codes, categories=FEATURE_TYPES),
+        'longitude': lons,
+        'latitude': lats,
+    })
+
+    # spatial connection
+    print(f"Step 4/5: Synchronise the data point and start the Spetial conection process (SA1 lookup)...")
+    print(f"    ...locating {len(features_df)} features in {len(lookup.codes)} regions ({lookup.strips.crs})")
+
+    # Apply the Spatial connection
+    joined_gdf = locate_points_in_sa1(features_df, lookup)
+    print(f"    ...Spatial connection has finished {len(joined_gdf)} Features are matching to {lookup.code_column} AREA.")
+
+
+    print("Step 5/5: Count based on SA1 area's Features counting...")
+
+    if joined_gdf.empty:
+        print("Error: The result of spatial connection. your OSM points and GPKG areamay not overlayed")
+        sys.exit()
+
+    final_df = count_features_by_sa1(joined_gdf, lookup.codes, lookup.code_column)
+
+    table_store.write_table(final_df, output_csv_path, count_schema(final_df))
+    table_store.write_table(joined_gdf[point_columns(lookup.code_column)], points_csv_path)
+    table_store.write_table(handler.way_nodes.to_frame(), osm_area_points.way_nodes_path(points_csv_path))
+    return final_df
+
+
+def main(state=state_shards.DEFAULT_STATE):
+    print(f"--- Starting OSM Feature Counter Script ({state}) ---")
+    start_time = time.time()
+    gpkg_path, layer_name, output_csv_path, points_csv_path = state_paths(state)
+
+    print(f"Step 1/5: Start scanning OSM file: {OSM_FILE_PATH}")
+    print(f"looking for {len(TARGET_FEATURES)} types of features...")
+
+    osm_file_path = osm_region_extract.resolve_scan_input(OSM_FILE_PATH, gpkg_path, layer_name)
+
+    if SCAN_WORKERS > 1:
+        handler = parallel_feature_scan(osm_file_path, SCAN_WORKERS)
+    else:
+        handler = FeatureLocationHandler()
+        osm_apply.apply_handlers(osm_file_path, [handler])
+
+    final_df = write_feature_counts(handler, output_csv_path, points_csv_path, gpkg_path, layer_name, state)
+
+    end_time = time.time()
+    print("\nSUCESSFUL !!!!!")
+    print(f"New feature file has been save to: {table_store.table_path(output_csv_path)}")
+    print(f"Total  cost: {end_time - start_time:.2f} second")
+    print("\nHead review")
+    print(final_df.head())
+
+
+if __name__ == "__main__":
+    main(state_shards.check_state(sys.argv[1]) if len(sys.argv) > 1 else state_shards.DEFAULT_STATE)
@@ -0,0 +1,100 @@
+import os
+import random
+import struct
+
+# An .osm.pbf file is a sequence of blobs: [4-byte length][BlobHeader][Blob].
+# The first blob is the OSMHeader, every other one is an independent OSMData
+# block, so any subset of data blobs behind the header is itself a valid PBF.
+
+
+def _read_varint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7F) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _parse_blob_header(buf):
+    blob_type = None
+    datasize = 0
+    pos = 0
+    while pos < len(buf):
+        key, pos = _read_varint(buf, pos)
+        field, wire_type = key >> 3, key & 0x07
+        if wire_type == 2:
+            length, pos = _read_varint(buf, pos)
+            if field == 1:
+                blob_type = buf[pos:pos + length].decode('utf-8')
+            pos += length
+        elif wire_type == 0:
+            value, pos = _read_varint(buf, pos)
+            if field == 3:
+                datasize = value
+        else:
+            raise ValueError(f"Unexpected wire type {wire_type} in BlobHeader")
+    return blob_type, datasize
+
+
+def read_blob_index(pbf_path):
+    """Return (offset, length, type) for every blob without decoding any data."""
+    blobs = []
+    file_size = os.path.getsize(pbf_path)
+    with open(pbf_path, 'rb') as f:
+        offset = 0
+        while offset < file_size:
+            f.seek(offset)
+            header_len = struct.unpack('>I', f.read(4))[0]
+            blob_type, datasize = _parse_blob_header(f.read(header_len))
+            length = 4 + header_len + datasize
+            blobs.append((offset, length, blob_type))
+            offset += length
+    return blobs
+
+
+def split_block_ranges(blobs, n_ranges):
+    """Split the OSMData blobs into n contiguous ranges of roughly equal bytes."""
+    data_blobs = [b for b in blobs if b[2] == 'OSMData']
+    if not data_blobs:
+        return []
+    n_ranges = max(1, min(n_ranges, len(data_blobs)))
+    target = sum(b[1] for b in data_blobs) / n_ranges
+
+    ranges = []
+    current = []
+    current_bytes = 0
+    for blob in data_blobs:
+        current.append(blob)
+        current_bytes += blob[1]
+        if current_bytes >= target and len(ranges) < n_ranges - 1:
+            ranges.append(current)
+            current = []
+            current_bytes = 0
+    if current:
+        ranges.append(current)
+    return ranges
+
+
+def read_block_buffer(pbf_path, blobs, data_blobs):
+    """Read the header blob plus the given data blobs into one PBF byte string."""
+    header_blobs = [b for b in blobs if b[2] == 'OSMHeader']
+    parts = []
+    with open(pbf_path, 'rb') as f:
+        for offset, length, _ in header_blobs[:1] + list(data_blobs):
+            f.seek(offset)
+            parts.append(f.read(length))
+    return b''.join(parts)
+
+
+def sample_data_blobs(blobs, fraction, seed=None):
+    """A random subset of the OSMData blobs (at least one), kept in file order."""
+    data_blobs = [b for b in blobs if b[2] == 'OSMData']
+    if not data_blobs:
+        return []
+    n_sample = min(len(data_blobs), max(1, round(len(data_blobs) * fraction)))
+    picked = sorted(random.Random(seed).sample(range(len(data_blobs)), n_sample))
+    return [data_blobs[i] for i in picked]
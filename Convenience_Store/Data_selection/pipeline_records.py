@@ -0,0 +1,62 @@
+import json
+import os
+
+import cache_utils
+import state_shards
+
+# The record run_pipeline.py keeps of its last successful stage runs. It lives
+# here so scripts that rewrite pipeline outputs in place
+# (osm_incremental_update.py) can keep it current without importing the runner.
+
+# stage name -> fingerprint and output digests of its last successful run
+PIPELINE_STATE_PATH = os.path.join(state_shards.CONVEN_DIR, 'pipeline_state.json')
+# file digests are memoised here by size and mtime (see cache_utils.file_digest)
+DIGEST_CACHE_DIR = os.path.join(state_shards.CONVEN_DIR, 'pipeline_cache')
+
+
+def load_pipeline_state():
+    try:
+        with open(PIPELINE_STATE_PATH, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def save_pipeline_state(pipeline_state):
+    os.makedirs(os.path.dirname(PIPELINE_STATE_PATH), exist_ok=True)
+    tmp_path = PIPELINE_STATE_PATH + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(pipeline_state, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, PIPELINE_STATE_PATH)
+
+
+def file_digest(path):
+    return cache_utils.file_digest(path, DIGEST_CACHE_DIR)
+
+
+def file_digests(paths):
+    if not all(os.path.exists(path) for path in paths):
+        return None
+    return {path: file_digest(path) for path in paths}
+
+
+def stages_with_outputs(paths):
+    """Names of the stages that wrote any of paths in their last run and are
+    still up to date with it (their outputs unchanged since)."""
+    paths = {os.path.abspath(path) for path in paths}
+    return [name for name, record in load_pipeline_state().items()
+            if any(os.path.abspath(path) in paths for path in record.get('outputs', {}))
+            and file_digests(record['outputs']) == record['outputs']]
+
+
+def record_rewritten_outputs(stage_names):
+    """Record the current outputs of stages whose outputs were rewritten in
+    place outside the pipeline (osm_incremental_update.py), so the next run
+    keeps them instead of redoing the stage from its old inputs. The stages
+    below them see the new content and rerun."""
+    pipeline_state = load_pipeline_state()
+    for name in stage_names:
+        outputs = file_digests(pipeline_state[name]['outputs'])
+        if outputs is not None:
+            pipeline_state[name]['outputs'] = outputs
+    save_pipeline_state(pipeline_state)
@@ -0,0 +1,90 @@
+import geopandas as gpd
+import numpy as np
+import os
+import sys
+import time
+
+import cache_utils
+import state_shards
+
+BASE_DATA_PATH = state_shards.BASE_DATA_PATH
+SA1_GPKG_PATH = os.path.join(BASE_DATA_PATH, "Geopackage_2021_G01_NSW_GDA2020/G01_NSW_GDA2020.gpkg")
+SA1_LAYER_NAME = "G01_SA1_2021_NSW"
+CACHE_DIR = os.path.join(BASE_DATA_PATH, 'geometry_cache')
+
+SA1_CODE_COLUMN = 'SA1_CODE_2021'
+# bump when the cached table layout changes
+CACHE_VERSION = 2
+# rows are stored in Hilbert-curve order in row groups of this size, so a bbox
+# read only opens the row groups near the bbox
+ROW_GROUP_SIZE = 2048
+
+
+def cache_path_for(gpkg_path, layer_name, crs=None, cache_dir=None, code_column=SA1_CODE_COLUMN, where=None):
+    cache_dir = cache_dir or CACHE_DIR
+    digest = cache_utils.file_digest(gpkg_path, cache_dir)
+    parts = [digest, layer_name, crs or 'native', CACHE_VERSION]
+    if code_column != SA1_CODE_COLUMN or where:
+        # other regions than the SA1s of a layer, e.g. one state's Mesh Blocks
+        parts += [code_column, where]
+    key = cache_utils.cache_key(*parts)
+    return os.path.join(cache_dir, f"{layer_name}_{key}.parquet")
+
+
+def _build_cache(gpkg_path, layer_name, crs, output_path, code_column=SA1_CODE_COLUMN, where=None):
+    print(f"    ...building {code_column} geometry cache from {gpkg_path} (Layer: {layer_name}"
+          + (f", {where})" if where else ")"))
+    start_time = time.time()
+    shapes = gpd.read_file(gpkg_path, layer=layer_name, columns=[code_column], where=where, engine="pyogrio")
+    shapes[code_column] = shapes[code_column].astype(str)
+    if crs is not None:
+        shapes = shapes.to_crs(crs)
+
+    # layer order is kept in layer_row so loads return the layer order
+    shapes['layer_row'] = range(len(shapes))
+    # regions without geometry (e.g. the "no usual address" SA1s) are kept, so
+    # every code of the layer gets a row; they sort last and point joins skip them
+    has_shape = (shapes.geometry.notna() & ~shapes.geometry.is_empty).to_numpy()
+    hilbert = np.full(len(shapes), np.iinfo(np.int64).max, dtype=np.int64)
+    if has_shape.any():
+        hilbert[has_shape] = shapes.geometry[has_shape].hilbert_distance()
+    shapes = shapes.iloc[np.argsort(hilbert, kind='stable')]
+
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    tmp_path = output_path + '.tmp'
+    # GeoParquet with WKB geometry plus a bbox column per row (the GeoParquet
+    # "covering"), whose row-group statistics let readers skip far-away rows
+    shapes.to_parquet(tmp_path, index=False, write_covering_bbox=True, row_group_size=ROW_GROUP_SIZE)
+    os.replace(tmp_path, output_path)
+    print(f"    ...cached {len(shapes)} shapes to {output_path} ({time.time() - start_time:.1f} seconds)")
+
+
+def load_sa1_shapes(gpkg_path=SA1_GPKG_PATH, layer_name=SA1_LAYER_NAME, crs=None,
+                    bbox=None, cache_dir=None, code_column=SA1_CODE_COLUMN, where=None):
+    """SA1 code + polygon for every SA1 in the layer, read from the GeoParquet cache.
+
+    SA1s without geometry in the layer are included with a missing polygon.
+
+    The cache is keyed by the GeoPackage's content hash, the layer and the
+    target CRS, so a reprojected copy (crs="EPSG:4326") is cached on its own
+    and never reprojected again. bbox=(minx, miny, maxx, maxy) in that CRS
+    reads only the shapes whose bounding box intersects it.
+    code_column and where (an SQL filter on the layer) select other regions,
+    e.g. the Mesh Blocks of one state from the national layer.
+    The spatial index is ready to use: gdf.sindex is built on first access.
+    """
+    if not os.path.exists(gpkg_path):
+        print(f"Error: SA1 GeoPackage not found at {gpkg_path}")
+        sys.exit()
+
+    cache_path = cache_path_for(gpkg_path, layer_name, crs, cache_dir, code_column, where)
+    if not os.path.exists(cache_path):
+        _build_cache(gpkg_path, layer_name, crs, cache_path, code_column, where)
+
+    shapes = gpd.read_parquet(cache_path, columns=[code_column, 'geometry', 'layer_row'], bbox=bbox)
+    return shapes.sort_values('layer_row').drop(columns='layer_row').reset_index(drop=True)
+
+
+if __name__ == "__main__":
+    sa1_shapes = load_sa1_shapes()
+    print(f"{len(sa1_shapes)} SA1 shapes, CRS {sa1_shapes.crs}")
@@ -0,0 +1,131 @@
+import numpy as np
+import pyproj
+import shapely
+import os
+import sys
+
+import sa1_geometry_cache
+import sa1_point_join
+import state_shards
+
+# Batch point -> SA1 code lookup on the strip index saved by sa1_point_join.
+# The index and the SA1 codes are opened with mmap, so a lookup process pays
+# for the pages it touches instead of reading the GeoPackage; the exact
+# polygons are only read if some point falls near a boundary.
+
+# lon/lat as they come from OSM and the store csvs
+INPUT_CRS = "EPSG:4326"
+# points per batch; bounds the temporary arrays for very large inputs
+LOOKUP_BATCH_SIZE = 1_000_000
+CODES_FILENAME = 'sa1_codes.npy'
+
+
+class SA1Lookup:
+    """lookup(lons, lats) -> SA1 code of every point, None outside every SA1.
+
+    Same answer as gpd.sjoin(points, sa1_shapes, predicate="within") for
+    points projected from input_crs to the layer's CRS. code_column and
+    where select other regions of a layer, e.g. one state's Mesh Blocks
+    (see region_lookup).
+    """
+
+    def __init__(self, gpkg_path=None, layer_name=None, input_crs=INPUT_CRS,
+                 code_column=state_shards.SA1_CODE_COLUMN, where=None):
+        self.gpkg_path = gpkg_path or state_shards.census_gpkg_path('G01')
+        self.layer_name = layer_name or state_shards.sa1_layer_name('G01')
+        self.code_column = code_column
+        self.where = where
+        self._geometries = None
+        if not os.path.exists(self.gpkg_path):
+            print(f"Error: SA1 GeoPackage not found at {self.gpkg_path}")
+            sys.exit()
+
+        strips_dir = sa1_point_join.strips_dir_for(self.gpkg_path, self.layer_name,
+                                                   code_column=code_column, where=where)
+        codes_path = os.path.join(strips_dir, CODES_FILENAME)
+        if not os.path.exists(codes_path):
+            shapes = self._load_shapes()
+            layer = sa1_point_join.load_prepared_layer(shapes, self.gpkg_path, self.layer_name, force=True,
+                                                       code_column=code_column, where=where)
+            self._geometries = layer.geometries
+            tmp_path = f"{codes_path}.{os.getpid()}.tmp.npy"
+            np.save(tmp_path, shapes[code_column].to_numpy().astype(str))
+            os.replace(tmp_path, codes_path)
+
+        self.strips = sa1_point_join.StripIndex.load(strips_dir)
+        self.codes = np.load(codes_path, mmap_mode='r')
+
+        self.transformer = None
+        if input_crs is not None and self.strips.crs is not None:
+            input_crs = pyproj.CRS.from_user_input(input_crs)
+            if input_crs != self.strips.crs:
+                self.transformer = pyproj.Transformer.from_crs(input_crs, self.strips.crs, always_xy=True)
+
+    def _load_shapes(self):
+        return sa1_geometry_cache.load_sa1_shapes(self.gpkg_path, self.layer_name,
+                                                  code_column=self.code_column, where=self.where)
+
+    def _exact_geometries(self):
+        if self._geometries is None:
+            shapes = self._load_shapes()
+            self._geometries = np.asarray(shapes.geometry.values, dtype=object)
+            shapely.prepare(self._geometries)
+        return self._geometries
+
+    def _positions_batch(self, lons, lats):
+        if self.transformer is not None:
+            xs, ys = self.transformer.transform(lons, lats)
+        else:
+            xs, ys = lons, lats
+        positions = np.full(len(xs), -1, dtype=np.int64)
+        finite = np.flatnonzero(np.isfinite(xs) & np.isfinite(ys))
+        xs, ys = xs[finite], ys[finite]
+
+        polys = self.strips.locate(xs, ys)
+        rest = np.flatnonzero(polys < 0)
+        if len(rest):
+            point_pos, poly_pos = sa1_point_join.locate_exact(self._exact_geometries(), xs[rest], ys[rest])
+            polys[rest[point_pos]] = poly_pos
+        positions[finite] = polys
+        return positions
+
+    def positions(self, lons, lats):
+        """Layer position of the SA1 holding each point, -1 when there is none."""
+        lons = np.asarray(lons, dtype=np.float64)
+        lats = np.asarray(lats, dtype=np.float64)
+        positions = np.empty(len(lons), dtype=np.int64)
+        for start in range(0, len(lons), LOOKUP_BATCH_SIZE):
+            stop = start + LOOKUP_BATCH_SIZE
+            positions[start:stop] = self._positions_batch(lons[start:stop], lats[start:stop])
+        return positions
+
+    def lookup(self, lons, lats):
+        """SA1 code of each point as an object array, None where the point is in no SA1."""
+        positions = self.positions(lons, lats)
+        codes = np.full(len(positions), None, dtype=object)
+        hit = positions >= 0
+        codes[hit] = self.codes[positions[hit]].tolist()
+        return codes
+
+
+def region_lookup(state=state_shards.DEFAULT_STATE, level=None, input_crs=INPUT_CRS):
+    """Lookup of the regions of one state at the geography level (state_shards.GEOGRAPHY_LEVEL)."""
+    gpkg_path, layer_name, code_column, where = state_shards.region_layer(state, level)
+    return SA1Lookup(gpkg_path, layer_name, input_crs, code_column, where)
+
+
+if __name__ == "__main__":
+    # SA1 (or Mesh Block, see state_shards.GEOGRAPHY_LEVEL) of candidate sites:
+    # python sa1_lookup.py [STATE] lon lat [lon lat ...]
+    args = sys.argv[1:]
+    state = state_shards.DEFAULT_STATE
+    if args and args[0].upper() in state_shards.STATES:
+        state = state_shards.check_state(args.pop(0).upper())
+    if not args or len(args) % 2:
+        print("Usage: python sa1_lookup.py [STATE] lon lat [lon lat ...]")
+        sys.exit()
+
+    sites = np.array(args, dtype=np.float64).reshape(-1, 2)
+    sa1_lookup = region_lookup(state)
+    for (lon, lat), code in zip(sites, sa1_lookup.lookup(sites[:, 0], sites[:, 1])):
+        print(f"{lon:.6f},{lat:.6f} -> {code or f'outside every {state_shards.check_level()}'}")
@@ -0,0 +1,289 @@
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+import pyproj
+import json
+import os
+import shutil
+import sys
+
+import sa1_geometry_cache
+import state_shards
+
+# Points-in-SA1 join that tests most points without touching the full
+# resolution polygons:
+#   1. every SA1 is simplified (topology preserving) and shrunk into a "core"
+#      lying more than a tolerance inside the real polygon
+#   2. the layer is cut into horizontal strips; in each strip the x-ranges
+#      crossed by no core boundary are stored with the SA1 they lie in. A
+#      point inside one of these ranges is inside that SA1: a NumPy
+#      searchsorted, no geometry involved
+#   3. the remaining points (near a boundary, or outside every SA1) are tested
+#      against the exact, prepared polygons
+# so the result is the same as gpd.sjoin(..., predicate="within"), as long as
+# the polygons do not overlap (SA1s tile the state).
+
+# False = plain gpd.sjoin
+USE_PREPARED_JOIN = True
+# metres; the core is shrunk by twice this, so every point it keeps is more
+# than a tolerance away from the real boundary
+SIMPLIFY_TOLERANCE_M = 5.0
+# metres; lower keeps more points on the fast path but stores more ranges
+STRIP_HEIGHT_M = 25.0
+METRES_PER_DEGREE = 111_320.0
+# bump when the stored strip index layout changes
+STRIPS_VERSION = 2
+STRIP_ARRAYS = ['range_keys', 'range_rows', 'range_ends', 'range_polys']
+
+
+def _core_edges(cores):
+    """(x0, y0, x1, y1) of every edge of every core ring."""
+    parts = shapely.get_parts(cores[~shapely.is_empty(cores)])
+    rings = shapely.get_rings(parts)
+    coords, ring_idx = shapely.get_coordinates(rings, return_index=True)
+    same_ring = ring_idx[:-1] == ring_idx[1:]
+    start, end = coords[:-1][same_ring], coords[1:][same_ring]
+    return start[:, 0], start[:, 1], end[:, 0], end[:, 1]
+
+
+class StripIndex:
+    """Per strip, the x-ranges lying inside one core, as flat sorted arrays.
+
+    Saved as one .npy per array plus meta.json, so it can be opened with
+    mmap and no geometry at all.
+    """
+
+    def __init__(self, origin, height, width, n_polygons, crs, range_keys, range_rows, range_ends, range_polys):
+        self.origin = tuple(origin)
+        self.height = height
+        # keys are row * width + x, so rows never overlap
+        self.width = width
+        self.n_polygons = n_polygons
+        self.crs = crs
+        self.range_keys = range_keys
+        self.range_rows = range_rows
+        self.range_ends = range_ends
+        self.range_polys = range_polys
+
+    @classmethod
+    def build(cls, geometries, crs, tolerance_m=SIMPLIFY_TOLERANCE_M, strip_height_m=STRIP_HEIGHT_M):
+        scale = 1.0
+        if crs is not None and crs.is_geographic:
+            scale = 1.0 / METRES_PER_DEGREE
+        tolerance = tolerance_m * scale
+        height = strip_height_m * scale
+
+        simplified = shapely.simplify(geometries, tolerance, preserve_topology=True)
+        cores = shapely.buffer(simplified, -2 * tolerance)
+        cores[shapely.is_missing(cores)] = shapely.Polygon()
+
+        x0, y0, x1, y1 = _core_edges(cores)
+        if not len(x0):
+            empty = np.empty(0)
+            return cls((0.0, 0.0), height, 1.0, len(geometries), crs,
+                       empty, empty.astype(np.int64), empty, empty.astype(np.int64))
+
+        min_x = min(x0.min(), x1.min())
+        min_y = min(y0.min(), y1.min())
+        width = max(x0.max(), x1.max()) - min_x + 1.0
+
+        # every edge cut into one piece per strip it crosses
+        lo_y, hi_y = np.minimum(y0, y1), np.maximum(y0, y1)
+        row_lo = np.floor((lo_y - min_y) / height).astype(np.int64)
+        row_hi = np.floor((hi_y - min_y) / height).astype(np.int64)
+        n_rows = row_hi - row_lo + 1
+        edge = np.repeat(np.arange(len(x0)), n_rows)
+        rows = row_lo[edge] + (np.arange(len(edge)) - np.repeat(np.cumsum(n_rows) - n_rows, n_rows))
+
+        strip_lo = min_y + rows * height
+        y_a = np.clip(strip_lo, lo_y[edge], hi_y[edge])
+        y_b = np.clip(strip_lo + height, lo_y[edge], hi_y[edge])
+        dy = y1[edge] - y0[edge]
+        flat = dy == 0
+        safe_dy = np.where(flat, 1.0, dy)
+        t_a = np.where(flat, 0.0, (y_a - y0[edge]) / safe_dy)
+        t_b = np.where(flat, 1.0, (y_b - y0[edge]) / safe_dy)
+        x_a = x0[edge] + t_a * (x1[edge] - x0[edge])
+        x_b = x0[edge] + t_b * (x1[edge] - x0[edge])
+        piece_start = np.minimum(x_a, x_b)
+        piece_end = np.maximum(x_a, x_b)
+
+        # the gaps between the merged pieces of a strip cross no boundary, so
+        # each one lies entirely inside one core or outside all of them
+        order = np.lexsort((piece_start, rows))
+        rows, piece_start, piece_end = rows[order], piece_start[order], piece_end[order]
+        covered_to = pd.Series(piece_end).groupby(rows).cummax().to_numpy()
+        same_row = rows[1:] == rows[:-1]
+        is_gap = same_row & (piece_start[1:] > covered_to[:-1])
+        gap_rows = rows[1:][is_gap]
+        gap_start = covered_to[:-1][is_gap]
+        gap_end = piece_start[1:][is_gap]
+
+        mid_points = shapely.points((gap_start + gap_end) / 2, min_y + (gap_rows + 0.5) * height)
+        core_pos, point_pos = shapely.STRtree(mid_points).query(cores, predicate='contains')
+        polys = np.full(len(gap_rows), -1, dtype=np.int64)
+        polys[point_pos] = core_pos
+        inside = polys >= 0
+
+        return cls((min_x, min_y), height, width, len(geometries), crs,
+                   gap_rows[inside] * width + (gap_start[inside] - min_x),
+                   gap_rows[inside], gap_end[inside], polys[inside])
+
+    def save(self, index_dir):
+        tmp_dir = f"{index_dir}.{os.getpid()}.tmp"
+        os.makedirs(tmp_dir, exist_ok=True)
+        for name in STRIP_ARRAYS:
+            np.save(os.path.join(tmp_dir, f"{name}.npy"), getattr(self, name))
+        meta = {'origin': list(self.origin), 'height': self.height, 'width': self.width,
+                'n_polygons': self.n_polygons, 'crs': self.crs.to_wkt() if self.crs is not None else None}
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump(meta, f, indent=2)
+        if os.path.exists(index_dir):
+            shutil.rmtree(index_dir)
+        os.replace(tmp_dir, index_dir)
+
+    @classmethod
+    def load(cls, index_dir, mmap_mode='r'):
+        """Open a saved index; with mmap the arrays are paged in as lookups touch them."""
+        with open(os.path.join(index_dir, 'meta.json'), 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        arrays = {name: np.load(os.path.join(index_dir, f"{name}.npy"), mmap_mode=mmap_mode)
+                  for name in STRIP_ARRAYS}
+        crs = pyproj.CRS.from_wkt(meta['crs']) if meta['crs'] else None
+        return cls(meta['origin'], meta['height'], meta['width'], meta['n_polygons'], crs, **arrays)
+
+    def locate(self, xs, ys):
+        """Polygon position of every point inside a stored range, -1 for the others."""
+        if not len(self.range_keys):
+            return np.full(len(xs), -1, dtype=np.int64)
+        rows = np.floor((ys - self.origin[1]) / self.height).astype(np.int64)
+        keys = rows * self.width + (xs - self.origin[0])
+        # sorted needles make searchsorted several times faster than random ones
+        order = np.argsort(keys)
+        idx = np.empty(len(keys), dtype=np.int64)
+        idx[order] = np.searchsorted(self.range_keys, keys[order], side='right') - 1
+        found = idx >= 0
+        idx = np.where(found, idx, 0)
+        found &= (self.range_rows[idx] == rows) & (xs < self.range_ends[idx])
+        return np.where(found, self.range_polys[idx], -1)
+
+
+def locate_exact(geometries, xs, ys):
+    """(point positions, polygon positions) of the points within the prepared geometries.
+
+    Like sjoin, the points go in the tree and each polygon queries it.
+    """
+    poly_pos, point_pos = shapely.STRtree(shapely.points(xs, ys)).query(geometries, predicate='contains')
+    return point_pos, poly_pos
+
+
+class PreparedSA1Layer:
+    """Prepared exact polygons plus the strip index of their simplified cores, built once per layer."""
+
+    def __init__(self, sa1_shapes_gdf, strips=None):
+        self.crs = sa1_shapes_gdf.crs
+        self.geometries = np.asarray(sa1_shapes_gdf.geometry.values, dtype=object)
+        shapely.prepare(self.geometries)
+        if strips is None:
+            strips = StripIndex.build(self.geometries, self.crs)
+        elif strips.n_polygons != len(self.geometries):
+            raise ValueError(f"Strip index was built for {strips.n_polygons} polygons, "
+                             f"the layer has {len(self.geometries)}")
+        self.strips = strips
+
+    def locate(self, xs, ys):
+        """(point positions, polygon positions) of every point within a polygon, sorted."""
+        xs = np.asarray(xs, dtype=np.float64)
+        ys = np.asarray(ys, dtype=np.float64)
+
+        # 1. interior fast path
+        polys = self.strips.locate(xs, ys)
+        fast = polys >= 0
+        fast_points = np.flatnonzero(fast)
+
+        # 2. exact test for everything else
+        rest_idx = np.flatnonzero(~fast)
+        point_pos, poly_pos = locate_exact(self.geometries, xs[rest_idx], ys[rest_idx])
+        point_pos = rest_idx[point_pos]
+
+        if len(np.unique(point_pos)) == len(point_pos):
+            # one polygon per point (SA1s do not overlap): no sort needed
+            polys[point_pos] = poly_pos
+            point_pos = np.flatnonzero(polys >= 0)
+            return point_pos, polys[point_pos]
+        point_pos = np.concatenate([fast_points, point_pos])
+        poly_pos = np.concatenate([polys[fast], poly_pos])
+        order = np.lexsort((poly_pos, point_pos))
+        return point_pos[order], poly_pos[order]
+
+
+def strips_dir_for(gpkg_path, layer_name, crs=None, code_column=sa1_geometry_cache.SA1_CODE_COLUMN, where=None):
+    """Where the strip index of a cached SA1 layer lives: next to its GeoParquet, same key."""
+    cache_path = sa1_geometry_cache.cache_path_for(gpkg_path, layer_name, crs, code_column=code_column, where=where)
+    return cache_path.replace('.parquet', f"_strips_v{STRIPS_VERSION}_"
+                                          f"{SIMPLIFY_TOLERANCE_M:g}m_{STRIP_HEIGHT_M:g}m")
+
+
+def load_prepared_layer(sa1_shapes_gdf, gpkg_path, layer_name, crs=None, force=False,
+                        code_column=sa1_geometry_cache.SA1_CODE_COLUMN, where=None):
+    """PreparedSA1Layer of shapes read by sa1_geometry_cache.load_sa1_shapes.
+
+    The strip index is the slow part to build, so it is saved on first use
+    and opened with mmap afterwards. None when USE_PREPARED_JOIN is off,
+    unless force is set.
+    """
+    if not USE_PREPARED_JOIN and not force:
+        return None
+    strips_dir = strips_dir_for(gpkg_path, layer_name, crs, code_column, where)
+    if os.path.exists(strips_dir):
+        return PreparedSA1Layer(sa1_shapes_gdf, StripIndex.load(strips_dir))
+    print(f"    ...building point-in-SA1 strip index: {strips_dir}")
+    layer = PreparedSA1Layer(sa1_shapes_gdf)
+    layer.strips.save(strips_dir)
+    return layer
+
+
+def join_points_within(points_gdf, sa1_gdf, layer=None):
+    """Same rows and columns as gpd.sjoin(points_gdf, sa1_gdf, how="inner", predicate="within").
+
+    Pass a PreparedSA1Layer of sa1_gdf as layer to reuse it across calls.
+    """
+    if not USE_PREPARED_JOIN:
+        return gpd.sjoin(points_gdf, sa1_gdf, how="inner", predicate="within")
+
+    if sa1_gdf.crs is not None and points_gdf.crs != sa1_gdf.crs:
+        points_gdf = points_gdf.to_crs(sa1_gdf.crs)
+    layer = layer or PreparedSA1Layer(sa1_gdf)
+
+    point_geoms = points_gdf.geometry.values
+    valid_idx = np.flatnonzero(~(point_geoms.isna() | point_geoms.is_empty))
+    xs = point_geoms[valid_idx].x
+    ys = point_geoms[valid_idx].y
+    finite = np.isfinite(xs) & np.isfinite(ys)
+    valid_idx, xs, ys = valid_idx[finite], xs[finite], ys[finite]
+    point_pos, poly_pos = layer.locate(xs, ys)
+    point_pos = valid_idx[point_pos]
+
+    left = points_gdf.iloc[point_pos]
+    right = pd.DataFrame(sa1_gdf.drop(columns=sa1_gdf.geometry.name)).iloc[poly_pos]
+    # clashing names get sjoin's suffixes
+    clashes = (set(left.columns) - {points_gdf.geometry.name}) & set(right.columns)
+    left = left.rename(columns={col: f"{col}_left" for col in clashes})
+    right = right.rename(columns={col: f"{col}_right" for col in clashes})
+
+    joined = left.copy()
+    joined['index_right'] = sa1_gdf.index.values[poly_pos]
+    for col in right.columns:
+        joined[col] = right[col].values
+    return joined
+
+
+if __name__ == "__main__":
+    # precompute the strip index of a state's SA1 layer: python sa1_point_join.py [STATE]
+    state = state_shards.check_state(sys.argv[1]) if len(sys.argv) > 1 else state_shards.DEFAULT_STATE
+    gpkg_path = state_shards.census_gpkg_path('G01', state)
+    layer_name = state_shards.sa1_layer_name('G01', state)
+    layer = load_prepared_layer(sa1_geometry_cache.load_sa1_shapes(gpkg_path, layer_name), gpkg_path, layer_name,
+                                force=True)
+    print(f"{len(layer.strips.range_keys)} interior ranges over {len(layer.geometries)} SA1 shapes")
@@ -0,0 +1,102 @@
+import os
+
+# Every stage (census extraction, OSM counting, merge, final build) runs per
+# state and writes into that state's shard directory. The national dataset is
+# the concatenation of the shards, so one state can be rebuilt on its own.
+
+# the repository root, two levels above this file
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+BASE_DATA_PATH = os.path.join(PROJECT_ROOT, 'data')
+CONVEN_DIR = os.path.join(PROJECT_ROOT, 'Convenience_Store', 'Data_for_Conven')
+SHARDS_DIR = os.path.join(CONVEN_DIR, 'states')
+
+# ABS state/territory abbreviations; the first digit of an SA1 code is the
+# state code in this order (1 = NSW ... 8 = ACT)
+STATES = ['NSW', 'VIC', 'QLD', 'SA', 'WA', 'TAS', 'NT', 'ACT']
+DEFAULT_STATE = 'NSW'
+
+# Regions of the OSM counts, master table and datasets:
+#   'SA1' - census SA1s, the G01 DataPack layer of each state
+#   'MB'  - ABS Mesh Blocks, 10-20x more and smaller regions, from the national
+#           ASGS 2021 Mesh Block layer. Census tables stop at SA1, so a Mesh
+#           Block gets its SA1's counts in proportion to its share of the area
+# Files of the MB level get an _MB suffix, next to the SA1 files.
+GEOGRAPHY_LEVEL = 'SA1'
+GEOGRAPHY_LEVELS = ['SA1', 'MB']
+SA1_CODE_COLUMN = 'SA1_CODE_2021'
+MB_CODE_COLUMN = 'MB_CODE_2021'
+MB_LAYER_NAME = 'MB_2021_AUST_GDA2020'
+# numeric state code of every Mesh Block, 1 = NSW ... as in STATES
+STATE_CODE_COLUMN = 'STE_CODE_2021'
+
+
+def check_state(state):
+    if state not in STATES:
+        raise ValueError(f"Unknown state '{state}'. Choose from {STATES}")
+    return state
+
+
+def check_level(level=None):
+    level = level or GEOGRAPHY_LEVEL
+    if level not in GEOGRAPHY_LEVELS:
+        raise ValueError(f"Unknown geography level '{level}'. Choose from {GEOGRAPHY_LEVELS}")
+    return level
+
+
+def census_gpkg_path(table, state=DEFAULT_STATE):
+    """The ABS DataPack GeoPackage of one census table, e.g. G01 for VIC."""
+    return os.path.join(BASE_DATA_PATH, f"Geopackage_2021_{table}_{state}_GDA2020",
+                        f"{table}_{state}_GDA2020.gpkg")
+
+
+def sa1_layer_name(table, state=DEFAULT_STATE):
+    return f"{table}_SA1_2021_{state}"
+
+
+def mb_gpkg_path():
+    """The ASGS 2021 main structure GeoPackage, which holds the Mesh Blocks of every state."""
+    return os.path.join(BASE_DATA_PATH, 'ASGS_2021_MAIN_STRUCTURE_GPKG_GDA2020',
+                        'ASGS_2021_Main_Structure_GDA2020.gpkg')
+
+
+def state_code(state):
+    return str(STATES.index(check_state(state)) + 1)
+
+
+def region_code_column(level=None):
+    return SA1_CODE_COLUMN if check_level(level) == 'SA1' else MB_CODE_COLUMN
+
+
+def region_layer(state=DEFAULT_STATE, level=None):
+    """(GeoPackage, layer, code column, SQL filter or None) of the regions of one state."""
+    if check_level(level) == 'SA1':
+        return census_gpkg_path('G01', state), sa1_layer_name('G01', state), SA1_CODE_COLUMN, None
+    return mb_gpkg_path(), MB_LAYER_NAME, MB_CODE_COLUMN, f"{STATE_CODE_COLUMN} = '{state_code(state)}'"
+
+
+def level_filename(filename, level=None):
+    """filename for the geography level: unchanged for SA1, name_MB.ext for Mesh Blocks."""
+    level = check_level(level)
+    if level == 'SA1':
+        return filename
+    stem, ext = os.path.splitext(filename)
+    return f"{stem}_{level}{ext}"
+
+
+def shard_dir(state=DEFAULT_STATE):
+    return os.path.join(SHARDS_DIR, check_state(state))
+
+
+def shard_path(state, filename):
+    return os.path.join(shard_dir(state), filename)
+
+
+def fill_state(value, state):
+    """Replace {state} in a config value (string, list or dict, recursively)."""
+    if isinstance(value, str):
+        return value.replace('{state}', state)
+    if isinstance(value, list):
+        return [fill_state(v, state) for v in value]
+    if isinstance(value, dict):
+        return {k: fill_state(v, state) for k, v in value.items()}
+    return value
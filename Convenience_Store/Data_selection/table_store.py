@@ -0,0 +1,155 @@
+import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import os
+
+# Storage of the tables handed from stage to stage (census extracts, OSM
+# counts, master, engineered and final datasets). Paths are written with
+# .csv in the scripts and config.json; table_path swaps in the extension of
+# STORAGE_FORMAT.
+#   'parquet' - typed columns, SA1 codes as int64: no text parsing or dtype
+#               guessing on load, and readers can load only the columns
+#               they use
+#   'csv'     - the old text files
+STORAGE_FORMAT = 'parquet'
+FORMAT_EXTENSIONS = {'parquet': '.parquet', 'csv': '.csv'}
+
+SA1_CODE_COLUMN = 'SA1_CODE_2021'
+# region codes stored as int64, SA1 and Mesh Block
+CODE_COLUMNS = [SA1_CODE_COLUMN, 'MB_CODE_2021']
+# census person/household counts
+CENSUS_COUNT_DTYPE = 'int32'
+# OSM features and stores per SA1
+COUNT_DTYPE = 'uint16'
+# quantile bin labels
+BIN_DTYPE = 'uint8'
+# rows per frame of read_table_chunks / write_table_chunks; what a stage that
+# streams a table holds in memory, whatever the size of the table
+CHUNK_ROWS = 100_000
+
+
+def table_path(path, storage_format=None):
+    """path with the extension of the storage format."""
+    storage_format = storage_format or STORAGE_FORMAT
+    return os.path.splitext(path)[0] + FORMAT_EXTENSIONS[storage_format]
+
+
+def existing_table_path(path):
+    """path in the storage format, or in the other format if only that one exists."""
+    preferred = table_path(path)
+    if os.path.exists(preferred):
+        return preferred
+    for storage_format in FORMAT_EXTENSIONS:
+        other = table_path(path, storage_format)
+        if os.path.exists(other):
+            return other
+    return preferred
+
+
+def census_schema(df):
+    """Integer census columns as CENSUS_COUNT_DTYPE; other columns keep their type."""
+    return {col: CENSUS_COUNT_DTYPE for col in df.columns
+            if col not in CODE_COLUMNS and pd.api.types.is_integer_dtype(df[col])}
+
+
+def _typed(df, schema):
+    dtypes = dict(schema or {})
+    for col in CODE_COLUMNS:
+        if col in df.columns:
+            dtypes[col] = np.int64
+    return df.astype({col: dtype for col, dtype in dtypes.items() if col in df.columns})
+
+
+def write_table(df, path, schema=None):
+    """Write df to path in the storage format; returns the path written.
+
+    schema maps columns to dtypes; region codes are always stored as int64.
+    """
+    path = table_path(path)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    if path.endswith('.csv'):
+        df.to_csv(path, index=False)
+        return path
+
+    tmp_path = path + '.tmp'
+    _typed(df, schema).to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, path)
+    return path
+
+
+def write_table_chunks(chunks, path, schema=None):
+    """Write frames with the same columns one after the other as one table.
+
+    Only one frame is in memory at a time; each becomes a Parquet row group.
+    Returns (path written, rows), or (None, 0) when there were no frames.
+    """
+    path = table_path(path)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = path + '.tmp'
+    rows = 0
+    started = False
+    writer = None
+    try:
+        for df in chunks:
+            if path.endswith('.csv'):
+                df.to_csv(tmp_path, index=False, mode='a' if started else 'w', header=not started)
+            else:
+                table = pa.Table.from_pandas(_typed(df, schema), preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(tmp_path, table.schema)
+                writer.write_table(table.cast(writer.schema))
+            started = True
+            rows += len(df)
+    finally:
+        if writer is not None:
+            writer.close()
+    if not started:
+        return None, 0
+    os.replace(tmp_path, path)
+    return path, rows
+
+
+def read_table(path, columns=None):
+    """Read a table written by write_table, only the given columns if any.
+
+    Falls back to the other format when only that file exists, so tables
+    written before a change of STORAGE_FORMAT still load. Raises
+    FileNotFoundError like pd.read_csv.
+    """
+    path = existing_table_path(path)
+    if path.endswith('.csv'):
+        return pd.read_csv(path, usecols=columns)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"No such table: {path}")
+    return pd.read_parquet(path, columns=columns)
+
+
+def read_training_table(path, exclude=CODE_COLUMNS):
+    """Read a final dataset for model training, without the exclude columns.
+
+    The region codes are identifiers, not features; from Parquet they are not
+    read at all. Falls back to the other format like read_table.
+    """
+    path = existing_table_path(path)
+    if path.endswith('.csv'):
+        return pd.read_csv(path, usecols=lambda col: col not in exclude)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"No such table: {path}")
+    columns = [col for col in pq.read_schema(path).names if col not in exclude]
+    return pd.read_parquet(path, columns=columns)
+
+
+def read_table_chunks(path, columns=None, chunk_rows=None):
+    """Iterator over the table in frames of up to chunk_rows rows, in file order.
+
+    Raises FileNotFoundError here, before the first frame, like read_table.
+    """
+    path = existing_table_path(path)
+    chunk_rows = chunk_rows or CHUNK_ROWS
+    if path.endswith('.csv'):
+        return pd.read_csv(path, usecols=columns, chunksize=chunk_rows)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"No such table: {path}")
+    parquet_file = pq.ParquetFile(path)
+    return (batch.to_pandas() for batch in parquet_file.iter_batches(batch_size=chunk_rows, columns=columns))
@@ -7,9 +7,14 @@ from imblearn.over_sampling import SMOTE
 from sklearn.model_selection import GridSearchCV
 from imblearn.pipeline import Pipeline
 import numpy as np
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Data_selection'))
+import table_store
 file_path = 'Data_for_Conven/FINAL_TRAINING_DATASET.csv'
 try:
-    df = pd.read_csv(file_path)
+    df = table_store.read_training_table(file_path)
 except FileNotFoundError:
     print(f"error: replace {file_path} to your correct file path")
     exit()
@@ -3,10 +3,15 @@ from sklearn.model_selection import train_test_split
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.metrics import classification_report, confusion_matrix
 import numpy as np
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Data_selection'))
+import table_store
 
 file_path = 'FINAL_TRAINING_DATASET.csv'
 try:
-    df = pd.read_csv(file_path)
+    df = table_store.read_training_table(file_path)
 except FileNotFoundError:
     print(f"error: replace {file_path} to your correct file path")
     exit()
@@ -1,209 +1,219 @@
 import pandas as pd
-import geopandas as gpd
 import os
+import sys
 import time
 import numpy as np
 
-print("Starting final training dataset creation...")
-start_time = time.time()
-
 CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
-BASE_PATH = os.path.join(CURRENT_DIR, '..', 'Data_for_Conven')
-DATA_DIR = os.path.join(CURRENT_DIR, '..', '..', 'data', 'Geopackage_2021_G01_NSW_GDA2020')
-
-ORIGINAL_GPKG_PATH = os.path.join(DATA_DIR, 'G01_NSW_GDA2020.gpkg')
-GPKG_LAYER_NAME = "G01_SA1_2021_NSW"
+sys.path.append(os.path.join(CURRENT_DIR, '..', 'Data_selection'))
 
-store_locations_csv = os.path.join(BASE_PATH, 'convenience_stores_locations.csv')
-features_csv = os.path.join(BASE_PATH, 'MASTER_Convenience_Store_Dataset.csv')
+import catchment_counts
+import feature_engine
+import quantile_binning
+import sa1_lookup
+import state_shards
+import table_store
 
-#final cleaned dataset
-FINAL_TRAINING_DATASET_PATH = os.path.join(BASE_PATH, 'FINAL_TRAINING_DATASET.csv')
+BASE_PATH = os.path.join(CURRENT_DIR, '..', 'Data_for_Conven')
 
-def apply_binning(df, cols_to_bin):
-    binned_df = df.copy()
-    for col in cols_to_bin:
-        if col in binned_df.columns:
-            try:
-                binned_df[col] = pd.qcut(binned_df[col], q=5, labels=False, duplicates='drop')
-            except ValueError:
-                pass
-    return binned_df
+# engineered (not yet binned) features + store_count of one state
+STATE_FEATURES_FILENAME = 'engineered_features.csv'
 
-#Group attributes to erase noise and improve models' performance
-def group_and_engineer_features(df):
-    print("  Grouping attributes and engineering new features...")
-    engineered_df = df[['SA1_CODE_2021']].copy()
+#final cleaned dataset, all states
+FINAL_TRAINING_DATASET_PATH = os.path.join(BASE_PATH, 'FINAL_TRAINING_DATASET.csv')
 
-    base_pop = df['Tot_P_P'].replace(0, 1)
-    base_area = df['AREA_ALBERS_SQKM'].replace(0, 0.01)
-    base_hh = df['Tot_Tot'].replace(0, 1)
+# Denominators of the features (see feature_engine.py): columns summed, '-'
+# subtracts, and the value used when the sum is 0
+FEATURE_BASES = {
+    'pop': (['Tot_P_P'], 1),
+    'area': (['AREA_ALBERS_SQKM'], 0.01),
+    'households': (['Tot_Tot'], 1),
     #Total working people
-    base_work_pop = (df['Tot_P'] - df['Did_not_go_to_work_P'] - df['Worked_home_P']).replace(0, 1)
+    'work_pop': (['Tot_P', '-Did_not_go_to_work_P', '-Worked_home_P'], 1),
+}
 
+# (feature, columns summed, base it is divided by or None)
+FEATURES = [
     #G01 population related attributes
-    #deisity
-    engineered_df['pop_density'] = df['Tot_P_P'] / base_area
-
+    ('pop_density', ['Tot_P_P'], 'area'),
     #main consumer groups
-    core_cosunmer = df['Age_25_34_yr_P'] + df['Age_35_44_yr_P'] + df['Age_45_54_yr_P']
-    engineered_df['core_consumer'] = core_cosunmer / base_pop
-
-    #Students
-    students = df['Age_psns_att_edu_inst_15_19_P'] + df['Age_psns_att_edu_inst_20_24_P']
-    engineered_df['students'] = students / base_pop
-
-    #highly_educated populations
-    highly_educated = df['High_yr_schl_comp_Yr_12_eq_P']
-    engineered_df['highly_educated'] = highly_educated / base_pop
+    ('core_consumer', ['Age_25_34_yr_P', 'Age_35_44_yr_P', 'Age_45_54_yr_P'], 'pop'),
+    ('students', ['Age_psns_att_edu_inst_15_19_P', 'Age_psns_att_edu_inst_20_24_P'], 'pop'),
+    ('highly_educated', ['High_yr_schl_comp_Yr_12_eq_P'], 'pop'),
 
     #G33 income related attributes
-    #high
-    high_income = df['HI_2000_2499_Tot']
-    engineered_df['high_income'] = high_income / base_hh
-    #mindum
-    mid_income = df['HI_1500_1749_Tot'] + df['HI_2000_2499_Tot']
-    engineered_df['mid_income'] = mid_income / base_hh
-    #low
-    low_income =  df['Negative_Nil_income_Tot']
-    engineered_df['low_income'] = low_income / base_hh
+    ('high_income', ['HI_2000_2499_Tot'], 'households'),
+    ('mid_income', ['HI_1500_1749_Tot', 'HI_2000_2499_Tot'], 'households'),
+    ('low_income', ['Negative_Nil_income_Tot'], 'households'),
 
     #G62 transportation attributes
-    #bus only
-    bus = df['One_method_Bus_P']
-    engineered_df['bus'] = bus / base_work_pop
-    # walk only
-    walk = df['One_method_Walked_only_P']
-    engineered_df['walk'] = walk / base_work_pop
-
-    #geographic data emerge
-    # competitor
-    competitor = df['competitor_supermarket_count']
-    engineered_df['competitor_density'] = competitor / base_area
-
-    # food (cafe + restaurant)
-    food = df['cafe_count'] + df['restaurant_count']
-    engineered_df['food_density'] = food / base_area
-
-    # finance (atm + bank)
-    finance = df['atm_count'] + df['bank_count']
-    engineered_df['finance_density'] = finance / base_area
-
-    # community (hospital + school + university)
-    community = df['hospital_count'] + df['school_count'] + df['university_count']
-    engineered_df['community_density'] = community / base_area
-
-    # other stores
-    stores = df['office_count']
-    engineered_df['other_store_density'] = stores / base_area
-
-    # traffic/misc
-    traffic = df['parking_count'] + df['post_office_count']
-    engineered_df['traffic_density'] = traffic / base_area
-
-    # Final cleanup
-    print("  Cleaning up inf and NaN values...")
-    engineered_df = engineered_df.replace([np.inf, -np.inf], 0)
-    engineered_df = engineered_df.fillna(0)
-
-    print(f"  Finished engineering features. New feature count: {len(engineered_df.columns)}")
-    return engineered_df
+    ('bus', ['One_method_Bus_P'], 'work_pop'),
+    ('walk', ['One_method_Walked_only_P'], 'work_pop'),
+
+    #geographic data, per square km
+    ('competitor_density', ['competitor_supermarket_count'], 'area'),
+    ('food_density', ['cafe_count', 'restaurant_count'], 'area'),
+    ('finance_density', ['atm_count', 'bank_count'], 'area'),
+    ('community_density', ['hospital_count', 'school_count', 'university_count'], 'area'),
+    ('other_store_density', ['office_count'], 'area'),
+    ('traffic_density', ['parking_count', 'post_office_count'], 'area'),
+]
+#features within walking radii of the centroid (catchment_counts.py), as counts
+FEATURES += [(col, [col], None) for col in catchment_counts.catchment_columns()]
 
+# remove the index 'shape' from dataset cause there is no need for training AI
+FINAL_COLUMNS = ['SA1_CODE_2021'] + [name for name, _, _ in FEATURES] + ['store_count']
 
-print(f"Loading store locations from {store_locations_csv}...")
-try:
-    stores_df = pd.read_csv(store_locations_csv)
-    #convert pandas dataframe to geodataframe
-    stores_gdf = gpd.GeoDataFrame(
-        stores_df,
-        geometry=gpd.points_from_xy(stores_df.longitude, stores_df.latitude),
-        crs="EPSG:4326"
-    )
-    print(f"Loaded {len(stores_gdf)} store locations.")
-except FileNotFoundError:
-    print(f"Error: Store locations file not found at {store_locations_csv}")
-    print(f"Current Directory: {CURRENT_DIR}") # Debug info
-    exit()
-
-print("Loading SA1 features and shapes...")
-try:
-    features_df = pd.read_csv(features_csv)
-    print(f"Loaded {len(features_df)} SA1 feature rows with {len(features_df.columns)} original features.")
-    features_df = group_and_engineer_features(features_df)
-
-    cols_to_bin = [col for col in features_df.columns if col != 'SA1_CODE_2021']
-    features_df = apply_binning(features_df, cols_to_bin)
-
-    print(f"Loading geometries from {ORIGINAL_GPKG_PATH}...")
-    sa1_shapes_gdf = gpd.read_file(
-        ORIGINAL_GPKG_PATH,
-        layer=GPKG_LAYER_NAME,
-        engine="fiona",
-        usecols=['SA1_CODE_2021', 'geometry']
-    )
 
-    print("Fixing data types for merge...")
-    features_df['SA1_CODE_2021'] = features_df['SA1_CODE_2021'].astype(str)
-    sa1_shapes_gdf['SA1_CODE_2021'] = sa1_shapes_gdf['SA1_CODE_2021'].astype(str)
+def final_columns(level=None):
+    """FINAL_COLUMNS keyed by the region code of the geography level."""
+    return [state_shards.region_code_column(level)] + FINAL_COLUMNS[1:]
 
-    sa1_main_gdf = sa1_shapes_gdf.merge(
-        features_df,
-        on='SA1_CODE_2021',
-        how='right'
-    )
-    sa1_main_gdf = gpd.GeoDataFrame(sa1_main_gdf, crs=sa1_shapes_gdf.crs)
-    print(f"Master SA1 GeoDataFrame created with shape: {sa1_main_gdf.shape}")
 
-    #make sure two geopanda's dataframe are same
-    print(f"Projecting stores CRS to match SA1 CRS ({sa1_main_gdf.crs})...")
-    stores_gdf = stores_gdf.to_crs(sa1_main_gdf.crs)
+def state_features_path(state, level=None):
+    return state_shards.shard_path(state, state_shards.level_filename(STATE_FEATURES_FILENAME, level))
 
-except FileNotFoundError:
-    print(f"Error: One of the master files not found. Check paths.")
-    exit()
-except Exception as e:
-    print(f"Error during shape/feature loading: {e}")
-    print("Check your GPKG path and layer name in the script.")
-    exit()
 
-# Spatial Join
-print("Performing spatial join... (This may take a moment)")
-joined_gdf = gpd.sjoin(stores_gdf, sa1_main_gdf, how="inner", predicate="within")
-print(f"Spatial join complete. Found {len(joined_gdf)} stores located within SA1 regions.")
+def final_dataset_path(level=None):
+    """FINAL_TRAINING_DATASET_PATH, with an _MB suffix at Mesh Block level."""
+    return state_shards.level_filename(FINAL_TRAINING_DATASET_PATH, level)
 
-print("Calculating target variable (Y) 'store_count'...")
-if joined_gdf.empty:
-    print("Warning: Spatial join resulted in 0 matches. No stores were found inside the provided SA1 regions.")
-    sa1_main_gdf['store_count'] = 0
-else:
-    store_counts_by_sa1 = joined_gdf.groupby('SA1_CODE_2021').size().reset_index(name='store_count')
 
-    print("Merging 'store_count' back into master table...")
-    final_gdf = sa1_main_gdf.merge(store_counts_by_sa1, on='SA1_CODE_2021', how='left')
+#Group attributes to erase noise and improve models' performance
+def group_and_engineer_features(df, key_column='SA1_CODE_2021', verbose=True):
+    if verbose:
+        print("  Grouping attributes and engineering new features...")
+    engine = feature_engine.FeatureEngine(FEATURES, FEATURE_BASES)
+    engineered_df = engine.transform(df, keep_columns=[key_column])
+    if verbose:
+        print(f"  Finished engineering features. New feature count: {len(engineered_df.columns)}")
+    return engineered_df
 
-    final_gdf['store_count'] = final_gdf['store_count'].fillna(0).astype(int)
 
-print("Saving final training dataset...")
+def build_state_features(state=state_shards.DEFAULT_STATE):
+    """Engineered features and store_count of one state, saved to its shard.
+
+    Binning is left to combine_states, so the quantiles are national. The
+    master is read, engineered and written one chunk of rows at a time
+    (table_store.CHUNK_ROWS), in its spatial order, so a Mesh Block master
+    never has to fit in memory.
+    """
+    start_time = time.time()
+    level = state_shards.check_level()
+    key_column = state_shards.region_code_column()
+    store_locations_csv = state_shards.shard_path(state, 'convenience_stores_locations.csv')
+    features_csv = state_shards.shard_path(state, state_shards.level_filename('MASTER_Convenience_Store_Dataset.csv'))
+    output_path = state_features_path(state)
+
+    print(f"Loading store locations from {store_locations_csv}...")
+    try:
+        stores_df = pd.read_csv(store_locations_csv)
+        print(f"Loaded {len(stores_df)} store locations.")
+    except FileNotFoundError:
+        print(f"Error: Store locations file not found at {store_locations_csv}")
+        return None
+
+    print(f"Opening {level} features and lookup index...")
+    try:
+        feature_chunks = table_store.read_table_chunks(features_csv)
+        print(f"Reading {table_store.existing_table_path(features_csv)} in chunks of {table_store.CHUNK_ROWS} rows.")
+
+        # point -> region code lookup on the cached strip index (built on first use)
+        lookup = sa1_lookup.region_lookup(state)
+        print(f"Loaded {level} lookup for {lookup.gpkg_path} (Layer: {lookup.layer_name})")
+
+    except FileNotFoundError:
+        print(f"Error: One of the master files not found. Check paths.")
+        return None
+    except Exception as e:
+        print(f"Error during shape/feature loading: {e}")
+        print("Check your GPKG path and layer name in the script.")
+        return None
+
+    # store counts go onto the region rows that have features
+    print(f"Locating stores in {level} regions...")
+    store_codes = lookup.lookup(stores_df['longitude'].to_numpy(), stores_df['latitude'].to_numpy())
+    store_codes = pd.Series(store_codes[pd.notna(store_codes)], name=key_column)
+    print(f"Spatial join complete. Found {len(store_codes)} stores located within {level} regions.")
+
+    print("Calculating target variable (Y) 'store_count'...")
+    if store_codes.empty:
+        print(f"Warning: Spatial join resulted in 0 matches. No stores were found inside the provided {level} regions.")
+    store_counts = store_codes.value_counts()
+    store_counts.index = store_counts.index.astype(np.int64)
+
+    def engineered_chunks():
+        for chunk in feature_chunks:
+            engineered_df = group_and_engineer_features(chunk, key_column, verbose=False)
+            engineered_df[key_column] = engineered_df[key_column].astype(np.int64)
+            engineered_df['store_count'] = store_counts.reindex(engineered_df[key_column].to_numpy(),
+                                                                fill_value=0).to_numpy()
+            yield engineered_df[final_columns()]
+
+    print("Grouping attributes, engineering features and merging 'store_count', chunk by chunk...")
+    try:
+        output_path, rows = table_store.write_table_chunks(engineered_chunks(), output_path,
+                                                           {'store_count': table_store.COUNT_DTYPE})
+    except Exception as e:
+        print(f"Error during feature engineering: {e}")
+        return None
+    if output_path is None:
+        print(f"Error: {features_csv} has no rows.")
+        return None
+    print(f"{state} features ({rows} {level} rows) saved to: {output_path} ({time.time() - start_time:.2f} seconds)")
+    return output_path
+
+
+def combine_states(states=None, output_path=None):
+    """Concatenate the state shards and bin every feature over all of them."""
+    start_time = time.time()
+    states = states or state_shards.STATES
+    output_path = output_path or final_dataset_path()
+    key_column = state_shards.region_code_column()
+    shard_paths = [table_store.existing_table_path(state_features_path(state)) for state in states]
+    shard_paths = [path for path in shard_paths if os.path.exists(path)]
+    if not shard_paths:
+        print(f"Error: no state features found in {state_shards.SHARDS_DIR}")
+        return None
+
+    print(f"Combining {len(shard_paths)} state(s)...")
+    final_df = pd.concat(
+        [table_store.read_table(path) for path in shard_paths],
+        ignore_index=True
+    )
 
-# remove the index 'shape' from dataset cause there is no need for training AI
-final_cols = [
-    'SA1_CODE_2021',
-    'pop_density', 'core_consumer', 'students', 'highly_educated',
-    'high_income', 'mid_income', 'low_income',
-    'bus', 'walk',
-    'competitor_density', 'food_density', 'finance_density',
-    'community_density', 'other_store_density', 'traffic_density',
-    'store_count'
-]
-final_df_to_save = pd.DataFrame(final_gdf[final_cols])
-
-final_df_to_save.to_csv(FINAL_TRAINING_DATASET_PATH, index=False)
-
-end_time = time.time()
-print("\nSUCCESS!")
-print(f"Final training dataset saved to: {FINAL_TRAINING_DATASET_PATH}")
-print(f"Total time taken: {end_time - start_time:.2f} seconds")
-print("\nData Head (Top 5 rows)")
-print(final_df_to_save.head())
-print("\n'store_count' here")
-print(final_df_to_save['store_count'].value_counts().sort_index().head(10))
\ No newline at end of file
+    # quintiles over every state; the edges are saved so new rows can be
+    # binned the same way (python quantile_binning.py)
+    cols_to_bin = [col for col in final_df.columns if col not in (key_column, 'store_count')]
+    binner = quantile_binning.QuantileBinner().fit(final_df, cols_to_bin)
+    edges_path = quantile_binning.bins_path(output_path)
+    binner.save(edges_path)
+    print(f"Bin edges saved to: {edges_path}")
+    final_df_to_save = binner.transform(final_df)[final_columns()]
+
+    print("Saving final training dataset...")
+    # bin labels as uint8; columns with NaN labels (e.g. a constant column) stay float
+    schema = {col: table_store.BIN_DTYPE for col in cols_to_bin
+              if pd.api.types.is_integer_dtype(final_df_to_save[col])}
+    schema['store_count'] = table_store.COUNT_DTYPE
+    output_path = table_store.write_table(final_df_to_save, output_path, schema)
+
+    end_time = time.time()
+    print("\nSUCCESS!")
+    print(f"Final training dataset saved to: {output_path}")
+    print(f"Total time taken: {end_time - start_time:.2f} seconds")
+    print("\nData Head (Top 5 rows)")
+    print(final_df_to_save.head())
+    print("\n'store_count' here")
+    print(final_df_to_save['store_count'].value_counts().sort_index().head(10))
+    return final_df_to_save
+
+
+if __name__ == "__main__":
+    # python Group_attributes_to_finalize_data.py [STATE]
+    # rebuilds one state's features, then the national dataset from every state built so far
+    print("Starting final training dataset creation...")
+    state = state_shards.check_state(sys.argv[1]) if len(sys.argv) > 1 else state_shards.DEFAULT_STATE
+    if build_state_features(state) is None:
+        sys.exit()
+    combine_states()
@@ -0,0 +1,18 @@
+import sys
+
+import run_pipeline
+
+# The national build is run_pipeline over every state: the states are built
+# side by side as its stage graph allows, stages already up to date are
+# skipped, and pipeline_state.json stays current for the next run.
+
+
+def main(requested_states=None, workers=run_pipeline.PIPELINE_WORKERS):
+    print("--- Building the national training dataset ---")
+    return run_pipeline.main(requested_states, workers)
+
+
+if __name__ == "__main__":
+    # python build_national_dataset.py [STATE ...]
+    # no states: every state with census data
+    main(sys.argv[1:])
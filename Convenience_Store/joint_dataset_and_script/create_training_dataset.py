@@ -1,17 +1,25 @@
 import pandas as pd
-import geopandas as gpd
 import os
+import sys
 import time
 
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(CURRENT_DIR, '..', 'Data_selection'))
+
+import sa1_lookup
+import state_shards
+import table_store
+
 print("Starting final training dataset creation...")
 start_time = time.time()
 
-BASE_PATH = "/Users/Zhuanz/Documents/ACADEMIC/fifth-semaster/Introduction-to-AI/final_project/Convenience_Store/Data_for_Conven"
-ORIGINAL_GPKG_PATH = "/Users/Zhuanz/Documents/ACADEMIC/fifth-semaster/Introduction-to-AI/final_project/data/Geopackage_2021_G01_NSW_GDA2020/G01_NSW_GDA2020.gpkg"
-GPKG_LAYER_NAME = "G01_SA1_2021_NSW"
+BASE_PATH = state_shards.CONVEN_DIR
+ORIGINAL_GPKG_PATH = state_shards.census_gpkg_path('G01', 'NSW')
+GPKG_LAYER_NAME = state_shards.sa1_layer_name('G01', 'NSW')
 
-store_locations_csv = os.path.join(BASE_PATH, 'convenience_stores_locations.csv')
-features_csv = os.path.join(BASE_PATH, 'MASTER_Convenience_Store_Dataset.csv')
+# NSW only; Group_attributes_to_finalize_data.py builds the national dataset
+store_locations_csv = state_shards.shard_path('NSW', 'convenience_stores_locations.csv')
+features_csv = state_shards.shard_path('NSW', 'MASTER_Convenience_Store_Dataset.csv')
 
 #final cleaned dataset
 FINAL_TRAINING_DATASET_PATH = os.path.join(BASE_PATH, 'FINAL_TRAINING_DATASET.csv')
@@ -19,46 +27,24 @@ FINAL_TRAINING_DATASET_PATH = os.path.join(BASE_PATH, 'FINAL_TRAINING_DATASET.cs
 print(f"Loading store locations from {store_locations_csv}...")
 try:
     stores_df = pd.read_csv(store_locations_csv)
-    #convert pandas dataframe to geodataframe
-    stores_gdf = gpd.GeoDataFrame(
-        stores_df,
-        geometry=gpd.points_from_xy(stores_df.longitude, stores_df.latitude),
-        crs="EPSG:4326"
-    )
-    print(f"Loaded {len(stores_gdf)} store locations.")
+    print(f"Loaded {len(stores_df)} store locations.")
 except FileNotFoundError:
     print(f"Error: Store locations file not found at {store_locations_csv}")
     exit()
 
-print("Loading SA1 features and shapes...")
+print("Loading SA1 features and lookup index...")
 try:
-    features_df = pd.read_csv(features_csv)
+    features_df = table_store.read_table(features_csv)
     print(f"Loaded {len(features_df)} SA1 feature rows.")
 
-    print(f"Loading geometries from {ORIGINAL_GPKG_PATH}...")
-    sa1_shapes_gdf = gpd.read_file(
-        ORIGINAL_GPKG_PATH,
-        layer=GPKG_LAYER_NAME,
-        engine="fiona",
-        usecols=['SA1_CODE_2021', 'geometry']
-    )
-
     #fixed code here:
     print("Fixing data types for merge...")
     features_df['SA1_CODE_2021'] = features_df['SA1_CODE_2021'].astype(str)
-    sa1_shapes_gdf['SA1_CODE_2021'] = sa1_shapes_gdf['SA1_CODE_2021'].astype(str)
 
-    sa1_main_gdf = sa1_shapes_gdf.merge(
-        features_df,
-        on='SA1_CODE_2021',
-        how='right'
-    )
-    sa1_main_gdf = gpd.GeoDataFrame(sa1_main_gdf, crs=sa1_shapes_gdf.crs)
-    print(f"Master SA1 GeoDataFrame created with shape: {sa1_main_gdf.shape}")
-
-    #make sure two geopanda's dataframe are same
-    print(f"Projecting stores CRS to match SA1 CRS ({sa1_main_gdf.crs})...")
-    stores_gdf = stores_gdf.to_crs(sa1_main_gdf.crs)
+    # point -> SA1 code lookup on the cached strip index (built on first use);
+    # projects the lon/lat to the SA1 layer's CRS itself
+    print(f"Loading SA1 lookup for {ORIGINAL_GPKG_PATH}...")
+    lookup = sa1_lookup.SA1Lookup(ORIGINAL_GPKG_PATH, GPKG_LAYER_NAME)
 
 except FileNotFoundError:
     print(f"Error: One of the master files not found. Check paths.")
@@ -69,29 +55,30 @@ except Exception as e:
     exit()
 
 # Spatial Join
-print("Performing spatial join... (This may take a moment)")
-joined_gdf = gpd.sjoin(stores_gdf, sa1_main_gdf, how="inner", predicate="within")
-print(f"Spatial join complete. Found {len(joined_gdf)} stores located within SA1 regions.")
+print("Locating stores in SA1 regions...")
+store_sa1_codes = lookup.lookup(stores_df['longitude'].to_numpy(), stores_df['latitude'].to_numpy())
+store_sa1_codes = pd.Series(store_sa1_codes[pd.notna(store_sa1_codes)], name='SA1_CODE_2021')
+# stores in an SA1 without features are dropped, as with the old join on the feature table
+store_sa1_codes = store_sa1_codes[store_sa1_codes.isin(features_df['SA1_CODE_2021'])]
+print(f"Spatial join complete. Found {len(store_sa1_codes)} stores located within SA1 regions.")
 
 print("Calculating target variable (Y) 'store_count'...")
-if joined_gdf.empty:
+if store_sa1_codes.empty:
     print("Warning: Spatial join resulted in 0 matches. No stores were found inside the provided SA1 regions.")
-    sa1_main_gdf['store_count'] = 0
+    final_df_to_save = features_df.copy()
+    final_df_to_save['store_count'] = 0
 else:
-    store_counts = joined_gdf.groupby('index_right').size().reset_index(name='store_count')
-    store_counts_by_sa1 = joined_gdf.groupby('SA1_CODE_2021').size().reset_index(name='store_count')
+    store_counts_by_sa1 = store_sa1_codes.value_counts().rename('store_count').reset_index()
 
     print("Merging 'store_count' back into master table...")
-    final_gdf = sa1_main_gdf.merge(store_counts_by_sa1, on='SA1_CODE_2021', how='left')
+    final_df_to_save = features_df.merge(store_counts_by_sa1, on='SA1_CODE_2021', how='left')
 
-    final_gdf['store_count'] = final_gdf['store_count'].fillna(0).astype(int)
+    final_df_to_save['store_count'] = final_df_to_save['store_count'].fillna(0).astype(int)
 
 print("Saving final training dataset...")
 
-# remove the index 'shape' from dataset cause there is no need for training AI
-final_df_to_save = pd.DataFrame(final_gdf.drop(columns='geometry'))
-
-final_df_to_save.to_csv(FINAL_TRAINING_DATASET_PATH, index=False)
+FINAL_TRAINING_DATASET_PATH = table_store.write_table(final_df_to_save, FINAL_TRAINING_DATASET_PATH,
+                                                     {'store_count': table_store.COUNT_DTYPE})
 
 end_time = time.time()
 print("\n--- SUCCESS! ---")
@@ -0,0 +1,88 @@
+import numpy as np
+import pandas as pd
+
+# Engineered features declared as data and evaluated together.
+#
+# A base is (terms, zero_value): the sum of its terms, where a term is a
+# column name, or '-name' to subtract it. A base that sums to 0 is replaced
+# by zero_value before dividing.
+# A feature is (name, terms, base): the sum of its terms divided by the named
+# base, or just the sum when base is None.
+#
+# FeatureEngine turns the registry into coefficient matrices, so however many
+# features there are, evaluating them is one read of the used columns and two
+# matrix products. A feature that reads a NaN or infinite value, or whose
+# result is not finite, is 0.
+
+
+def _parse_term(term):
+    if term.startswith('-'):
+        return term[1:], -1.0
+    return term, 1.0
+
+
+class FeatureEngine:
+    """The features of a registry, compiled for one-pass evaluation."""
+
+    def __init__(self, features, bases):
+        names = [name for name, _, _ in features]
+        duplicates = sorted({name for name in names if names.count(name) > 1})
+        if duplicates:
+            raise ValueError(f"features defined more than once: {duplicates}")
+        unknown = sorted({base for _, _, base in features if base is not None and base not in bases})
+        if unknown:
+            raise ValueError(f"features use undefined bases: {unknown}")
+
+        # None is the base of plain sums: no terms, so always replaced by 1
+        base_names = [None] + sorted({base for _, _, base in features if base is not None})
+        base_defs = {None: ([], 1.0), **bases}
+
+        columns = []
+        for terms in [terms for _, terms, _ in features] + [base_defs[base][0] for base in base_names]:
+            for term in terms:
+                column, _ = _parse_term(term)
+                if column not in columns:
+                    columns.append(column)
+        column_pos = {column: i for i, column in enumerate(columns)}
+
+        def coefficients(term_lists):
+            matrix = np.zeros((len(columns), len(term_lists)))
+            for j, terms in enumerate(term_lists):
+                for term in terms:
+                    column, sign = _parse_term(term)
+                    matrix[column_pos[column], j] += sign
+            return matrix
+
+        self.names = names
+        self.columns = columns
+        self.numerators = coefficients([terms for _, terms, _ in features])
+        self.bases = coefficients([base_defs[base][0] for base in base_names])
+        self.zero_values = np.array([base_defs[base][1] for base in base_names], dtype=np.float64)
+        self.feature_bases = np.array([base_names.index(base) for _, _, base in features], dtype=np.intp)
+        # columns each feature reads, through its terms or its base
+        self.reads = (self.numerators != 0) | (self.bases[:, self.feature_bases] != 0)
+
+    def evaluate(self, df):
+        """(rows, features) float64 array of the features of df's rows."""
+        values = df[self.columns].to_numpy(dtype=np.float64, copy=True)
+        finite = np.isfinite(values)
+        values[~finite] = 0
+
+        numerators = values @ self.numerators
+        bases = values @ self.bases
+        bases = np.where(bases == 0, self.zero_values, bases)
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            result = numerators / bases[:, self.feature_bases]
+
+        invalid = ~np.isfinite(result)
+        if not finite.all():
+            invalid |= (~finite) @ self.reads
+        result[invalid] = 0
+        return result
+
+    def transform(self, df, keep_columns=()):
+        """DataFrame of keep_columns followed by the features."""
+        engineered_df = pd.DataFrame(self.evaluate(df), columns=self.names, index=df.index)
+        for i, column in enumerate(keep_columns):
+            engineered_df.insert(i, column, df[column])
+        return engineered_df
@@ -1,59 +1,268 @@
 import pandas as pd
+import numpy as np
 import os
+import sys
+from functools import reduce
 
-print("Starting data merging process (G01, G33, G62 + OSM Features)...")
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(CURRENT_DIR, '..', 'Data_selection'))
 
-PROJECT_ROOT = "/Users/Zhuanz/Documents/ACADEMIC/fifth-semaster/Introduction-to-AI/final_project"
-BASE_PATH = os.path.join(PROJECT_ROOT, 'Convenience_Store', 'Data_for_Conven')
+import catchment_counts
+import gpkg_attributes
+import state_shards
+import table_store
 
-path_g01 = os.path.join(BASE_PATH, 'G01.conven.csv')  # population
-path_g33 = os.path.join(BASE_PATH, 'G33.conven.csv')  # income
-path_g62 = os.path.join(BASE_PATH, 'G62.conven.csv')  # transportation
+MASTER_FILENAME = 'MASTER_Convenience_Store_Dataset.csv'
+COMMON_KEY = 'SA1_CODE_2021'
 
-path_osm_features = os.path.join(BASE_PATH, 'osm_features.csv')
+# (name, csv in the state's shard, keyed by region), merged in this column
+# order. Census tables are keyed by SA1; region tables by the regions of the
+# geography level (state_shards.GEOGRAPHY_LEVEL), in files of that level
+MERGE_TABLES = [
+    ('G01 (Population)', 'G01.conven.csv', False),
+    ('G33 (Income)', 'G33.conven.csv', False),
+    ('G62 (Transport)', 'G62.conven.csv', False),
+    ('OSM Features', 'osm_features.csv', True),
+    ('OSM Catchment', 'osm_catchment.csv', True),
+]
 
-output_path = os.path.join(BASE_PATH, 'MASTER_Convenience_Store_Dataset.csv')
+# Mesh Block level: each Mesh Block gets its SA1's census counts times its
+# share of the SA1's area, and its own area. The master is built and written
+# in spatial chunks of whole SA3s (SA1 code // SA3_DIVISOR), so memory is
+# bounded by the SA1 census tables plus one chunk
+AREA_COLUMN = 'AREA_ALBERS_SQKM'
+SA3_DIVISOR = 10 ** 6
+MERGE_CHUNK_ROWS = table_store.CHUNK_ROWS
 
-try:
-    df_g01 = pd.read_csv(path_g01)
-    df_g33 = pd.read_csv(path_g33)
-    df_g62 = pd.read_csv(path_g62)
 
-    df_osm = pd.read_csv(path_osm_features)
+def read_keyed_table(path, key=COMMON_KEY):
+    """A table indexed by its SA1 (or other region) code as a sorted int64 index.
 
-    print(f"Loaded G01 (Population). Shape: {df_g01.shape}")
-    print(f"Loaded G33 (Income).     Shape: {df_g33.shape}")
-    print(f"Loaded G62 (Transport).  Shape: {df_g62.shape}")
-    print(f"Loaded OSM Features.     Shape: {df_osm.shape}")
+    Returns (frame, codes that are not valid numbers or repeat an earlier row).
+    """
+    df = table_store.read_table(path)
+    raw_codes = df.pop(key)
+    codes = pd.to_numeric(raw_codes, errors='coerce')
+    valid = codes.notna().to_numpy()
+    df = df[valid]
+    df.index = codes[valid].astype(np.int64).to_numpy()
+    repeated = df.index.duplicated()
+    bad_codes = list(raw_codes[~valid].astype(str)) + list(df.index[repeated].astype(str))
+    df = df[~repeated].sort_index(kind='stable')
+    return df, bad_codes
 
-except FileNotFoundError as e:
-    print(f"Error: A CSV file was not found. Details: {e}")
-    print(f"Please check your paths in {BASE_PATH}")
-    exit()
 
-common_key = 'SA1_CODE_2021'
+def align_tables(tables, key=COMMON_KEY):
+    """Inner join of frames on their sorted, unique int64 indexes, in one pass.
 
-print(f"\nEnsuring all '{common_key}' keys are strings for merging...")
-df_g01[common_key] = df_g01[common_key].astype(str)
-df_g33[common_key] = df_g33[common_key].astype(str)
-df_g62[common_key] = df_g62[common_key].astype(str)
-df_osm[common_key] = df_osm[common_key].astype(str)
+    The common keys are intersected once and every column is taken at its
+    rows once, instead of rehashing and copying the frame at every join.
+    Returns (merged frame, keys each table loses).
+    """
+    keys = [df.index.to_numpy() for df in tables]
+    common = reduce(lambda a, b: np.intersect1d(a, b, assume_unique=True), keys)
 
-print("Starting merges...")
+    columns = {key: common}
+    for df, table_keys in zip(tables, keys):
+        positions = np.searchsorted(table_keys, common)
+        for col in df.columns:
+            columns[col] = df[col].to_numpy()[positions]
+    dropped = [np.setdiff1d(table_keys, common, assume_unique=True) for table_keys in keys]
+    return pd.DataFrame(columns), dropped
 
-merged_df = pd.merge(df_g01, df_g33, on=common_key, how='inner')
-print(f"After merging G01 + G33, shape is: {merged_df.shape}")
 
-merged_df = pd.merge(merged_df, df_g62, on=common_key, how='inner')
-print(f"After merging + G62, shape is: {merged_df.shape}")
+def read_mesh_blocks(state):
+    """Mesh Blocks of one state: MB code, SA1 code and area, sorted by SA1 then MB code.
 
-final_df = pd.merge(merged_df, df_osm, on=common_key, how='inner')
-print(f"After merging + OSM Features, final shape is: {final_df.shape}")
+    Returns (frame, number of rows without valid codes).
+    """
+    gpkg_path, layer_name, mb_column, where = state_shards.region_layer(state, 'MB')
+    # the state filter runs in SQLite, so only the state's rows are read
+    mb_df = gpkg_attributes.read_attribute_frame(gpkg_path, layer_name, [mb_column, COMMON_KEY, AREA_COLUMN],
+                                                 where=where)
 
-if final_df.empty:
-    print("Error: The final dataframe is empty. No common 'SA1_CODE_2021' keys.")
-else:
-    final_df.to_csv(output_path, index=False)
+    codes = mb_df[[mb_column, COMMON_KEY]].apply(pd.to_numeric, errors='coerce')
+    valid = codes.notna().all(axis=1).to_numpy()
+    mb_df = pd.DataFrame({
+        mb_column: codes[mb_column].to_numpy()[valid].astype(np.int64),
+        COMMON_KEY: codes[COMMON_KEY].to_numpy()[valid].astype(np.int64),
+        AREA_COLUMN: mb_df[AREA_COLUMN].to_numpy(dtype=np.float64)[valid],
+    })
+    mb_df = mb_df.sort_values([COMMON_KEY, mb_column], kind='stable').reset_index(drop=True)
+    return mb_df, int((~valid).sum())
+
+
+def area_shares(sa1_codes, areas):
+    """Share of its SA1's area of every Mesh Block (rows sorted by SA1 code).
+
+    The Mesh Blocks of an SA1 without area split it evenly.
+    """
+    _, starts, sizes = np.unique(sa1_codes, return_index=True, return_counts=True)
+    areas = np.nan_to_num(areas)
+    totals = np.repeat(np.add.reduceat(areas, starts) if len(starts) else areas[:0], sizes)
+    evenly = 1.0 / np.repeat(sizes, sizes)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(totals > 0, areas / totals, evenly)
+
+
+def spatial_chunks(sa1_codes, max_rows=None):
+    """(start, stop) row ranges of whole SA3s, up to max_rows rows each unless one SA3 is bigger."""
+    max_rows = max_rows or MERGE_CHUNK_ROWS
+    sa3_starts = np.flatnonzero(np.diff(sa1_codes // SA3_DIVISOR, prepend=-1)).tolist() + [len(sa1_codes)]
+    start = 0
+    for sa3_start, sa3_stop in zip(sa3_starts[:-1], sa3_starts[1:]):
+        if sa3_stop - start > max_rows and sa3_start > start:
+            yield start, sa3_start
+            start = sa3_start
+    if start < len(sa1_codes):
+        yield start, len(sa1_codes)
+
+
+def _find(keys, codes):
+    """Positions of codes in the sorted keys, and whether each one is there."""
+    positions = np.searchsorted(keys, codes)
+    found = positions < len(keys)
+    found[found] = keys[positions[found]] == codes[found]
+    return positions, found
+
+
+def mesh_block_chunks(mb_df, census_df, region_df, mb_column, kept):
+    """Master rows of the Mesh Blocks in census_df (SA1 index) and region_df
+    (MB index), one spatial chunk at a time. kept collects the MB codes written.
+    """
+    census_keys = census_df.index.to_numpy()
+    region_keys = region_df.index.to_numpy()
+    scaled = [col for col in census_df.columns
+              if col != AREA_COLUMN and pd.api.types.is_numeric_dtype(census_df[col])]
+    for start, stop in spatial_chunks(mb_df[COMMON_KEY].to_numpy()):
+        chunk = mb_df.iloc[start:stop]
+        sa1_codes = chunk[COMMON_KEY].to_numpy()
+        mb_codes = chunk[mb_column].to_numpy()
+        census_pos, in_census = _find(census_keys, sa1_codes)
+        region_pos, in_regions = _find(region_keys, mb_codes)
+        keep = in_census & in_regions
+        census_pos, region_pos = census_pos[keep], region_pos[keep]
+        shares = chunk['share'].to_numpy()[keep]
+        kept.append(mb_codes[keep])
+
+        columns = {mb_column: mb_codes[keep], COMMON_KEY: sa1_codes[keep]}
+        for col in census_df.columns:
+            values = census_df[col].to_numpy()[census_pos]
+            if col == AREA_COLUMN:
+                values = chunk[AREA_COLUMN].to_numpy()[keep]
+            elif col in scaled:
+                values = values * shares
+            columns[col] = values
+        for col in region_df.columns:
+            columns[col] = region_df[col].to_numpy()[region_pos]
+        yield pd.DataFrame(columns)
+
+
+def merge_mesh_blocks(state, census_df, region_tables, output_path):
+    """Write the Mesh Block master of one state in spatial chunks; returns (path, rows)."""
+    mb_column = state_shards.MB_CODE_COLUMN
+    print(f"\nReading the Mesh Blocks of {state} from {state_shards.mb_gpkg_path()}...")
+    mb_df, invalid = read_mesh_blocks(state)
+    mb_df['share'] = area_shares(mb_df[COMMON_KEY].to_numpy(), mb_df[AREA_COLUMN].to_numpy())
+    print(f"Loaded {len(mb_df)} Mesh Blocks in {mb_df[COMMON_KEY].nunique()} SA1s "
+          f"({invalid} without valid codes)")
+
+    region_df, region_dropped = align_tables([df for _, df, _ in region_tables], mb_column)
+    region_df = region_df.set_index(mb_column)
+
+    print(f"Writing the Mesh Block master in chunks of whole SA3s (up to {MERGE_CHUNK_ROWS} rows)...")
+    kept = []
+    output_path, rows = table_store.write_table_chunks(
+        mesh_block_chunks(mb_df, census_df, region_df, mb_column, kept), output_path)
+    kept = np.concatenate(kept) if kept else np.array([], dtype=np.int64)
+
+    print("Keys dropped at the Mesh Block join:")
+    no_census = ~np.isin(mb_df[COMMON_KEY].to_numpy(), census_df.index.to_numpy())
+    print(f"  {'Mesh Blocks':<17} {int(no_census.sum())} in an SA1 without census rows, "
+          f"{len(mb_df) - int(no_census.sum()) - len(kept)} without region counts")
+    unused = np.setdiff1d(census_df.index.to_numpy(), mb_df[COMMON_KEY].to_numpy())
+    print(f"  {'Census SA1s':<17} {len(unused)} without Mesh Blocks")
+    for (name, df, bad), table_dropped in zip(region_tables, region_dropped):
+        not_mb = np.setdiff1d(df.index.to_numpy(), mb_df[mb_column].to_numpy())
+        print(f"  {name:<17} {len(not_mb)} not Mesh Blocks of {state}, "
+              f"{len(table_dropped)} not in every region table, {len(bad)} invalid or repeated")
+    return output_path, rows
+
+
+def merge_state(state=state_shards.DEFAULT_STATE):
+    """Merge one state's G01/G33/G62 extracts and OSM feature and catchment counts into its master table."""
+    level = state_shards.check_level()
+    print(f"Starting data merging process (G01, G33, G62 + OSM Features and Catchment) for {state}, {level} level...")
+    base_path = state_shards.shard_dir(state)
+    output_path = os.path.join(base_path, state_shards.level_filename(MASTER_FILENAME))
+    region_key = state_shards.region_code_column()
+
+    # shards built before the catchment counts existed get them from their feature points
+    if not os.path.exists(table_store.existing_table_path(catchment_counts.catchment_path(state))):
+        print("No catchment counts in the shard, computing them from the OSM feature points...")
+        catchment_counts.write_state_catchment(state)
+
+    names = [name for name, _, _ in MERGE_TABLES]
+    tables, bad_codes, per_region = [], [], []
+    try:
+        for name, filename, keyed_by_region in MERGE_TABLES:
+            if keyed_by_region:
+                filename = state_shards.level_filename(filename)
+            df, bad = read_keyed_table(os.path.join(base_path, filename),
+                                       region_key if keyed_by_region else COMMON_KEY)
+            tables.append(df)
+            bad_codes.append(bad)
+            per_region.append(keyed_by_region)
+            print(f"Loaded {name:<17} Shape: {df.shape}")
+
+    except FileNotFoundError as e:
+        print(f"Error: A table was not found. Details: {e}")
+        print(f"Please check your paths in {base_path}")
+        return None
+
+    all_columns = [col for df in tables for col in df.columns]
+    clashes = sorted({col for col in all_columns if all_columns.count(col) > 1})
+    if clashes:
+        print(f"Error: columns {clashes} appear in more than one table.")
+        return None
+
+    if level == 'MB':
+        census = [i for i, keyed_by_region in enumerate(per_region) if not keyed_by_region]
+        print(f"\nAligning the census tables on int64 '{COMMON_KEY}' keys...")
+        census_df, dropped = align_tables([tables[i] for i in census])
+        print("Keys dropped per census table:")
+        for i, table_dropped in zip(census, dropped):
+            print(f"  {names[i]:<17} {len(table_dropped)} not in every table, {len(bad_codes[i])} invalid or repeated")
+        region_tables = [(names[i], tables[i], bad_codes[i]) for i, keyed_by_region in enumerate(per_region)
+                         if keyed_by_region]
+        output_path, rows = merge_mesh_blocks(state, census_df.set_index(COMMON_KEY), region_tables, output_path)
+        if not rows:
+            print("Error: no Mesh Block has both census rows and region counts.")
+            return None
+        print(f"\nSuccess! Mesh Block master dataset ({rows} rows) saved to: {output_path}")
+        return output_path
+
+    print(f"\nAligning all tables on int64 '{COMMON_KEY}' keys...")
+    final_df, dropped = align_tables(tables)
+
+    print("Keys dropped per table:")
+    for name, bad, table_dropped in zip(names, bad_codes, dropped):
+        examples = [str(code) for code in table_dropped[:5]] + bad[:5]
+        print(f"  {name:<17} {len(table_dropped)} not in every table, {len(bad)} invalid or repeated"
+              + (f" (e.g. {', '.join(examples)})" if examples else ""))
+    print(f"After merging every table, final shape is: {final_df.shape}")
+
+    if final_df.empty:
+        print("Error: The final dataframe is empty. No common 'SA1_CODE_2021' keys.")
+        return None
+
+    # columns keep the types of their tables
+    output_path = table_store.write_table(final_df, output_path)
     print(f"\nSuccess! Master feature dataset saved to: {output_path}")
     print("\nNew Master Dataset Head (Top 5 rows):")
-    print(final_df.head())
\ No newline at end of file
+    print(final_df.head())
+    return output_path
+
+
+if __name__ == "__main__":
+    merge_state(state_shards.check_state(sys.argv[1]) if len(sys.argv) > 1 else state_shards.DEFAULT_STATE)
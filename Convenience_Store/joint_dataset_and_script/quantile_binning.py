@@ -0,0 +1,129 @@
+import json
+import os
+import sys
+import warnings
+
+import numpy as np
+import pandas as pd
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(CURRENT_DIR, '..', 'Data_selection'))
+
+import table_store
+
+# Quantile bins fitted once on the national dataset and saved next to it, so
+# a new SA1 or candidate site is binned with the same edges as the training
+# data. Bins are the labels of pd.qcut(col, q, labels=False,
+# duplicates='drop'): edge i < value <= edge i+1 is bin i, the first edge is
+# in bin 0, repeated edges are dropped.
+BIN_COUNT = 5
+BINS_VERSION = 1
+
+
+def quantile_levels(q):
+    """The quantile levels pd.qcut uses for q bins."""
+    levels = np.linspace(0, 1, q + 1)
+    # qcut rounds levels that are not exact in base 2 up
+    np.putmask(levels, q * levels != np.arange(q + 1), np.nextafter(levels, 1))
+    return levels
+
+
+class QuantileBinner:
+    """Per-column bin edges; fit on a table, then transform any batch of rows."""
+
+    def __init__(self, q=BIN_COUNT, edges=None):
+        self.q = q
+        # column -> increasing edges; fewer than 2 edges leaves nothing to bin into
+        self.edges = edges or {}
+
+    def fit(self, df, columns):
+        """Edges of the numeric columns, all in one quantile call."""
+        columns = [col for col in columns if col in df.columns]
+        skipped = [col for col in columns if not pd.api.types.is_numeric_dtype(df[col])]
+        if skipped:
+            print(f"  Not binning non-numeric columns: {skipped}")
+        columns = [col for col in columns if col not in skipped]
+
+        values = df[columns].to_numpy(dtype=np.float64)
+        if len(values) == 0:
+            quantiles = np.full((self.q + 1, len(columns)), np.nan)
+        else:
+            with warnings.catch_warnings():
+                # a column with no values has NaN edges
+                warnings.simplefilter('ignore', RuntimeWarning)
+                quantiles = np.nanquantile(values, quantile_levels(self.q), axis=0)
+
+        self.edges = {}
+        for j, col in enumerate(columns):
+            col_edges = quantiles[:, j]
+            col_edges = col_edges[~np.isnan(col_edges)]
+            self.edges[col] = [float(edge) for edge in pd.unique(col_edges)]
+        return self
+
+    def bin_values(self, col, values, clip=False):
+        """Bin labels of values: int64, or float64 with NaN for values
+        outside the fitted range unless clip puts them in the end bins."""
+        edges = np.asarray(self.edges[col], dtype=np.float64)
+        values = np.asarray(values)
+        if len(edges) < 2:
+            return np.full(len(values), np.nan)
+
+        labels = np.searchsorted(edges, values, side='left') - 1
+        labels[values == edges[0]] = 0
+        if clip:
+            labels = np.clip(labels, 0, len(edges) - 2)
+            missing = pd.isna(values)
+        else:
+            missing = pd.isna(values) | (labels < 0) | (labels == len(edges) - 1)
+        if missing.any():
+            labels = labels.astype(np.float64)
+            labels[missing] = np.nan
+        return labels
+
+    def transform(self, df, clip=False):
+        """Copy of df with every fitted column replaced by its bin labels."""
+        binned_df = df.copy()
+        for col in self.edges:
+            if col in binned_df.columns:
+                binned_df[col] = self.bin_values(col, binned_df[col].to_numpy(), clip)
+        return binned_df
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'version': BINS_VERSION, 'q': self.q, 'edges': self.edges}, f, indent=2)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r', encoding='utf-8') as f:
+            saved = json.load(f)
+        if saved.get('version') != BINS_VERSION:
+            raise ValueError(f"{path} was written by another version of quantile_binning.py")
+        return cls(saved['q'], saved['edges'])
+
+
+def bins_path(dataset_path):
+    """Where the bin edges of a dataset are saved."""
+    return os.path.splitext(dataset_path)[0] + '_bins.json'
+
+
+if __name__ == "__main__":
+    # python quantile_binning.py FEATURES_TABLE OUTPUT_TABLE [BINS_JSON]
+    # bins a table of engineered features (e.g. candidate sites) with the
+    # edges saved by Group_attributes_to_finalize_data.py; values beyond the
+    # training range go in the end bins
+    if len(sys.argv) < 3:
+        print("Usage: python quantile_binning.py FEATURES_TABLE OUTPUT_TABLE [BINS_JSON]")
+        sys.exit()
+    import Group_attributes_to_finalize_data as finalize
+    edges_path = sys.argv[3] if len(sys.argv) > 3 else bins_path(finalize.final_dataset_path())
+    try:
+        binner = QuantileBinner.load(edges_path)
+        features_df = table_store.read_table(sys.argv[1])
+    except FileNotFoundError as e:
+        print(f"Error: {e}")
+        sys.exit()
+    output_path = table_store.write_table(binner.transform(features_df, clip=True), sys.argv[2])
+    print(f"Binned {len(features_df)} rows with {edges_path} -> {output_path}")
@@ -0,0 +1,316 @@
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_SELECTION_DIR = os.path.join(CURRENT_DIR, '..', 'Data_selection')
+sys.path.append(DATA_SELECTION_DIR)
+
+import cache_utils
+import catchment_counts
+import census_extractor
+import geographic_store_data_extraction as store_scan
+import gpkg_attributes
+import osm_apply
+import osm_area_points
+import osm_region_extract
+import osm_single_pass_scan
+import osmium_feature_counter as feature_scan
+import pbf_blocks
+import pipeline_records
+import sa1_geometry_cache
+import sa1_lookup
+import sa1_point_join
+import state_shards
+import table_store
+import feature_engine
+import Group_attributes_to_finalize_data as finalize
+import quantile_binning
+import merge_features_from_G01_G33_G62 as merge_features
+
+# Every stage declares the files it reads and writes. A stage's fingerprint
+# hashes the content of its inputs, the source files of its code and its
+# settings; a stage whose fingerprint and outputs match its last successful
+# run is skipped. An upstream stage that reruns but writes the same bytes
+# leaves everything below it up to date.
+#
+# Per state: osm_features -> catchment; census:<table>, osm_features and
+# catchment -> merge; merge and stores -> features. Then every state's
+# features -> combine.
+
+CONFIG_PATH = census_extractor.CONFIG_PATH
+# pipeline_state.json and the digest cache are kept by pipeline_records
+# stages run at the same time
+PIPELINE_WORKERS = 4
+# bump to rebuild everything
+PIPELINE_VERSION = 1
+
+OSM_CODE = [osm_single_pass_scan, osm_apply, osm_area_points, osm_region_extract, sa1_geometry_cache]
+SA1_LOOKUP_CODE = [sa1_lookup, sa1_point_join, sa1_geometry_cache]
+
+
+class Stage:
+    """func(*args) reads inputs and writes outputs.
+
+    code lists the modules whose source is part of the fingerprint, params
+    any JSON-able settings that are. Stages with the same lock never run at
+    the same time.
+    """
+
+    def __init__(self, name, func, args, inputs, outputs, code, params=None, lock=None):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.inputs = inputs
+        self.outputs = outputs
+        self.code = [module.__file__ for module in code]
+        self.params = params
+        self.lock = lock
+
+
+def run_census_table(table, state):
+    results = census_extractor.extract_tables(CONFIG_PATH, [table], workers=1, state=state)
+    if not results or results[0][2] is None:
+        raise RuntimeError(f"census extraction of {table} failed")
+
+
+def run_osm_scan(task, state):
+    osm_single_pass_scan.main([task], state)
+
+
+def run_catchment(state):
+    catchment_counts.write_state_catchment(state)
+
+
+def run_merge(state):
+    if merge_features.merge_state(state) is None:
+        raise RuntimeError("merge failed")
+
+
+def run_state_features(state):
+    if finalize.build_state_features(state) is None:
+        raise RuntimeError("feature build failed")
+
+
+def run_combine(states, output_path):
+    if finalize.combine_states(states, output_path) is None:
+        raise RuntimeError("combine failed")
+
+
+def state_stages(state, config):
+    """The stages of one state, up to its engineered features."""
+    gpkg_path, _, counts_path, points_path = feature_scan.state_paths(state)
+    counts_path, points_path = table_store.table_path(counts_path), table_store.table_path(points_path)
+    stores_csv_path = store_scan.state_output_path(state)
+    # node ids of the placed ways, for osm_incremental_update.py
+    store_way_nodes_path = table_store.table_path(osm_area_points.way_nodes_path(stores_csv_path))
+    osm_file_path = osm_single_pass_scan.OSM_FILE_PATH
+    level = state_shards.check_level()
+    master_path = table_store.table_path(state_shards.shard_path(
+        state, state_shards.level_filename(merge_features.MASTER_FILENAME)))
+    features_path = table_store.table_path(finalize.state_features_path(state))
+    catchment_path = table_store.table_path(catchment_counts.catchment_path(state))
+    # the regions of the level: SA1s are in gpkg_path, Mesh Blocks in the national layer
+    region_gpkg_path = state_shards.region_layer(state)[0]
+
+    stages = []
+    census_outputs = []
+    for table in census_extractor.census_tables(config):
+        settings = config[table]
+        output_path = table_store.table_path(settings['output_path'])
+        census_outputs.append(output_path)
+        stages.append(Stage(
+            f"census:{table}:{state}", run_census_table, (table, state),
+            [settings['input_path']], [output_path],
+            [census_extractor, gpkg_attributes, table_store],
+            {'settings': settings, 'reader': census_extractor.ATTRIBUTE_READER,
+             'format': table_store.STORAGE_FORMAT},
+        ))
+
+    stages.append(Stage(
+        f"stores:{state}", run_osm_scan, ('stores', state),
+        [osm_file_path, gpkg_path], [stores_csv_path, store_way_nodes_path],
+        [store_scan, table_store] + OSM_CODE,
+        lock=f"osm:{state}",
+    ))
+    # TARGET_FEATURES lives in osmium_feature_counter.py, so editing it
+    # reruns this stage and what reads osm_features.csv, not the store scan.
+    # The two scans of a state share its region extract and node location
+    # index file, so they take turns
+    stages.append(Stage(
+        f"osm_features:{state}", run_osm_scan, ('features', state),
+        [osm_file_path, gpkg_path] + ([region_gpkg_path] if level == 'MB' else []),
+        [counts_path, points_path, osm_area_points.way_nodes_path(points_path)],
+        [feature_scan, pbf_blocks, table_store] + OSM_CODE + SA1_LOOKUP_CODE,
+        {'format': table_store.STORAGE_FORMAT, 'level': level},
+        lock=f"osm:{state}",
+    ))
+    # the centroids are those of the level's regions
+    stages.append(Stage(
+        f"catchment:{state}", run_catchment, (state,),
+        [points_path, region_gpkg_path], [catchment_path],
+        [catchment_counts, feature_scan, sa1_geometry_cache, table_store],
+        {'format': table_store.STORAGE_FORMAT, 'level': level, 'radii': catchment_counts.CATCHMENT_RADII_M,
+         'crs': catchment_counts.PROJECTED_CRS},
+    ))
+    stages.append(Stage(
+        f"merge:{state}", run_merge, (state,),
+        census_outputs + [counts_path, catchment_path] + ([region_gpkg_path] if level == 'MB' else []), [master_path],
+        [merge_features, gpkg_attributes, table_store],
+        {'tables': merge_features.MERGE_TABLES, 'format': table_store.STORAGE_FORMAT, 'level': level,
+         'chunk_rows': merge_features.MERGE_CHUNK_ROWS},
+    ))
+    stages.append(Stage(
+        f"features:{state}", run_state_features, (state,),
+        [master_path, stores_csv_path, region_gpkg_path], [features_path],
+        [finalize, feature_engine, catchment_counts, table_store] + SA1_LOOKUP_CODE,
+        {'format': table_store.STORAGE_FORMAT, 'level': level},
+    ))
+    return stages
+
+
+def pipeline_stages(states):
+    stages = []
+    for state in states:
+        config = census_extractor.load_config(CONFIG_PATH)
+        if config is None:
+            sys.exit()
+        config = census_extractor.resolve_paths(state_shards.fill_state(config, state),
+                                                os.path.dirname(os.path.abspath(CONFIG_PATH)))
+        stages += state_stages(state, config)
+
+    final_path = finalize.final_dataset_path()
+    stages.append(Stage(
+        "combine", run_combine, (states, final_path),
+        [table_store.table_path(finalize.state_features_path(state)) for state in states],
+        [table_store.table_path(final_path), quantile_binning.bins_path(final_path)],
+        [finalize, quantile_binning, table_store],
+        {'format': table_store.STORAGE_FORMAT, 'bins': quantile_binning.BIN_COUNT,
+         'level': state_shards.check_level()},
+    ))
+    return stages
+
+
+def stage_fingerprint(stage):
+    """Hash of the stage's inputs, code and settings; None when an input is missing."""
+    missing = [path for path in stage.inputs if not os.path.exists(path)]
+    if missing:
+        print(f"[{stage.name}] Error: missing input(s) {missing}")
+        return None
+    parts = [PIPELINE_VERSION, stage.name, json.dumps(stage.params, sort_keys=True, default=str)]
+    for path in stage.code + stage.inputs:
+        parts.append(f"{os.path.basename(path)}={pipeline_records.file_digest(path)}")
+    return cache_utils.cache_key(*parts)
+
+
+def output_digests(stage):
+    return pipeline_records.file_digests(stage.outputs)
+
+
+def _execute(func, args):
+    """Run a stage in a worker; returns an error message or None."""
+    try:
+        func(*args)
+    except SystemExit:
+        # the stage scripts exit on missing inputs after printing why
+        return "stopped, see the log above"
+    except Exception as e:
+        return f"{type(e).__name__}: {e}"
+    return None
+
+
+def run_stages(stages, workers=PIPELINE_WORKERS):
+    """Run every stale stage once its upstream stages are done, up to workers at a time.
+
+    Returns {stage name: 'ran', 'up to date', or an error}.
+    """
+    producers = {path: stage.name for stage in stages for path in stage.outputs}
+    upstream = {stage.name: {producers[path] for path in stage.inputs if path in producers}
+                for stage in stages}
+    pipeline_state = pipeline_records.load_pipeline_state()
+    pending = {stage.name: stage for stage in stages}
+    running = {}
+    results = {}
+
+    def ok(name):
+        return results.get(name) in ('ran', 'up to date')
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        while pending or running:
+            changed = True
+            while changed:
+                changed = False
+                for name, stage in list(pending.items()):
+                    if any(dep in results and not ok(dep) for dep in upstream[name]):
+                        results[name] = "skipped, an upstream stage failed"
+                    elif all(ok(dep) for dep in upstream[name]):
+                        if stage.lock and any(other.lock == stage.lock for other, _ in running.values()):
+                            continue
+                        fingerprint = stage_fingerprint(stage)
+                        record = pipeline_state.get(name, {})
+                        if fingerprint is None:
+                            results[name] = "missing input"
+                        elif record.get('fingerprint') == fingerprint and record.get('outputs') == output_digests(stage):
+                            results[name] = 'up to date'
+                        else:
+                            print(f"--- [{name}] starting ---")
+                            running[pool.submit(_execute, stage.func, stage.args)] = (stage, fingerprint)
+                    else:
+                        continue
+                    del pending[name]
+                    changed = True
+
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage, fingerprint = running.pop(future)
+                error = future.result()
+                outputs = output_digests(stage)
+                if error is None and outputs is None:
+                    error = f"did not write {[path for path in stage.outputs if not os.path.exists(path)]}"
+                if error is None:
+                    pipeline_state[stage.name] = {'fingerprint': fingerprint, 'outputs': outputs}
+                    pipeline_records.save_pipeline_state(pipeline_state)
+                    results[stage.name] = 'ran'
+                else:
+                    results[stage.name] = error
+                print(f"--- [{stage.name}] {results[stage.name]} ---")
+
+    for name in pending:
+        results[name] = "skipped, an upstream stage failed"
+    return results
+
+
+def pipeline_states(requested):
+    """The requested states, or else every state with census data."""
+    if requested:
+        return [state_shards.check_state(state) for state in requested]
+    return [state for state in state_shards.STATES
+            if os.path.exists(state_shards.census_gpkg_path('G01', state))]
+
+
+def main(requested_states=None, workers=PIPELINE_WORKERS):
+    print("--- Running the data pipeline ---")
+    start_time = time.time()
+    states = pipeline_states(requested_states)
+    if not states:
+        print(f"Error: no census GeoPackages found in {state_shards.BASE_DATA_PATH}")
+        sys.exit()
+
+    stages = pipeline_stages(states)
+    results = run_stages(stages, workers)
+
+    print("\n--- Pipeline summary ---")
+    for stage in stages:
+        print(f"{stage.name}: {results[stage.name]}")
+    print(f"\nTotal wall time: {time.time() - start_time:.2f} seconds")
+    return results
+
+
+if __name__ == "__main__":
+    # python run_pipeline.py [STATE ...]
+    # reruns only the stages whose inputs, code or settings changed
+    main(sys.argv[1:])
@@ -1,33 +1,54 @@
 import osmium
+import numpy as np
 import sys
 import os
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 
-print("Starting tag scanning process...")
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(CURRENT_DIR, '..', '..', 'Convenience_Store', 'Data_selection'))
 
-PBF_FILE_PATH = "/Users/Zhuanz/Documents/ACADEMIC/fifth-semaster/Introduction-to-AI/final_project/data/australia-251105.osm.pbf"
-OUTPUT_DIR = "/Users/Zhuanz/Documents/ACADEMIC/fifth-semaster/Introduction-to-AI/final_project/script_to_clean_data/list_of_header"
+import osm_region_extract
+import pbf_blocks
+import state_shards
+
+PBF_FILE_PATH = os.path.join(state_shards.BASE_DATA_PATH, "australia-251105.osm.pbf")
+OUTPUT_DIR = os.path.join(CURRENT_DIR, "..", "list_of_header")
 OUTPUT_TXT_PATH = os.path.join(OUTPUT_DIR, "tag_scan_results.txt")
-os.makedirs(OUTPUT_DIR, exist_ok=True)
+
+TAG_KEYS = ('amenity', 'shop')
+
+# 'exact'  - count every value over all PBF blocks, SCAN_WORKERS processes
+# 'sample' - decode a random SAMPLE_FRACTION of the blocks and estimate the counts
+SCAN_MODE = 'exact'
+SCAN_WORKERS = 4
+SAMPLE_FRACTION = 0.02
+SAMPLE_SEED = 42
+# two-sided 95% normal interval
+CONFIDENCE_Z = 1.96
+
 
 # osmium to get ABS and ONLY data
 class TagScannerHandler(osmium.SimpleHandler):
+    # only objects with an amenity or shop key reach Python
+    FILTER_KEYS = TAG_KEYS
+
     def __init__(self):
         super(TagScannerHandler, self).__init__()
-        self.amenity_values = set()
-        self.shop_values = set()
+        # value -> number of objects, one Counter per key
+        self.value_counts = {key: Counter() for key in TAG_KEYS}
         self.elements_processed = 0
 
     def process_tags(self, tags):
-        if 'amenity' in tags:
-            self.amenity_values.add(tags['amenity'])
-
-        if 'shop' in tags:
-            self.shop_values.add(tags['shop'])
+        for key in TAG_KEYS:
+            if key in tags:
+                self.value_counts[key][tags[key]] += 1
 
         self.elements_processed += 1
         if self.elements_processed % 1000000 == 0:
-            print(f"Processed {self.elements_processed // 1000000}M elements... "
-                  f"(Found {len(self.amenity_values)} amenities, {len(self.shop_values)} shops)", end='\r')
+            print(f"Processed {self.elements_processed // 1000000}M tagged elements... "
+                  f"(Found {len(self.value_counts['amenity'])} amenities, "
+                  f"{len(self.value_counts['shop'])} shops)", end='\r')
 
 
     def node(self, n):
@@ -40,39 +61,143 @@ class TagScannerHandler(osmium.SimpleHandler):
         self.process_tags(r.tags)
 
 
-print(f"Scanning PBF file: {PBF_FILE_PATH}")
-print(f"Results will be saved to: {OUTPUT_TXT_PATH}")
-print("This will take several minutes...")
+def _scan_blocks(pbf_path, blobs, data_blobs):
+    handler = TagScannerHandler()
+    handler.apply_buffer(pbf_blocks.read_block_buffer(pbf_path, blobs, data_blobs), 'pbf',
+                         filters=[osmium.filter.KeyFilter(*TAG_KEYS)])
+    return handler.value_counts
+
+
+def _scan_blocks_one_by_one(pbf_path, blobs, data_blobs):
+    return [_scan_blocks(pbf_path, blobs, [blob]) for blob in data_blobs]
+
+
+def parallel_tag_count(pbf_file_path, workers=SCAN_WORKERS):
+    """Exact value counts, every worker scanning its own range of PBF blocks."""
+    blobs = pbf_blocks.read_blob_index(pbf_file_path)
+    ranges = pbf_blocks.split_block_ranges(blobs, workers)
+    print(f"    ...counting {len(blobs)} PBF blocks in {len(ranges)} ranges")
+
+    handler = TagScannerHandler()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for value_counts in pool.map(_scan_blocks, [pbf_file_path] * len(ranges), [blobs] * len(ranges), ranges):
+            for key in TAG_KEYS:
+                handler.value_counts[key].update(value_counts[key])
+    return handler
+
+
+def sampled_tag_estimates(pbf_file_path, fraction=SAMPLE_FRACTION, seed=SAMPLE_SEED, workers=SCAN_WORKERS):
+    """Estimated value counts from a random sample of PBF blocks.
+
+    Blocks are the sampling unit, so the interval comes from the spread of
+    the per-block counts (cluster sampling, with the finite population
+    correction). Values that never appear in the sample are not listed.
+    Returns {key: [(value, estimate, low, high, sampled count), ...]}.
+    """
+    blobs = pbf_blocks.read_blob_index(pbf_file_path)
+    n_blocks = sum(1 for b in blobs if b[2] == 'OSMData')
+    sample = pbf_blocks.sample_data_blobs(blobs, fraction, seed)
+    print(f"    ...sampling {len(sample)} of {n_blocks} PBF blocks (seed {seed})")
+
+    chunks = [sample[i::workers] for i in range(workers) if sample[i::workers]]
+    block_counts = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for counts in pool.map(_scan_blocks_one_by_one, [pbf_file_path] * len(chunks), [blobs] * len(chunks), chunks):
+            block_counts.extend(counts)
+
+    n_sample = len(block_counts)
+    estimates = {}
+    for key in TAG_KEYS:
+        values = sorted({value for counts in block_counts for value in counts[key]})
+        if not values:
+            estimates[key] = []
+            continue
+        # rows: sampled blocks, columns: values
+        matrix = np.array([[counts[key].get(value, 0) for value in values] for counts in block_counts],
+                          dtype=np.float64)
+        sampled = matrix.sum(axis=0)
+        estimate = n_blocks * matrix.mean(axis=0)
+        if n_sample > 1:
+            variance = n_blocks ** 2 * (1 - n_sample / n_blocks) * matrix.var(axis=0, ddof=1) / n_sample
+        else:
+            variance = np.full(len(values), np.nan)
+        margin = CONFIDENCE_Z * np.sqrt(variance)
+        low = np.maximum(estimate - margin, sampled)
+        high = estimate + margin
+        order = np.argsort(-estimate, kind='stable')
+        estimates[key] = [(values[i], float(estimate[i]), float(low[i]), float(high[i]), int(sampled[i]))
+                          for i in order]
+    return estimates, {'sampled_blocks': n_sample, 'total_blocks': n_blocks, 'seed': seed}
+
+
+def write_tag_scan_results(handler, output_txt_path=OUTPUT_TXT_PATH):
+    print("\n\nScan complete. Writing results to file...")
 
-if not os.path.exists(PBF_FILE_PATH):
-    print(f"Error: Input file not found at {PBF_FILE_PATH}")
-    sys.exit()
+    try:
+        os.makedirs(os.path.dirname(output_txt_path), exist_ok=True)
+        with open(output_txt_path, 'w', encoding='utf-8') as f:
+            for key in TAG_KEYS:
+                f.write(f"--- Unique '{key}' Tag Values Found (value, objects) ---\n")
+                f.write("=" * 40 + "\n")
+                # most frequent first, ties in alphabetical order
+                for value, count in sorted(handler.value_counts[key].items(), key=lambda item: (-item[1], item[0])):
+                    f.write(f"{value}\t{count}\n")
+                f.write("\n\n")
+
+        print(f"Success! Results saved to: {output_txt_path}")
+        for key in TAG_KEYS:
+            print(f"Total unique '{key}' values: {len(handler.value_counts[key])}")
 
-handler = TagScannerHandler()
+    except Exception as e:
+        print(f"Error writing to output file: {e}")
 
-try:
-    handler.apply_file(PBF_FILE_PATH, locations=False)
 
-finally:
-    print("\n\nScan complete. Writing results to file...")
+def write_tag_estimates(estimates, sample_info, output_txt_path=OUTPUT_TXT_PATH):
+    print("\n\nSampled scan complete. Writing estimates to file...")
 
     try:
-        with open(OUTPUT_TXT_PATH, 'w', encoding='utf-8') as f:
-            f.write("--- Unique 'amenity' Tag Values Found ---\n")
-            f.write("=" * 40 + "\n")
-            # sort the result for better read perpose
-            for amenity in sorted(handler.amenity_values):
-                f.write(f"{amenity}\n")
-
-            f.write("\n\n")
-            f.write("--- Unique 'shop' Tag Values Found ---\n")
-            f.write("=" * 40 + "\n")
-            for shop in sorted(handler.shop_values):
-                f.write(f"{shop}\n")
-
-        print(f"Success! Results saved to: {OUTPUT_TXT_PATH}")
-        print(f"Total unique 'amenity' values: {len(handler.amenity_values)}")
-        print(f"Total unique 'shop' values: {len(handler.shop_values)}")
+        os.makedirs(os.path.dirname(output_txt_path), exist_ok=True)
+        with open(output_txt_path, 'w', encoding='utf-8') as f:
+            f.write(f"# estimated from {sample_info['sampled_blocks']} of {sample_info['total_blocks']} "
+                    f"PBF blocks (seed {sample_info['seed']}), 95% interval\n\n")
+            for key in TAG_KEYS:
+                f.write(f"--- Estimated '{key}' Tag Values (value, estimate, low, high, sampled) ---\n")
+                f.write("=" * 40 + "\n")
+                for value, estimate, low, high, sampled in estimates[key]:
+                    f.write(f"{value}\t{estimate:.0f}\t{low:.0f}\t{high:.0f}\t{sampled}\n")
+                f.write("\n\n")
+
+        print(f"Success! Results saved to: {output_txt_path}")
+        for key in TAG_KEYS:
+            print(f"Unique '{key}' values seen in the sample: {len(estimates[key])}")
 
     except Exception as e:
-        print(f"Error writing to output file: {e}")
\ No newline at end of file
+        print(f"Error writing to output file: {e}")
+
+
+def main():
+    print("Starting tag scanning process...")
+    print(f"Scanning PBF file: {PBF_FILE_PATH}")
+    print(f"Results will be saved to: {OUTPUT_TXT_PATH}")
+    print(f"Scan mode: {SCAN_MODE}")
+
+    if not os.path.exists(PBF_FILE_PATH):
+        print(f"Error: Input file not found at {PBF_FILE_PATH}")
+        sys.exit()
+
+    pbf_file_path = osm_region_extract.resolve_scan_input(PBF_FILE_PATH)
+
+    if SCAN_MODE == 'sample':
+        estimates, sample_info = sampled_tag_estimates(pbf_file_path)
+        write_tag_estimates(estimates, sample_info, OUTPUT_TXT_PATH)
+    elif SCAN_MODE == 'exact':
+        print("This will take several minutes...")
+        handler = parallel_tag_count(pbf_file_path)
+        write_tag_scan_results(handler, OUTPUT_TXT_PATH)
+    else:
+        print(f"Error: unknown SCAN_MODE '{SCAN_MODE}'. Choose 'exact' or 'sample'")
+        sys.exit()
+
+
+if __name__ == "__main__":
+    main()